@@ -0,0 +1,406 @@
+"""
+allokeringsmotor.py - Kolumnbaserad allokeringsmotor för Teammanager
+Håller allokering och frånvaro i minnet som NumPy-arrayer (personindex,
+dagnummer, projektindex, timmar) med uppslagstabeller för id:n, och svarar på
+dashboardens summeringar med vektoriserade reduktioner (np.bincount).
+Allokeringarna läses per dag ur vyn allokering_dag (dagsrader, utvidgade
+perioder och regler). Nya skrivningar läses in inkrementellt ur ändringsloggen
+(andringslogg); en ändrad allokeringsperiod eller -regel läser om allt.
+
+Motorn är valfri och aktiveras med TEAMMANAGER_ALLOKERINGSMOTOR=1;
+annars returnerar hamta_motor() None och charts.py läser från databasen.
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from cache_utils import generation, vid_rensning
+from calendar_utils import hamta_busdaycalendar
+from database import (
+    hamta_all_personal, hamta_alla_projekt, hamta_generation, hamta_andringar_sedan,
+    hamta_synkhorisont, rensa_gammal_andringslogg, ANDRINGSLOGG_DAGAR,
+    hamta_allokeringsdagar, stromma_allokeringsdagar, stromma_franvarodagar, stromma_tabell,
+    FRANVARO_TYPER
+)
+
+MOTOR_AKTIV = os.environ.get("TEAMMANAGER_ALLOKERINGSMOTOR", "").lower() in ("1", "true", "ja")
+# Längsta tid mellan synkningar mot andra processers skrivningar; egna
+# skrivningar (lokala cachegenerationer) synkas alltid direkt.
+MOTOR_SYNK_S = float(os.environ.get("TEAMMANAGER_MOTOR_SYNK_S", 5))
+# Hur ofta motorn rensar gamla poster ur andringslogg (sekunder)
+MOTOR_RENSA_S = float(os.environ.get("TEAMMANAGER_MOTOR_RENSA_S", 3600))
+
+_TABELLER = ("allokering", "allokeringsperiod", "allokeringsregel", "franvaro", "personal", "projekt")
+
+
+def _dagnummer(datum):
+    """Dagar sedan 1970-01-01 för ett date-objekt eller en ISO-sträng."""
+    return int(np.datetime64(str(datum), "D").astype(np.int64))
+
+
+def _dagnummer_array(datum_lista):
+    return np.array(datum_lista, dtype="datetime64[D]").astype(np.int32)
+
+
+def _kapacitet(person):
+    """Personens kapacitet i timmar per dag; obegränsad bara om personen eller värdet saknas."""
+    kapacitet = None if person is None else person.get("kapacitet_h")
+    return np.inf if kapacitet is None else kapacitet
+
+
+def _iso_veckor(forsta, sista):
+    """Veckoindex per dag i [forsta, sista] och etiketterna (ÅÅÅÅ-Vnn) i ordning."""
+    dagar = np.arange(forsta, sista + 1, dtype=np.int64)
+    veckodag = (dagar + 3) % 7  # 1970-01-01 var en torsdag; måndag = 0
+    torsdag = dagar - veckodag + 3
+    ar = torsdag.astype("datetime64[D]").astype("datetime64[Y]")
+    vecka = (torsdag - ar.astype("datetime64[D]").astype(np.int64)) // 7 + 1
+    nyckel = (ar.astype(np.int64) + 1970) * 100 + vecka
+    unika, index = np.unique(nyckel, return_inverse=True)
+    return index, [f"{k // 100}-V{k % 100:02d}" for k in unika]
+
+
+class AllokeringsMotor:
+    """Allokering och frånvaro i kolumnform med inkrementell synk mot databasen."""
+
+    def __init__(self):
+        self._las = threading.RLock()
+        self.generation = 0
+        # PostgreSQL: horisont från förra läsningen av loggen och generationerna
+        # som då lästes — poster från transaktioner som pågick kan dyka upp sent
+        # med lägre generation och läses om tills horisonten har passerat dem
+        self._horisont = None
+        self._sedda = set()
+        self._lokal_generation = None
+        self._senast_synkad = 0.0
+        self._senast_rensad = time.monotonic()
+        self._tom()
+
+    def _tom(self):
+        self.personal = {}
+        self.projekt = {}
+        self._person_index, self._person_ids = {}, []
+        self._projekt_index, self._projekt_ids = {}, []
+        self._regelprojekt = {}
+        # Allokering: rad i arrayerna per (personindex, dag, projektindex)
+        self._n = 0
+        self._person = np.empty(0, np.int32)
+        self._dag = np.empty(0, np.int32)
+        self._projekt = np.empty(0, np.int32)
+        self._timmar = np.empty(0, np.float64)
+        self._giltig = np.empty(0, bool)
+        self._position = {}
+        self._lediga = []
+        # Frånvaro: en rad per (person, dag)
+        self._typer = list(FRANVARO_TYPER)
+        self._f_person = np.empty(0, np.int32)
+        self._f_dag = np.empty(0, np.int32)
+        self._f_typ = np.empty(0, np.int16)
+
+    # ------------------------------------------------------------
+    # Laddning och synk
+    # ------------------------------------------------------------
+
+    def _intern(self, index, ids, id_):
+        if id_ not in index:
+            index[id_] = len(ids)
+            ids.append(id_)
+        return index[id_]
+
+    def _ladda_uppslag(self):
+        self.personal = {p["id"]: p for p in hamta_all_personal(bara_aktiva=False)}
+        self.projekt = {p["id"]: p for p in hamta_alla_projekt(bara_aktiva=False)}
+        for pid in self.personal:
+            self._intern(self._person_index, self._person_ids, pid)
+        for prid in self.projekt:
+            self._intern(self._projekt_index, self._projekt_ids, prid)
+
+    def _ladda_franvaro(self):
+        personer, dagar, typer = [], [], []
+        for rader in stromma_franvarodagar():
+            for pid, datum, typ in rader:
+                personer.append(self._intern(self._person_index, self._person_ids, pid))
+                dagar.append(datum)
+                if typ not in self._typer:
+                    self._typer.append(typ)
+                typer.append(self._typer.index(typ))
+        self._f_person = np.array(personer, dtype=np.int32)
+        self._f_dag = _dagnummer_array(dagar)
+        self._f_typ = np.array(typer, dtype=np.int16)
+
+    def _reservera(self, antal):
+        """Se till att arrayerna rymmer antal rader till (dubblerad kapacitet)."""
+        behov = self._n + antal
+        if behov <= len(self._timmar):
+            return
+        kapacitet = max(behov, 2 * len(self._timmar), 1024)
+        for namn in ("_person", "_dag", "_projekt", "_timmar", "_giltig"):
+            gammal = getattr(self, namn)
+            ny = np.zeros(kapacitet, dtype=gammal.dtype)
+            ny[:self._n] = gammal[:self._n]
+            setattr(self, namn, ny)
+
+    def _lagg_till_block(self, personer, dagar, projekt, timmar):
+        antal = len(timmar)
+        self._reservera(antal)
+        start, slut = self._n, self._n + antal
+        self._person[start:slut] = personer
+        self._dag[start:slut] = dagar
+        self._projekt[start:slut] = projekt
+        self._timmar[start:slut] = timmar
+        self._giltig[start:slut] = True
+        for rad, nyckel in enumerate(zip(personer.tolist(), dagar.tolist(), projekt.tolist()), start):
+            self._position[nyckel] = rad
+        self._n = slut
+
+    def _satt(self, personal_id, projekt_id, datum, timmar):
+        """Sätt timmar för en nyckel; None eller <= 0 tar bort raden."""
+        nyckel = (self._intern(self._person_index, self._person_ids, personal_id),
+                  _dagnummer(datum),
+                  self._intern(self._projekt_index, self._projekt_ids, projekt_id))
+        rad = self._position.get(nyckel)
+        if timmar is None or timmar <= 0:
+            if rad is not None:
+                self._giltig[rad] = False
+                self._timmar[rad] = 0.0
+                del self._position[nyckel]
+                self._lediga.append(rad)
+            return
+        if rad is None:
+            if self._lediga:
+                rad = self._lediga.pop()
+            else:
+                self._reservera(1)
+                rad = self._n
+                self._n += 1
+            self._person[rad], self._dag[rad], self._projekt[rad] = nyckel
+            self._giltig[rad] = True
+            self._position[nyckel] = rad
+        self._timmar[rad] = timmar
+
+    def ladda(self):
+        """Läs in allt från databasen. Generation och loggposter från pågående
+        transaktioner läses först så att ändringar under laddningen spelas upp
+        vid nästa synk."""
+        with self._las:
+            horisont = hamta_synkhorisont()
+            gen = hamta_generation()
+            sedda = {a["generation"] for a in hamta_andringar_sedan(gen, _TABELLER, horisont=horisont)}
+            lokal = generation(*_TABELLER)
+            self._tom()
+            self._ladda_uppslag()
+            for rader in stromma_allokeringsdagar():
+                pids, prids, datum, timmar = zip(*rader)
+                self._lagg_till_block(
+                    np.array([self._intern(self._person_index, self._person_ids, p) for p in pids], np.int32),
+                    _dagnummer_array(datum),
+                    np.array([self._intern(self._projekt_index, self._projekt_ids, p) for p in prids], np.int32),
+                    np.array(timmar, np.float64),
+                )
+            self._ladda_franvaro()
+            # Projekt med regler per person: frånvaro ändrar deras regeldagar
+            for rader in stromma_tabell("allokeringsregel", ["personal_id", "projekt_id"]):
+                for pid, prid in rader:
+                    self._regelprojekt.setdefault(pid, set()).add(prid)
+            self.generation = max([gen, *sedda])
+            self._horisont, self._sedda = horisont, sedda
+            self._lokal_generation = lokal
+            self._senast_synkad = time.monotonic()
+
+    def synka(self):
+        """Applicera ändringar ur andringslogg sedan senaste synk.
+        Returnerar antal nya loggposter."""
+        with self._las:
+            if time.monotonic() - self._senast_synkad >= ANDRINGSLOGG_DAGAR * 86400 / 2:
+                # Loggen kan ha rensats förbi vår position
+                self.ladda()
+                return 0
+            lokal = generation(*_TABELLER)
+            horisont = hamta_synkhorisont()
+            andringar = hamta_andringar_sedan(self.generation, _TABELLER, horisont=self._horisont)
+            # Allt som inte lästes förra gången är nytt, också poster som blivit
+            # synliga sent med lägre generation än den senast lästa
+            nya = [a for a in andringar if a["generation"] not in self._sedda]
+            if any(a["tabell"] in ("allokeringsperiod", "allokeringsregel") for a in nya):
+                self.ladda()
+                return len(nya)
+            if any(a["tabell"] in ("personal", "projekt") for a in nya):
+                self._ladda_uppslag()
+            # Loggen säger vilka dagar som ändrats; vyn ger gällande värde
+            # (en borttagen dagsrad kan blotta en period, frånvaro stryker regeldagar)
+            nycklar = {(a["personal_id"], a["projekt_id"], a["datum"])
+                       for a in nya if a["tabell"] == "allokering"}
+            nycklar |= {(a["personal_id"], projekt_id, a["datum"])
+                        for a in nya if a["tabell"] == "franvaro"
+                        for projekt_id in self._regelprojekt.get(a["personal_id"], ())}
+            gallande = hamta_allokeringsdagar(nycklar)
+            for nyckel in nycklar:
+                self._satt(*nyckel, gallande.get(nyckel))
+            if any(a["tabell"] == "franvaro" for a in nya):
+                self._ladda_franvaro()
+            if andringar:
+                self.generation = max(self.generation, andringar[-1]["generation"])
+            # Nästa läsning ger bara poster med xid >= horisont, och de som
+            # redan syns nu finns alla i den här läsningen
+            self._horisont, self._sedda = horisont, {a["generation"] for a in andringar}
+            self._lokal_generation = lokal
+            self._senast_synkad = time.monotonic()
+            if time.monotonic() - self._senast_rensad >= MOTOR_RENSA_S:
+                self._senast_rensad = time.monotonic()
+                rensa_gammal_andringslogg()
+            return len(nya)
+
+    def synka_vid_behov(self):
+        """Synka om den här processen har skrivit sedan sist eller om
+        MOTOR_SYNK_S sekunder har gått."""
+        if (generation(*_TABELLER) != self._lokal_generation
+                or time.monotonic() - self._senast_synkad >= MOTOR_SYNK_S):
+            self.synka()
+
+    # ------------------------------------------------------------
+    # Summeringar
+    # ------------------------------------------------------------
+
+    def _urval(self, fran_datum, till_datum, personal_id=None):
+        """Radnummer för giltiga allokeringar i intervallet."""
+        n = self._n
+        dag = self._dag[:n]
+        mask = self._giltig[:n] & (dag >= _dagnummer(fran_datum)) & (dag <= _dagnummer(till_datum))
+        if personal_id is not None:
+            if personal_id not in self._person_index:
+                return np.empty(0, np.int64)
+            mask &= self._person[:n] == self._person_index[personal_id]
+        return np.flatnonzero(mask)
+
+    def _projektkolumner(self, projektindex):
+        projekt = [self.projekt.get(self._projekt_ids[i], {}) for i in projektindex]
+        return [p.get("namn") for p in projekt], [p.get("farg") for p in projekt]
+
+    def timmar_per_person_vecka(self, fran_datum, till_datum, bara_arbetsdagar=True):
+        """Allokerade timmar per person och ISO-vecka: DataFrame med personal_id
+        som index och veckoetiketter (ÅÅÅÅ-Vnn) som kolumner."""
+        with self._las:
+            forsta, sista = _dagnummer(fran_datum), _dagnummer(till_datum)
+            veckoindex, veckor = _iso_veckor(forsta, sista)
+            rader = self._urval(fran_datum, till_datum)
+            dag = self._dag[rader] - forsta
+            if bara_arbetsdagar:
+                arbetsdag = np.is_busday(np.arange(forsta, sista + 1).astype("datetime64[D]"),
+                                         busdaycal=hamta_busdaycalendar(fran_datum, till_datum))
+                behall = arbetsdag[dag]
+                rader, dag = rader[behall], dag[behall]
+            antal_personer, antal_veckor = len(self._person_ids), len(veckor)
+            summa = np.bincount(
+                self._person[rader].astype(np.int64) * antal_veckor + veckoindex[dag],
+                weights=self._timmar[rader], minlength=antal_personer * antal_veckor
+            ).reshape(antal_personer, antal_veckor)
+            return pd.DataFrame(summa, index=list(self._person_ids), columns=veckor)
+
+    def timmar_per_projekt_vecka(self, fran_datum, till_datum):
+        """Timmar per ISO-vecka och projekt: DataFrame med vecka, projekt_namn,
+        projekt_farg, timmar — en rad per kombination som har allokeringar."""
+        with self._las:
+            forsta, sista = _dagnummer(fran_datum), _dagnummer(till_datum)
+            veckoindex, veckor = _iso_veckor(forsta, sista)
+            rader = self._urval(fran_datum, till_datum)
+            if not len(rader):
+                return pd.DataFrame(columns=["vecka", "projekt_namn", "projekt_farg", "timmar"])
+            antal_projekt = len(self._projekt_ids)
+            nyckel = veckoindex[self._dag[rader] - forsta] * antal_projekt + self._projekt[rader]
+            langd = len(veckor) * antal_projekt
+            antal = np.bincount(nyckel, minlength=langd)
+            summa = np.bincount(nyckel, weights=self._timmar[rader], minlength=langd)
+            finns = np.flatnonzero(antal)
+            namn, farg = self._projektkolumner(finns % antal_projekt)
+            df = pd.DataFrame({
+                "vecka": [veckor[i] for i in finns // antal_projekt],
+                "projekt_namn": namn, "projekt_farg": farg, "timmar": summa[finns],
+            })
+            return df.sort_values(["vecka", "projekt_namn", "projekt_farg"]).reset_index(drop=True)
+
+    def timmar_per_projekt(self, fran_datum, till_datum, personal_id=None):
+        """Timmar per projekt (valfritt för en person): DataFrame med
+        projekt_namn, projekt_farg, timmar."""
+        with self._las:
+            rader = self._urval(fran_datum, till_datum, personal_id)
+            antal_projekt = len(self._projekt_ids)
+            antal = np.bincount(self._projekt[rader], minlength=antal_projekt)
+            summa = np.bincount(self._projekt[rader], weights=self._timmar[rader], minlength=antal_projekt)
+            finns = np.flatnonzero(antal)
+            namn, farg = self._projektkolumner(finns)
+            df = pd.DataFrame({"projekt_namn": namn, "projekt_farg": farg, "timmar": summa[finns]})
+            return df.sort_values(["projekt_namn", "projekt_farg"]).reset_index(drop=True)
+
+    def overbelagda(self, fran_datum, till_datum):
+        """Alla person+datum där summan överstiger kapaciteten: DataFrame med
+        personal_id, personal_namn, datum, kapacitet_h, total_timmar, overtid."""
+        with self._las:
+            forsta, sista = _dagnummer(fran_datum), _dagnummer(till_datum)
+            antal_dagar = sista - forsta + 1
+            rader = self._urval(fran_datum, till_datum)
+            nyckel = self._person[rader].astype(np.int64) * antal_dagar + (self._dag[rader] - forsta)
+            summa = np.bincount(nyckel, weights=self._timmar[rader],
+                                minlength=len(self._person_ids) * antal_dagar)
+            # Saknad person (eller NULL) räknas som obegränsad, som joinen i hamta_overbelagda; 0 h är 0 h
+            kapacitet = np.array([_kapacitet(self.personal.get(pid)) for pid in self._person_ids],
+                                 dtype=np.float64)
+            over = np.flatnonzero(summa > np.repeat(kapacitet, antal_dagar))
+            personer = [self._person_ids[i] for i in over // antal_dagar]
+            df = pd.DataFrame({
+                "personal_id": personer,
+                "personal_namn": [self.personal[pid]["namn"] for pid in personer],
+                "datum": (over % antal_dagar + forsta).astype("datetime64[D]").astype(str),
+                "kapacitet_h": kapacitet[over // antal_dagar],
+                "total_timmar": summa[over],
+            })
+            df["overtid"] = df["total_timmar"] - df["kapacitet_h"]
+            return df.sort_values(["datum", "personal_namn"]).reset_index(drop=True)
+
+    def franvaro_per_person_typ(self, fran_datum, till_datum):
+        """Antal frånvarodagar per person och typ: DataFrame med personal_namn, typ, dagar."""
+        with self._las:
+            mask = (self._f_dag >= _dagnummer(fran_datum)) & (self._f_dag <= _dagnummer(till_datum))
+            antal_typer = len(self._typer)
+            antal = np.bincount(self._f_person[mask].astype(np.int64) * antal_typer + self._f_typ[mask],
+                                minlength=len(self._person_ids) * antal_typer)
+            finns = np.flatnonzero(antal)
+            df = pd.DataFrame({
+                "personal_namn": [self.personal[self._person_ids[i]]["namn"] for i in finns // antal_typer],
+                "typ": [self._typer[i] for i in finns % antal_typer],
+                "dagar": antal[finns],
+            })
+            return df.sort_values(["personal_namn", "typ"]).reset_index(drop=True)
+
+
+_motor = None
+_motor_las = threading.Lock()
+
+
+def hamta_motor():
+    """Processens allokeringsmotor, synkad mot databasen, eller None om
+    motorn inte är aktiverad (TEAMMANAGER_ALLOKERINGSMOTOR)."""
+    global _motor
+    if not MOTOR_AKTIV:
+        return None
+    with _motor_las:
+        if _motor is None:
+            motor = AllokeringsMotor()
+            motor.ladda()
+            _motor = motor
+        else:
+            _motor.synka_vid_behov()
+        return _motor
+
+
+def _aterstall_motor():
+    """Släpp motorn (t.ex. vid byte av databas); nästa hamta_motor() laddar om."""
+    global _motor
+    with _motor_las:
+        _motor = None
+
+
+vid_rensning(_aterstall_motor)
@@ -6,35 +6,34 @@ lediga resurser, kopiera vecka, kommentarer och smart startsida.
 Kör med: streamlit run app.py
 """
 
+import os
 import streamlit as st
-import pandas as pd
 from datetime import date, timedelta, datetime
 from database import (
     init_db, hamta_all_personal, lagg_till_personal, uppdatera_personal,
     ta_bort_personal, hamta_alla_projekt, lagg_till_projekt, uppdatera_projekt,
-    ta_bort_projekt, hamta_allokeringar, satt_allokering, hamta_dagsbelastning,
+    ta_bort_projekt, hamta_allokeringar,
     hamta_kompetenser, hamta_alla_kompetenser, satt_kompetenser,
-    bulk_allokera, kopiera_vecka,
+    bulk_allokera, satt_allokeringar, kopiera_allokeringar,
     hamta_franvaro, satt_franvaro, bulk_franvaro, ta_bort_franvaro,
-    ar_franvarande, FRANVARO_TYPER,
+    FRANVARO_TYPER,
     hamta_kommentar, satt_kommentar, hamta_kommentarer_period,
     hamta_overbelagda, hamta_oallokerade, hamta_lediga_resurser,
-    hamta_teamoversikt
+    hamta_teamoversikt, hamta_allokeringsperioder,
+    hamta_allokeringsregler, satt_allokeringsregel, ta_bort_allokeringsregel,
+    arkivera, hamta_arkivstatus, ARKIV_AR
 )
 from calendar_utils import (
     skapa_manadskalender, ar_arbetsdag, hamta_arbetsdagar,
     hamta_svenska_helgdagar, antal_arbetsdagar_i_manad,
     VECKODAG_NAMN, MANAD_NAMN
 )
-from charts import (
-    skapa_belaggnings_heatmap, skapa_team_belaggning_stapel,
-    skapa_person_belaggning_pie, skapa_kapacitetsvarningar,
-    skapa_gantt_oversikt, skapa_franvaro_oversikt
-)
-from export_utils import (
-    exportera_allokeringar_csv, exportera_personal_csv,
-    exportera_belaggningsrapport_csv, generera_pdf_rapport
+from fragelogg_utils import FRAGELOGG_AKTIV, starta_insamling, avsluta_insamling, logga_rapport
+from profilering_utils import (
+    PROFILERING_LAGE, tolka_lage, starta_profilering, profil_steg, profil_del, avsluta_profilering
 )
+# pandas, charts (plotly) och export_utils (fpdf) importeras av sidorna som
+# använder dem, så att kallstarten och de enkla sidorna slipper ladda dem.
 
 # ============================================================
 # KONFIGURATION
@@ -47,6 +46,15 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Frågelogg: ?fragelogg=1 i adressen (eller TEAMMANAGER_FRAGELOGG=1) mäter alla SQL-satser i körningen
+fragelogg_pa = FRAGELOGG_AKTIV or st.query_params.get("fragelogg") == "1"
+if fragelogg_pa:
+    starta_insamling()
+
+# Profilering: ?profilering=delar|cprofile|sampling (eller TEAMMANAGER_PROFILERING) skriver till profiler/
+starta_profilering(tolka_lage(st.query_params.get("profilering") or PROFILERING_LAGE))
+profil_steg("uppstart")
+
 init_db()
 
 # ============================================================
@@ -193,6 +201,7 @@ hr { border-color: rgba(108,92,231,0.08) !important; margin: 24px 0 !important;
 # SIDEBAR
 # ============================================================
 
+profil_steg("sidofält")
 st.sidebar.markdown('<div class="sidebar-brand"><h2>Teammanager</h2><p>Resource Planning</p></div>',
                     unsafe_allow_html=True)
 st.sidebar.markdown("---")
@@ -223,8 +232,22 @@ st.sidebar.caption("v3.0 &middot; 2026")
 
 
 def page_header(title, subtitle):
+    profil_del("rubrik")
     st.markdown(f'<div class="page-header"><h1>{NAV_ICONS.get(title, "")} {title}</h1><p>{subtitle}</p></div>',
                 unsafe_allow_html=True)
+    profil_del("rendering")
+
+
+def export_knapp(nyckel, etikett, skapa, file_name, mime):
+    """Nedladdningsknapp som skapar exporten först när användaren klickar:
+    skapa (utan argument, returnerar bytes) anropas av Streamlit vid klicket,
+    inte vid varje rerun. Innehållet hämtas ur exportcachen i export_utils och
+    byggs bara om när datat har ändrats."""
+    st.download_button(etikett, skapa, key=f"ladda_{nyckel}",
+        file_name=file_name, mime=mime, use_container_width=True)
+
+
+profil_steg(sida)
 
 
 # ============================================================
@@ -234,6 +257,7 @@ def page_header(title, subtitle):
 if sida == "Hem":
     page_header("Hem", "Snabböversikt och åtgärder som kräver uppmärksamhet")
 
+    profil_del("data")
     idag = date.today()
     vecka_slut = idag + timedelta(days=(4 - idag.weekday()) if idag.weekday() < 5 else 0)
     arbetsdagar_veckan = hamta_arbetsdagar(idag, vecka_slut)
@@ -246,6 +270,7 @@ if sida == "Hem":
     overbelagda_nasta = hamta_overbelagda(nasta_vecka_start, nasta_vecka_slut)
     oallokerade_nu = hamta_oallokerade(idag, vecka_slut, arbetsdagar_veckan)
     franvaro_nu = hamta_franvaro(fran_datum=idag, till_datum=vecka_slut)
+    profil_del("rendering")
 
     # KPI-kort
     col1, col2, col3, col4 = st.columns(4)
@@ -289,13 +314,15 @@ if sida == "Hem":
     # Oallokerade
     if oallokerade_nu:
         with st.expander(f"Utan allokering denna vecka ({len(oallokerade_nu)} poster)", expanded=False):
-            df_oa = pd.DataFrame(oallokerade_nu)
-            st.dataframe(df_oa[["personal_namn", "datum", "roll"]], use_container_width=True, hide_index=True)
+            st.dataframe([{k: o[k] for k in ("personal_namn", "datum", "roll")} for o in oallokerade_nu],
+                         use_container_width=True, hide_index=True)
 
     # Lediga resurser idag
     st.markdown("---")
     st.markdown("### Lediga resurser idag")
+    profil_del("data")
     lediga = hamta_lediga_resurser(idag)
+    profil_del("rendering")
     if lediga:
         for l in lediga:
             pct = (l["ledigt"] / l["kapacitet_h"]) * 100
@@ -394,13 +421,17 @@ elif sida == "Resurser":
 
     st.markdown("---")
     visa_inaktiva = st.checkbox("Visa inaktiva", value=False)
+    profil_del("data")
     personal = hamta_all_personal(bara_aktiva=not visa_inaktiva)
+    profil_del("rendering")
 
     if not personal:
         st.markdown('<div class="glass-card" style="text-align:center;padding:48px;"><div style="font-size:48px;">&#128101;</div><h3>Inga medarbetare ännu</h3><p style="opacity:0.6;">Lägg till personal ovan.</p></div>', unsafe_allow_html=True)
     else:
         for person in personal:
+            profil_del("data")
             kompetenser = hamta_kompetenser(person["id"])
+            profil_del("rendering")
             label = f'{person["namn"]} — {person["roll"]}' if person["roll"] else person["namn"]
             with st.expander(label):
                 with st.form(f"edit_{person['id']}"):
@@ -447,7 +478,9 @@ elif sida == "Projekt":
 
     st.markdown("---")
     visa_avslutade = st.checkbox("Visa avslutade", value=False)
+    profil_del("data")
     projekt = hamta_alla_projekt(bara_aktiva=not visa_avslutade)
+    profil_del("rendering")
 
     if not projekt:
         st.markdown('<div class="glass-card" style="text-align:center;padding:48px;"><div style="font-size:48px;">&#128188;</div><h3>Inga projekt ännu</h3></div>', unsafe_allow_html=True)
@@ -479,10 +512,14 @@ elif sida == "Projekt":
 # ============================================================
 
 elif sida == "Allokering":
+    import pandas as pd
+
     page_header("Allokering", "Tilldela personal till projekt — med snabbverktyg")
 
+    profil_del("data")
     personal = hamta_all_personal()
     projekt = hamta_alla_projekt()
+    profil_del("rendering")
 
     if not personal:
         st.markdown('<div class="alert-warn">&#128161; Lägg till personal först under <b>Resurser</b>.</div>', unsafe_allow_html=True)
@@ -504,6 +541,14 @@ elif sida == "Allokering":
                     format_func=lambda p: f"{p['namn']} ({p['roll']})")
 
                 if person_val:
+                    # Hela periodens allokeringar och frånvaro i två frågor
+                    profil_del("data")
+                    allok_period = hamta_allokeringar(personal_id=person_val["id"],
+                                                      fran_datum=allok_start, till_datum=allok_slut)
+                    franvaro_period = {f["datum"]: f["typ"] for f in hamta_franvaro(
+                        personal_id=person_val["id"], fran_datum=allok_start, till_datum=allok_slut)}
+                    profil_del("rendering")
+
                     tab_snabb, tab_dag, tab_kopiera, tab_kommentar = st.tabs(
                         ["Snabballokering", "Dag-för-dag", "Kopiera vecka", "Kommentarer"]
                     )
@@ -541,54 +586,147 @@ elif sida == "Allokering":
                                         st.success(f"Allokerat {label} till {projekt[0]['namn']}")
                                         st.rerun()
 
+                        # Perioder som snabballokeringen har sparat (dagändringar går före)
+                        perioder = hamta_allokeringsperioder(personal_id=person_val["id"],
+                                                             fran_datum=allok_start, till_datum=allok_slut)
+                        if perioder:
+                            st.markdown("**Perioder i urvalet:**")
+                            for ap in perioder:
+                                st.caption(f"{ap['projekt_namn']}: {ap['start_datum']} – "
+                                           f"{ap['slut_datum']}, {ap['timmar']:.1f}h/dag")
+
+                        # Återkommande allokering (regler utvidgas vid läsning, hoppar över röda dagar och frånvaro)
+                        with st.expander("Återkommande allokering", expanded=False):
+                            with st.form("regel_form"):
+                                c1, c2, c3 = st.columns(3)
+                                with c1:
+                                    regel_proj = st.selectbox("Projekt", projekt,
+                                        format_func=lambda p: p["namn"], key="regel_proj")
+                                with c2:
+                                    regel_dag = st.selectbox("Veckodag", range(5),
+                                        format_func=lambda d: VECKODAG_NAMN[d], key="regel_dag")
+                                with c3:
+                                    regel_intervall = st.selectbox("Intervall", [1, 2, 3, 4],
+                                        format_func=lambda n: "Varje vecka" if n == 1
+                                        else ("Varannan vecka" if n == 2 else f"Var {n}:e vecka"),
+                                        key="regel_intervall")
+                                c1, c2, c3 = st.columns(3)
+                                with c1:
+                                    regel_timmar = st.number_input("Timmar", value=4.0,
+                                        min_value=0.5, max_value=12.0, step=0.5, key="regel_h")
+                                with c2: regel_start = st.date_input("Gäller från", value=allok_start, key="regel_fran")
+                                with c3: regel_slut = st.date_input("Gäller till", value=allok_slut, key="regel_till")
+                                if st.form_submit_button("Spara regel"):
+                                    try:
+                                        satt_allokeringsregel(person_val["id"], regel_proj["id"], regel_dag,
+                                                              regel_start, regel_slut, regel_timmar,
+                                                              intervall_veckor=regel_intervall)
+                                        st.success("Regeln sparad")
+                                        st.rerun()
+                                    except ValueError as e:
+                                        st.error(str(e))
+
+                            for regel in hamta_allokeringsregler(personal_id=person_val["id"],
+                                                                 fran_datum=allok_start, till_datum=allok_slut):
+                                c1, c2 = st.columns([5, 1])
+                                with c1:
+                                    takt = "varje" if regel["intervall_veckor"] == 1 else f"var {regel['intervall_veckor']}:e"
+                                    st.caption(f"{regel['projekt_namn']}: {VECKODAG_NAMN[regel['veckodag']]} {takt} vecka, "
+                                               f"{regel['timmar']:.1f}h ({regel['start_datum']} – {regel['slut_datum']})")
+                                with c2:
+                                    if st.button("Ta bort", key=f"regel_bort_{regel['id']}"):
+                                        ta_bort_allokeringsregel(regel["id"])
+                                        st.rerun()
+
                     # TAB: DAG FÖR DAG
                     with tab_dag:
                         st.markdown("#### Dag-för-dag-allokering")
 
+                        belastning_per_dag = {}
+                        for a in allok_period:
+                            belastning_per_dag[a["datum"]] = belastning_per_dag.get(a["datum"], 0) + a["timmar"]
+
                         for dag in arbetsdagar:
-                            belastning = hamta_dagsbelastning(person_val["id"], dag)
-                            franv = ar_franvarande(person_val["id"], dag)
-                            if franv:
-                                info = FRANVARO_TYPER.get(franv["typ"], FRANVARO_TYPER["ovrigt"])
+                            belastning = belastning_per_dag.get(str(dag), 0)
+                            franv_typ = franvaro_period.get(str(dag))
+                            if franv_typ:
+                                info = FRANVARO_TYPER.get(franv_typ, FRANVARO_TYPER["ovrigt"])
                                 st.markdown(f'<div class="alert-info">{info["ikon"]} {dag} ({VECKODAG_NAMN[dag.weekday()]}) — {info["namn"]}</div>', unsafe_allow_html=True)
                                 continue
                             if belastning > person_val["kapacitet_h"]:
                                 st.markdown(f'<div class="alert-danger">&#9888;&#65039; {dag}: {belastning:.1f}h / {person_val["kapacitet_h"]:.1f}h</div>', unsafe_allow_html=True)
 
-                        for proj in projekt:
-                            st.markdown(f'<span class="proj-dot" style="background:{proj["farg"]};"></span> **{proj["namn"]}**', unsafe_allow_html=True)
-                            for rs in range(0, len(arbetsdagar), 7):
-                                rd = arbetsdagar[rs:rs + 7]
-                                cols = st.columns(len(rd))
-                                for i, dag in enumerate(rd):
-                                    bef = hamta_allokeringar(personal_id=person_val["id"], projekt_id=proj["id"], fran_datum=dag, till_datum=dag)
-                                    nuv = bef[0]["timmar"] if bef else 0.0
-                                    with cols[i]:
-                                        ny = st.number_input(f"{VECKODAG_NAMN[dag.weekday()]} {dag.day}/{dag.month}",
-                                            value=float(nuv), min_value=0.0, max_value=12.0, step=0.5,
-                                            key=f"a_{person_val['id']}_{proj['id']}_{dag}")
-                                        if ny != nuv:
-                                            satt_allokering(person_val["id"], proj["id"], dag, ny)
-                            st.markdown("---")
+                        # Matris projekt x dag, redigeras som en tabell och sparas som en diff
+                        dag_kolumner = [f"{VECKODAG_NAMN[dag.weekday()]} {dag.day}/{dag.month}" for dag in arbetsdagar]
+                        kolumn_datum = dict(zip(dag_kolumner, arbetsdagar))
+                        projekt_per_namn = {proj["namn"]: proj for proj in projekt}
+                        matris = pd.DataFrame(0.0, index=list(projekt_per_namn), columns=dag_kolumner)
+                        datum_kolumn = {str(dag): kol for kol, dag in kolumn_datum.items()}
+                        for a in allok_period:
+                            if a["projekt_namn"] in projekt_per_namn and a["datum"] in datum_kolumn:
+                                matris.at[a["projekt_namn"], datum_kolumn[a["datum"]]] = float(a["timmar"])
+
+                        redigerad = st.data_editor(
+                            matris, use_container_width=True,
+                            key=f"grid_{person_val['id']}_{allok_start}_{allok_slut}",
+                            column_config={kol: st.column_config.NumberColumn(
+                                kol, min_value=0.0, max_value=12.0, step=0.5, format="%.1f")
+                                for kol in dag_kolumner}
+                        )
+
+                        andringar = []
+                        redigerad = redigerad.fillna(0.0)
+                        for rad, kol in zip(*matris.ne(redigerad).to_numpy().nonzero()):
+                            proj_namn, kol_namn = matris.index[rad], matris.columns[kol]
+                            andringar.append((person_val["id"], projekt_per_namn[proj_namn]["id"],
+                                              kolumn_datum[kol_namn], float(redigerad.iat[rad, kol])))
+
+                        if st.button(f"Spara ändringar ({len(andringar)})", type="primary",
+                                     disabled=not andringar, key="spara_grid"):
+                            satt_allokeringar(andringar)
+                            st.success(f"Sparade {len(andringar)} ändringar.")
+                            st.rerun()
 
                     # TAB: KOPIERA VECKA
                     with tab_kopiera:
                         st.markdown("#### Kopiera vecka")
-                        st.caption("Kopiera alla allokeringar från en vecka till en annan.")
+                        st.caption("Kopiera eller upprepa ett antal veckors allokeringar för en eller flera medarbetare.")
 
                         with st.form("kopiera_form"):
+                            kop_personer = st.multiselect("Medarbetare", personal, default=[person_val],
+                                format_func=lambda p: p["namn"], key="kop_personer")
                             c1, c2 = st.columns(2)
                             with c1:
                                 fran_mandag = st.date_input("Från vecka (måndag)",
                                     value=allok_start - timedelta(days=allok_start.weekday()), key="kop_fran")
+                                kop_veckor = st.number_input("Antal veckor att kopiera", value=1,
+                                    min_value=1, max_value=8, step=1, key="kop_veckor")
                             with c2:
                                 till_mandag = st.date_input("Till vecka (måndag)",
                                     value=allok_start - timedelta(days=allok_start.weekday()) + timedelta(days=7), key="kop_till")
-
-                            if st.form_submit_button("Kopiera vecka", type="primary"):
-                                antal = kopiera_vecka(person_val["id"], fran_mandag, till_mandag)
-                                st.success(f"Kopierade {antal} allokeringar!")
-                                st.rerun()
+                                kop_upprepa = st.number_input("Antal upprepningar", value=1,
+                                    min_value=1, max_value=52, step=1, key="kop_upprepa")
+                            c1, c2 = st.columns(2)
+                            with c1: kop_hoppa_helg = st.checkbox("Hoppa över röda dagar", value=True, key="kop_helg")
+                            with c2: kop_hoppa_franv = st.checkbox("Hoppa över frånvaro", value=True, key="kop_franv")
+
+                            if st.form_submit_button("Kopiera", type="primary"):
+                                kop_slut = fran_mandag + timedelta(days=int(kop_veckor) * 7 - 3)  # Fredag sista veckan
+                                mal_starter = [till_mandag + timedelta(days=int(kop_veckor) * 7 * k)
+                                               for k in range(int(kop_upprepa))]
+                                hoppa = []
+                                if kop_hoppa_helg:
+                                    mal_slut = mal_starter[-1] + (kop_slut - fran_mandag)
+                                    hoppa = [d for d in hamta_svenska_helgdagar(till_mandag.year, mal_slut.year)
+                                             if till_mandag <= d <= mal_slut]
+                                try:
+                                    antal = kopiera_allokeringar([p["id"] for p in kop_personer], fran_mandag,
+                                        kop_slut, mal_starter, hoppa_over_datum=hoppa,
+                                        hoppa_over_franvaro=kop_hoppa_franv)
+                                    st.success(f"Kopierade {antal} allokeringar!")
+                                    st.rerun()
+                                except ValueError as e:
+                                    st.error(str(e))
 
                     # TAB: KOMMENTARER
                     with tab_kommentar:
@@ -612,9 +750,7 @@ elif sida == "Allokering":
                     total_allokerat = 0
                     per_projekt = {}
                     for proj in projekt:
-                        allok = hamta_allokeringar(personal_id=person_val["id"], projekt_id=proj["id"],
-                                                    fran_datum=allok_start, till_datum=allok_slut)
-                        pt = sum(a["timmar"] for a in allok)
+                        pt = sum(a["timmar"] for a in allok_period if a["projekt_id"] == proj["id"])
                         if pt > 0: per_projekt[proj["namn"]] = pt
                         total_allokerat += pt
                     total_kap = len(arbetsdagar) * person_val["kapacitet_h"]
@@ -634,9 +770,13 @@ elif sida == "Allokering":
 # ============================================================
 
 elif sida == "Frånvaro":
+    from charts import skapa_franvaro_oversikt
+
     page_header("Frånvaro", "Registrera semester, sjukdom, VAB och annan frånvaro")
 
+    profil_del("data")
     personal = hamta_all_personal()
+    profil_del("rendering")
     if not personal:
         st.warning("Lägg till personal först.")
     else:
@@ -678,7 +818,9 @@ elif sida == "Frånvaro":
 
         # Visa frånvaro
         st.markdown("### Kommande frånvaro (30 dagar)")
+        profil_del("data")
         kommande = hamta_franvaro(fran_datum=date.today(), till_datum=date.today() + timedelta(days=30))
+        profil_del("rendering")
         if kommande:
             for f in kommande:
                 info = FRANVARO_TYPER.get(f["typ"], FRANVARO_TYPER["ovrigt"])
@@ -693,7 +835,9 @@ elif sida == "Frånvaro":
         # Frånvarodiagram
         st.markdown("---")
         st.markdown("### Frånvaroöversikt (3 månader)")
+        profil_del("diagram")
         fv_chart = skapa_franvaro_oversikt(date.today(), date.today() + timedelta(days=90))
+        profil_del("rendering")
         if fv_chart:
             fv_chart.update_layout(paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)',
                                    font=dict(family="Inter", size=12), title=None)
@@ -705,14 +849,18 @@ elif sida == "Frånvaro":
 # ============================================================
 
 elif sida == "Teamöversikt":
+    from charts import skapa_gantt_oversikt
+
     page_header("Teamöversikt", "Se hela teamet på en tidslinje — vem gör vad?")
 
     c1, c2 = st.columns(2)
     with c1: to_start = st.date_input("Från", value=date.today(), key="to_fran")
     with c2: to_slut = st.date_input("Till", value=date.today() + timedelta(days=13), key="to_till")
 
+    profil_del("data")
     arbetsdagar = hamta_arbetsdagar(to_start, to_slut)
     personal = hamta_all_personal()
+    profil_del("rendering")
 
     if not personal:
         st.info("Lägg till personal först.")
@@ -721,7 +869,9 @@ elif sida == "Teamöversikt":
     else:
         # Gantt-diagram
         st.markdown("### Tidslinje")
+        profil_del("diagram")
         gantt = skapa_gantt_oversikt(to_start, to_slut, arbetsdagar)
+        profil_del("rendering")
         if gantt:
             gantt.update_layout(paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)',
                                font=dict(family="Inter", size=12))
@@ -731,7 +881,9 @@ elif sida == "Teamöversikt":
 
         # Tabell: vem gör vad
         st.markdown("### Detaljerad översikt")
+        profil_del("data")
         oversikt = hamta_teamoversikt(to_start, to_slut, arbetsdagar)
+        profil_del("rendering")
 
         for pid, pdata in oversikt.items():
             with st.expander(f"{pdata['namn']} — {pdata['roll']}"):
@@ -753,14 +905,16 @@ elif sida == "Teamöversikt":
                             rows.append({"Datum": dag_str, "Veckodag": VECKODAG_NAMN[dag.weekday()],
                                         "Status": "Ledig", "Timmar": "0h"})
                 if rows:
-                    st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+                    st.dataframe(rows, use_container_width=True, hide_index=True)
 
         st.markdown("---")
 
         # Lediga resurser per dag
         st.markdown("### Lediga resurser")
         vald_dag = st.date_input("Välj dag", value=date.today(), key="ledig_dag")
+        profil_del("data")
         lediga = hamta_lediga_resurser(vald_dag)
+        profil_del("rendering")
         if lediga:
             for l in lediga:
                 pct = (l["ledigt"] / l["kapacitet_h"]) * 100
@@ -775,6 +929,11 @@ elif sida == "Teamöversikt":
 # ============================================================
 
 elif sida == "Dashboard":
+    from charts import (
+        skapa_belaggnings_heatmap, skapa_team_belaggning_stapel,
+        skapa_person_belaggning_pie, skapa_kapacitetsvarningar
+    )
+
     page_header("Dashboard", "Beläggningsanalys och teamöversikt")
 
     c1, c2 = st.columns(2)
@@ -784,13 +943,17 @@ elif sida == "Dashboard":
     if ds >= de:
         st.error("Startdatum måste vara före slutdatum.")
     else:
+        profil_del("data")
         personal = hamta_all_personal()
+        profil_del("rendering")
         if not personal:
             st.info("Lägg till personal först.")
         else:
             st.markdown("---")
             st.markdown("### Beläggning per person och vecka")
+            profil_del("diagram")
             hm = skapa_belaggnings_heatmap(ds, de)
+            profil_del("rendering")
             if hm:
                 hm.update_layout(paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)',
                     font=dict(family="Inter", size=12), title=None, margin=dict(l=120, t=20))
@@ -799,7 +962,9 @@ elif sida == "Dashboard":
 
             st.markdown("---")
             st.markdown("### Team-allokering per vecka")
+            profil_del("diagram")
             sb = skapa_team_belaggning_stapel(ds, de)
+            profil_del("rendering")
             if sb:
                 sb.update_layout(paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)',
                     font=dict(family="Inter", size=12), title=None, margin=dict(t=20))
@@ -811,7 +976,9 @@ elif sida == "Dashboard":
             vp = st.selectbox("Välj medarbetare", personal,
                 format_func=lambda p: f"{p['namn']} ({p['roll']})", key="dp")
             if vp:
+                profil_del("diagram")
                 pie = skapa_person_belaggning_pie(vp["id"], ds, de)
+                profil_del("rendering")
                 if pie:
                     pie.update_layout(paper_bgcolor='rgba(0,0,0,0)', font=dict(family="Inter", size=12), title=None)
                     st.plotly_chart(pie, use_container_width=True)
@@ -819,7 +986,9 @@ elif sida == "Dashboard":
 
             st.markdown("---")
             st.markdown("### Kapacitetsvarningar")
+            profil_del("diagram")
             varn = skapa_kapacitetsvarningar(ds, de)
+            profil_del("rendering")
             if varn.empty:
                 st.markdown('<div class="alert-success">&#9989; Inga varningar!</div>', unsafe_allow_html=True)
             else:
@@ -834,7 +1003,13 @@ elif sida == "Dashboard":
 # ============================================================
 
 elif sida == "Export":
-    page_header("Export", "Exportera data till CSV och PDF")
+    from export_utils import (
+        exportera_allokeringar_csv, exportera_personal_csv,
+        exportera_belaggningsrapport_csv, generera_pdf_rapport,
+        exportera_parquet, importera_parquet
+    )
+
+    page_header("Export", "Exportera data till CSV och PDF, importera från Excel/CSV")
 
     c1, c2 = st.columns(2)
     with c1: es = st.date_input("Från", value=date.today().replace(day=1), key="ef")
@@ -844,17 +1019,97 @@ elif sida == "Export":
     c1, c2 = st.columns(2)
     with c1:
         st.markdown("### CSV-exporter")
-        st.download_button("&#128196; Allokeringar", exportera_allokeringar_csv(es, ee),
-            file_name=f"allokeringar_{es}_{ee}.csv", mime="text/csv", use_container_width=True)
-        st.download_button("&#128101; Personal", exportera_personal_csv(),
-            file_name="personalregister.csv", mime="text/csv", use_container_width=True)
-        st.download_button("&#128202; Beläggning", exportera_belaggningsrapport_csv(es, ee),
-            file_name=f"belaggning_{es}_{ee}.csv", mime="text/csv", use_container_width=True)
+        export_knapp("allokeringar", "&#128196; Allokeringar", lambda: exportera_allokeringar_csv(es, ee),
+            f"allokeringar_{es}_{ee}.csv", "text/csv")
+        export_knapp("personal", "&#128101; Personal", exportera_personal_csv,
+            "personalregister.csv", "text/csv")
+        export_knapp("belaggning", "&#128202; Beläggning", lambda: exportera_belaggningsrapport_csv(es, ee),
+            f"belaggning_{es}_{ee}.csv", "text/csv")
     with c2:
         st.markdown("### PDF-rapport")
-        try:
-            pdf = generera_pdf_rapport(es, ee)
-            st.download_button("&#128209; Ladda ner PDF", pdf,
-                file_name=f"rapport_{es}_{ee}.pdf", mime="application/pdf", use_container_width=True)
-        except Exception as e:
-            st.error(f"PDF-fel: {e}")
+        export_knapp("pdf", "&#128209; Beläggningsrapport", lambda: generera_pdf_rapport(es, ee),
+            f"rapport_{es}_{ee}.pdf", "application/pdf")
+
+    st.markdown("---")
+    with st.expander("Fullständig dump (Parquet)", expanded=False):
+        st.caption("Alla tabeller med typade kolumner, för flytt mellan databaser eller BI-verktyg.")
+        export_knapp("parquet", "&#128230; Parquet-dump", exportera_parquet,
+            f"teammanager_{date.today()}.zip", "application/zip")
+        dumpfil = st.file_uploader("Återställ från dump", type=["zip"], key="dump_fil")
+        if dumpfil is not None:
+            st.warning("Återställningen ersätter ALL data i databasen med dumpens innehåll.")
+            if st.button("Återställ", key="dump_aterstall", type="primary"):
+                try:
+                    antal = importera_parquet(dumpfil.getvalue())
+                    st.success(f"Återställde {sum(antal.values())} rader i {len(antal)} tabeller")
+                    st.rerun()
+                except ValueError as e:
+                    st.error(str(e))
+
+    with st.expander("Import från Excel/CSV", expanded=False):
+        st.caption("Långt format med samma kolumner som CSV-exporten, eller brett format med en "
+                   "kolumn per datum. Giltiga rader importeras; fel och varningar listas per rad.")
+        import_typ = st.selectbox("Importera", ["Allokeringar", "Frånvaro", "Personal"], key="import_typ")
+        importfil = st.file_uploader("Fil", type=["csv", "xlsx"], key="import_fil")
+        if importfil is not None and st.button("Importera", key="import_knapp", type="primary"):
+            from import_utils import importera_allokeringar, importera_franvaro, importera_personal
+            importera = {"Allokeringar": importera_allokeringar, "Frånvaro": importera_franvaro,
+                         "Personal": importera_personal}[import_typ]
+            try:
+                importrapport = importera(importfil, importfil.name)
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                st.success(f"Importerade {importrapport['importerade']} poster")
+                if importrapport["antal_fel"]:
+                    st.error(f"{importrapport['antal_fel']} rader kunde inte importeras")
+                    st.dataframe(importrapport["fel"], use_container_width=True, hide_index=True)
+                if importrapport["antal_varningar"]:
+                    st.warning(f"{importrapport['antal_varningar']} varningar")
+                    st.dataframe(importrapport["varningar"], use_container_width=True, hide_index=True)
+
+    with st.expander("Arkivering av gammal data", expanded=False):
+        arkiv = hamta_arkivstatus()
+        st.caption(f"Arkivet har {arkiv['allokering']} allokeringsdagar och {arkiv['franvaro']} frånvarodagar"
+                   + (f" t.o.m. {arkiv['sista_datum']}" if arkiv["sista_datum"] else "")
+                   + ". Arkiverad data visas och exporteras som vanligt men hålls utanför de aktiva tabellerna.")
+        with st.form("arkiv_form"):
+            arkiv_grans = st.date_input("Arkivera allt före",
+                value=date(date.today().year - ARKIV_AR, 1, 1), key="arkiv_grans")
+            if st.form_submit_button("Arkivera"):
+                resultat = arkivera(arkiv_grans)
+                st.success(f"Arkiverade {resultat['allokering']} allokeringsdagar och "
+                           f"{resultat['franvaro']} frånvarodagar")
+                st.rerun()
+
+
+# ============================================================
+# FRÅGELOGG OCH PROFILERING (debugpaneler i sidofältet)
+# ============================================================
+
+profil_steg("avslut")
+if fragelogg_pa:
+    rapport = avsluta_insamling(sida)
+    logga_rapport(rapport)
+    with st.sidebar.expander(f"&#128269; Frågelogg: {rapport['fragor']} frågor, {rapport['tid_ms']:.0f} ms",
+                             expanded=bool(rapport["n_plus_1"])):
+        if rapport["n_plus_1"]:
+            st.warning(f"{len(rapport['n_plus_1'])} N+1-mönster: samma sats med olika parametrar")
+        st.dataframe([{
+            "N+1": "⚠️" if sats["n_plus_1"] else "",
+            "Antal": sats["antal"],
+            "Olika param.": sats["olika_parametrar"],
+            "ms": sats["tid_ms"],
+            "Rader": sats["rader"],
+            "Sats": sats["sql"],
+            "Anropare": ", ".join(sats["anropare"]),
+        } for sats in rapport["satser"]], hide_index=True, use_container_width=True)
+
+profil = avsluta_profilering(sida)
+if profil:
+    with st.sidebar.expander(f"&#9201;&#65039; Profilering ({profil['lage']}): {profil['total_ms']:.0f} ms"):
+        st.dataframe(profil["delar"], hide_index=True, use_container_width=True)
+        if "kategorier" in profil:
+            st.caption(f"{profil['sampel']} sampel: " + ", ".join(
+                f"{kategori} {andel:.0%}" for kategori, andel in profil["kategorier"].items()))
+        st.caption("Skrivet: " + ", ".join(os.path.basename(f) for f in profil["filer"]))
@@ -0,0 +1,15 @@
+"""
+benchmark - Prestandamätning för Teammanager
+datagenerator: deterministiska syntetiska data (personal, projekt, dagliga
+allokeringar, frånvaro, kommentarer) skrivna via database.py.
+korning: tidtar hamta_*-funktioner, diagram och exporter över en matris av
+datastorlekar mot SQLite och PostgreSQL och skriver JSON som kan jämföras;
+mäter även kallstartens importtider.
+
+Körs från repots rot:
+    python -m benchmark kor --ut fore.json
+    python -m benchmark kor --backend sqlite postgres --pg-url postgresql://... --ut efter.json
+    python -m benchmark importer --ut import.json
+    python -m benchmark jamfor fore.json efter.json
+    python -m benchmark generera --databas demo.db --personer 25 --ar 2
+"""
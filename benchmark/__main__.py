@@ -0,0 +1,115 @@
+"""
+Kommandorad för benchmark-paketet: python -m benchmark {kor,importer,jamfor,generera}.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from benchmark.korning import (
+    STORLEKAR, formatera_jamforelse, formatera_resultat, jamfor, kor_arbetare, kor_importer,
+    kor_matris
+)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="Prestandamätning för Teammanager")
+    kommandon = parser.add_subparsers(dest="kommando", required=True)
+
+    kor = kommandon.add_parser("kor", help="kör benchmarkmatrisen och skriv JSON")
+    kor.add_argument("--backend", nargs="+", choices=["sqlite", "postgres"],
+                     help="standard: sqlite, plus postgres om --pg-url/BENCHMARK_PG_URL finns")
+    kor.add_argument("--storlek", nargs="+", choices=list(STORLEKAR), default=["liten", "mellan"])
+    kor.add_argument("--upprepningar", type=int, default=5)
+    kor.add_argument("--pg-url", default=os.environ.get("BENCHMARK_PG_URL", ""),
+                     help="PostgreSQL att mäta mot (ett eget schema skapas och tas bort)")
+    kor.add_argument("--motor", action="store_true", help="mät med allokeringsmotorn aktiverad")
+    kor.add_argument("--importer", action="store_true", help="mät även kallstartens importtider")
+    kor.add_argument("--ut", help="fil att skriva JSON-resultatet till")
+
+    imp = kommandon.add_parser("importer", help="mät bara importtider (kallstart)")
+    imp.add_argument("--upprepningar", type=int, default=5)
+    imp.add_argument("--ut", help="fil att skriva JSON-resultatet till")
+
+    jmf = kommandon.add_parser("jamfor", help="jämför två JSON-resultat")
+    jmf.add_argument("bas")
+    jmf.add_argument("ny")
+    jmf.add_argument("--troskel", type=float, default=1.2,
+                     help="kvot ny/bas som räknas som långsammare (standard 1.2)")
+    jmf.add_argument("--min-skillnad-ms", type=float, default=1.0,
+                     help="mindre skillnader räknas som brus (standard 1.0)")
+
+    gen = kommandon.add_parser("generera", help="fyll en SQLite-fil med syntetiska data")
+    gen.add_argument("--databas", required=True)
+    gen.add_argument("--personer", type=int, default=20)
+    gen.add_argument("--projekt", type=int, default=6)
+    gen.add_argument("--ar", type=int, default=1)
+    gen.add_argument("--franvaro", type=float, default=0.06, help="andel arbetsdagar med frånvaro")
+    gen.add_argument("--kommentarer", type=float, default=0.02, help="andel arbetsdagar med kommentar")
+    gen.add_argument("--fro", type=int, default=42)
+
+    # Intern: en mätning i egen process, startas av kor
+    arb = kommandon.add_parser("arbetare")
+    arb.add_argument("--backend", required=True)
+    arb.add_argument("--storlek", required=True)
+    arb.add_argument("--upprepningar", type=int, required=True)
+    arb.add_argument("--ut", required=True)
+
+    args = parser.parse_args(argv)
+
+    if args.kommando == "kor":
+        backends = args.backend or (["sqlite", "postgres"] if args.pg_url else ["sqlite"])
+        samlat = kor_matris(backends, args.storlek, args.upprepningar, args.pg_url, args.motor,
+                            args.importer)
+        print(formatera_resultat(samlat))
+        if args.ut:
+            with open(args.ut, "w", encoding="utf-8") as f:
+                json.dump(samlat, f, ensure_ascii=False, indent=2)
+        return 0
+
+    if args.kommando == "importer":
+        samlat = kor_importer(args.upprepningar)
+        print(formatera_resultat(samlat))
+        if args.ut:
+            with open(args.ut, "w", encoding="utf-8") as f:
+                json.dump(samlat, f, ensure_ascii=False, indent=2)
+        return 0
+
+    if args.kommando == "jamfor":
+        with open(args.bas, encoding="utf-8") as f:
+            bas = json.load(f)
+        with open(args.ny, encoding="utf-8") as f:
+            ny = json.load(f)
+        for nyckel in ("upprepningar", "motor", "period_dagar"):
+            if bas["meta"].get(nyckel) != ny["meta"].get(nyckel):
+                print(f"Obs: {nyckel} skiljer sig ({bas['meta'].get(nyckel)} / {ny['meta'].get(nyckel)})",
+                      file=sys.stderr)
+        rader = jamfor(bas, ny, args.troskel, args.min_skillnad_ms)
+        print(formatera_jamforelse(rader))
+        # Avslutningskod 1 om något blivit långsammare, för användning i skript
+        return 1 if any(r["status"] == "långsammare" for r in rader) else 0
+
+    if args.kommando == "generera":
+        if os.path.exists(args.databas):
+            parser.error(f"{args.databas} finns redan; datageneratorn kräver en tom databas")
+        os.environ.pop("SUPABASE_DB_URL", None)
+        import database
+        if database._USE_POSTGRES:
+            parser.error("database.py är kopplad till PostgreSQL (st.secrets); generera skriver bara SQLite")
+        database.DB_PATH = os.path.abspath(args.databas)
+        from benchmark.datagenerator import generera
+        dataset = generera(args.personer, args.projekt, args.ar, franvaro_andel=args.franvaro,
+                           kommentar_andel=args.kommentarer, fro=args.fro)
+        print(f"{args.databas}: {len(dataset['personal_ids'])} personer, "
+              f"{len(dataset['projekt_ids'])} projekt, {dataset['allokeringar']} allokeringar, "
+              f"{dataset['franvarodagar']} frånvarodagar, {dataset['kommentarer']} kommentarer "
+              f"({dataset['fran']} – {dataset['till']})")
+        return 0
+
+    kor_arbetare(args.backend, args.storlek, args.upprepningar, args.ut)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
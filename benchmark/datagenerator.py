@@ -0,0 +1,144 @@
+"""
+datagenerator.py - Syntetiska testdata för Teammanagers benchmarks
+Fyller den databas som database.py är kopplad till med personal, projekt,
+dagliga allokeringar, frånvaro, kommentarer och kompetenser. Samma
+parametrar (inklusive fro) ger alltid samma data, oavsett databas.
+Allt skrivs via database.py:s publika funktioner, så triggers,
+ändringslogg och dagsbelastning fylls precis som i appen.
+"""
+
+import random
+from datetime import date, timedelta
+
+import database
+from calendar_utils import hamta_arbetsdagar
+
+ROLLER = ["Utvecklare", "Testare", "Arkitekt", "Projektledare", "UX", "Analytiker"]
+KOMPETENSER = ["Python", "SQL", "Java", "React", "Azure", "AWS", "Test",
+               "Scrum", "UX", "Säkerhet", "Data", "Drift"]
+KAPACITETER = [6.0, 7.5, 8.0, 8.0, 8.0]
+PROJEKT_FARGER = ["#3498db", "#e74c3c", "#2ecc71", "#9b59b6", "#f39c12",
+                  "#1abc9c", "#e67e22", "#34495e", "#16a085", "#c0392b"]
+
+# Frånvarotyper med relativ vikt och längd (arbetsdagar) per tillfälle
+FRANVARO_PROFIL = {
+    "semester": (5, 5, 15),
+    "sjuk": (3, 1, 4),
+    "vab": (2, 1, 3),
+    "utbildning": (1, 1, 3),
+    "tjanstledig": (0.5, 5, 10),
+    "ovrigt": (0.5, 1, 2),
+}
+# Andel av en persons arbetsdagar som är helt oallokerade respektive överbelagda
+OALLOKERAD_ANDEL = 0.08
+OVERBELAGD_ANDEL = 0.04
+
+
+def _slutdatum(start, ar):
+    """Sista dagen i en period på `ar` hela år från start."""
+    try:
+        return start.replace(year=start.year + ar) - timedelta(days=1)
+    except ValueError:  # 29 februari
+        return start.replace(year=start.year + ar, day=28)
+
+
+def _franvaro_for_person(rnd, arbetsdagar, franvaro_andel):
+    """{datum: typ} där ungefär franvaro_andel av arbetsdagarna är frånvaro,
+    i sammanhängande perioder enligt FRANVARO_PROFIL."""
+    typer = list(FRANVARO_PROFIL)
+    vikter = [FRANVARO_PROFIL[t][0] for t in typer]
+    medellangd = sum(v * (FRANVARO_PROFIL[t][1] + FRANVARO_PROFIL[t][2]) / 2
+                     for t, v in zip(typer, vikter)) / sum(vikter)
+    start_sannolikhet = franvaro_andel / medellangd
+
+    franvaro = {}
+    i = 0
+    while i < len(arbetsdagar):
+        if rnd.random() < start_sannolikhet:
+            typ = rnd.choices(typer, weights=vikter)[0]
+            langd = rnd.randint(FRANVARO_PROFIL[typ][1], FRANVARO_PROFIL[typ][2])
+            for dag in arbetsdagar[i:i + langd]:
+                franvaro[dag] = typ
+            i += langd
+        else:
+            i += 1
+    return franvaro
+
+
+def generera(personer=20, projekt=6, ar=1, start=date(2025, 1, 1),
+             franvaro_andel=0.06, kommentar_andel=0.02, fro=42):
+    """
+    Fyll databasen med syntetiska data. Databasen bör vara tom (namn på
+    personal och projekt är unika).
+
+    personer, projekt: antal att skapa.
+    ar: antal år med dagliga allokeringar från och med start.
+    franvaro_andel: ungefärlig andel arbetsdagar med frånvaro per person.
+    kommentar_andel: andel arbetsdagar per person som får en kommentar.
+    fro: slumpfrö; samma parametrar ger samma data.
+
+    Returnerar dict med fran, till, personal_ids, projekt_ids och antal
+    skrivna allokeringar, frånvarodagar och kommentarer.
+    """
+    rnd = random.Random(fro)
+    database.init_db()
+    slut = _slutdatum(start, ar)
+    arbetsdagar = hamta_arbetsdagar(start, slut)
+
+    projekt_ids = []
+    for i in range(projekt):
+        # Projekten löper över olika delar av perioden
+        forsta = start + timedelta(days=rnd.randrange(0, max(1, (slut - start).days // 3)))
+        sista = slut - timedelta(days=rnd.randrange(0, max(1, (slut - start).days // 3)))
+        projekt_ids.append(database.lagg_till_projekt(
+            f"Projekt {i + 1:03d}", PROJEKT_FARGER[i % len(PROJEKT_FARGER)],
+            str(forsta), str(sista)))
+
+    personal_ids, kapacitet = [], {}
+    for i in range(personer):
+        kapacitet_h = rnd.choice(KAPACITETER)
+        pid = database.lagg_till_personal(f"Person {i + 1:04d}", rnd.choice(ROLLER), kapacitet_h)
+        personal_ids.append(pid)
+        kapacitet[pid] = kapacitet_h
+
+    antal_allokeringar = antal_franvaro = antal_kommentarer = 0
+    for pid in personal_ids:
+        database.satt_kompetenser(pid, rnd.sample(KOMPETENSER, rnd.randint(1, 4)))
+        egna_projekt = rnd.sample(projekt_ids, min(len(projekt_ids), rnd.randint(1, 3)))
+        franvaro = _franvaro_for_person(rnd, arbetsdagar, franvaro_andel)
+
+        poster = []
+        for dag in arbetsdagar:
+            if dag in franvaro:
+                continue
+            slump = rnd.random()
+            if slump < OALLOKERAD_ANDEL:
+                continue
+            fyllnad = 1.25 if slump > 1 - OVERBELAGD_ANDEL else rnd.choice([0.5, 0.75, 1.0, 1.0])
+            valda = rnd.sample(egna_projekt, rnd.randint(1, len(egna_projekt)))
+            # Halvtimmar, fördelat jämnt mellan dagens projekt
+            per_projekt = max(0.5, round(kapacitet[pid] * fyllnad / len(valda) * 2) / 2)
+            poster.extend((pid, prid, dag, per_projekt) for prid in valda)
+        antal_allokeringar += database.satt_allokeringar(poster)
+
+        per_typ = {}
+        for dag, typ in franvaro.items():
+            per_typ.setdefault(typ, []).append(dag)
+        for typ, dagar in sorted(per_typ.items()):
+            database.bulk_franvaro(pid, dagar, typ)
+        antal_franvaro += len(franvaro)
+
+        for dag in arbetsdagar:
+            if rnd.random() < kommentar_andel:
+                database.satt_kommentar(pid, dag, f"Anteckning {rnd.randint(1, 999)}")
+                antal_kommentarer += 1
+
+    return {
+        "fran": start,
+        "till": slut,
+        "personal_ids": personal_ids,
+        "projekt_ids": projekt_ids,
+        "allokeringar": antal_allokeringar,
+        "franvarodagar": antal_franvaro,
+        "kommentarer": antal_kommentarer,
+    }
@@ -0,0 +1,446 @@
+"""
+korning.py - Benchmarkkörning för Teammanager
+Tidtar varje publik hamta_*-funktion, varje diagram i charts.py och varje
+export i export_utils.py över en matris av datastorlekar och databaser.
+
+Databasen väljs i database.py när modulen importeras, så varje kombination
+av databas och storlek körs i en egen underprocess (arbetare) med rätt
+miljö. Arbetaren fyller en tom databas med datageneratorn, mäter och
+skriver sitt resultat som JSON; huvudprocessen samlar ihop allt till en fil
+som kan jämföras med en tidigare körning (jamfor).
+
+PostgreSQL-körningar sker i ett eget schema (BENCHMARK_SCHEMA) som skapas
+och tas bort av arbetaren, så befintliga tabeller i databasen rörs inte.
+"""
+
+import importlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+REPO_ROT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_SCHEMA = "tm_benchmark"
+
+# Storleksmatrisen: parametrar till datagenerator.generera
+STORLEKAR = {
+    "liten": {"personer": 10, "projekt": 4, "ar": 1},
+    "mellan": {"personer": 30, "projekt": 8, "ar": 2},
+    "stor": {"personer": 60, "projekt": 12, "ar": 3},
+}
+DATA_START = date(2025, 1, 1)
+# Längd på perioden som dashboardfunktionerna frågar om (sista dagarna i datat)
+PERIOD_DAGAR = 91
+
+
+# ============================================================
+# MÄTPUNKTER
+# ============================================================
+# (kategori, modul, funktion, argument) där argument tar mätkontexten
+# och returnerar (args, kwargs). Kontexten byggs av _matkontext.
+
+def _period(k):
+    return (k["fran"], k["till"]), {}
+
+
+def _period_dagar(k):
+    return (k["fran"], k["till"], k["arbetsdagar"]), {}
+
+
+MATPUNKTER = [
+    ("databas", "database", "hamta_schemaversion", lambda k: ((), {})),
+    ("databas", "database", "hamta_generation", lambda k: ((), {})),
+    ("databas", "database", "hamta_synkhorisont", lambda k: ((), {})),
+    ("databas", "database", "hamta_andringar_sedan", lambda k: ((max(0, k["generation"] - 1000),), {})),
+    ("databas", "database", "hamta_all_personal", lambda k: ((), {})),
+    ("databas", "database", "hamta_alla_projekt", lambda k: ((), {})),
+    ("databas", "database", "hamta_allokeringar", lambda k: ((), {"fran_datum": k["fran"], "till_datum": k["till"]})),
+    ("databas", "database", "hamta_allokeringsperioder", lambda k: ((), {"fran_datum": k["fran"], "till_datum": k["till"]})),
+    ("databas", "database", "hamta_allokeringsdagar", lambda k: ((k["nycklar"],), {})),
+    ("databas", "database", "hamta_allokeringsregler", lambda k: ((), {"fran_datum": k["fran"], "till_datum": k["till"]})),
+    ("databas", "database", "hamta_arkivstatus", lambda k: ((), {})),
+    ("databas", "database", "hamta_dagsbelastning", lambda k: ((k["person"], k["datum"]), {})),
+    ("databas", "database", "hamta_dagsbelastningar",
+     lambda k: (([(p, d) for p, _, d in k["nycklar"]],), {})),
+    ("databas", "database", "hamta_kompetenser", lambda k: ((k["person"],), {})),
+    ("databas", "database", "hamta_alla_kompetenser", lambda k: ((), {})),
+    ("databas", "database", "hamta_franvaro", lambda k: ((), {"fran_datum": k["fran"], "till_datum": k["till"]})),
+    ("databas", "database", "hamta_kommentar", lambda k: ((k["person"], k["datum"]), {})),
+    ("databas", "database", "hamta_kommentarer_period", lambda k: ((k["person"], k["fran"], k["till"]), {})),
+    ("databas", "database", "hamta_overbelagda", _period),
+    ("databas", "database", "hamta_timmar_per_person", _period),
+    ("databas", "database", "hamta_oallokerade", _period_dagar),
+    ("databas", "database", "hamta_lediga_resurser", lambda k: ((k["datum"],), {})),
+    ("databas", "database", "hamta_lediga_resurser_period", lambda k: ((k["arbetsdagar"],), {})),
+    ("databas", "database", "hamta_teamoversikt", _period_dagar),
+    ("diagram", "charts", "skapa_belaggnings_heatmap", _period),
+    ("diagram", "charts", "skapa_team_belaggning_stapel", _period),
+    ("diagram", "charts", "skapa_person_belaggning_pie", lambda k: ((k["person"], k["fran"], k["till"]), {})),
+    ("diagram", "charts", "skapa_kapacitetsvarningar", _period),
+    ("diagram", "charts", "skapa_gantt_oversikt", _period_dagar),
+    ("diagram", "charts", "skapa_franvaro_oversikt", _period),
+    ("export", "export_utils", "stromma_allokeringar_csv", lambda k: ((k["ar_fran"], k["till"]), {})),
+    ("export", "export_utils", "exportera_allokeringar_csv", lambda k: ((k["ar_fran"], k["till"]), {})),
+    ("export", "export_utils", "exportera_personal_csv", lambda k: ((), {})),
+    ("export", "export_utils", "exportera_belaggningsrapport_csv", _period),
+    ("export", "export_utils", "generera_pdf_rapport", _period),
+    ("export", "export_utils", "exportera_parquet", lambda k: ((), {})),
+]
+
+
+def _matkontext(dataset):
+    """Argumenten mätpunkterna använder, härledda ur det genererade datat."""
+    import database
+    from calendar_utils import hamta_arbetsdagar
+
+    till = dataset["till"]
+    fran = till - timedelta(days=PERIOD_DAGAR - 1)
+    arbetsdagar = hamta_arbetsdagar(fran, till)
+    # Nycklar som allokeringsmotorn slår upp efter en synk
+    nycklar = [(a["personal_id"], a["projekt_id"], a["datum"])
+               for a in database.hamta_allokeringar(fran_datum=fran, till_datum=till)[:200]]
+    return {
+        "fran": fran,
+        "till": till,
+        "ar_fran": max(dataset["fran"], till - timedelta(days=364)),
+        "arbetsdagar": arbetsdagar,
+        "datum": arbetsdagar[len(arbetsdagar) // 2],
+        "person": dataset["personal_ids"][0],
+        "generation": database.hamta_generation(),
+        "nycklar": nycklar,
+    }
+
+
+def _saknade_matpunkter():
+    """Publika hamta_*-funktioner i database.py som inte finns i MATPUNKTER."""
+    import database
+    matta = {namn for _, modul, namn, _ in MATPUNKTER if modul == "database"}
+    return sorted(namn for namn in dir(database)
+                  if namn.startswith("hamta_") and callable(getattr(database, namn))
+                  and namn not in matta)
+
+
+def _tidta(funk, args, kwargs, upprepningar, motor_aktiv):
+    """Kör funk upprepningar gånger med tömd läscache före varje körning
+    och returnera tiderna i millisekunder. En första, omätt körning tar
+    engångskostnader (importer, typsnitt i fpdf, arbetsdagsindex)."""
+    from cache_utils import rensa_cache
+    from allokeringsmotor import hamta_motor
+
+    def kor():
+        resultat = funk(*args, **kwargs)
+        if hasattr(resultat, "__next__"):
+            for _ in resultat:
+                pass
+
+    kor()
+    tider = []
+    for _ in range(upprepningar):
+        rensa_cache()
+        if motor_aktiv:
+            hamta_motor()  # motorn laddas utanför mätningen; den mäts som varm
+        start = time.perf_counter()
+        kor()
+        tider.append((time.perf_counter() - start) * 1000)
+    return tider
+
+
+# ============================================================
+# ARBETARE (en underprocess per databas och storlek)
+# ============================================================
+
+def _url_med_schema(url, schema):
+    """PostgreSQL-URL/DSN där search_path pekar på schemat."""
+    if "://" not in url:
+        return f"{url} options='-csearch_path={schema}'"
+    delar = urlsplit(url)
+    parametrar = [(k, v) for k, v in parse_qsl(delar.query, keep_blank_values=True) if k != "options"]
+    parametrar.append(("options", f"-csearch_path={schema}"))
+    return urlunsplit(delar._replace(query=urlencode(parametrar)))
+
+
+def _aterskapa_schema(url, schema, skapa=True):
+    """Ta bort schemat (och allt i det) och skapa det på nytt om skapa=True."""
+    import psycopg2
+    conn = psycopg2.connect(url)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+            if skapa:
+                cursor.execute(f"CREATE SCHEMA {schema}")
+    finally:
+        conn.close()
+
+
+def kor_arbetare(backend, storlek, upprepningar, ut):
+    """Generera data och mät alla mätpunkter för en databas och storlek.
+    Körs i en egen process; se kor_matris."""
+    sqlite_katalog = None
+    pg_url = os.environ.get("BENCHMARK_PG_URL", "")
+    if backend == "postgres":
+        _aterskapa_schema(pg_url, BENCHMARK_SCHEMA)
+        os.environ["SUPABASE_DB_URL"] = _url_med_schema(pg_url, BENCHMARK_SCHEMA)
+    else:
+        os.environ.pop("SUPABASE_DB_URL", None)
+
+    import database
+    # st.secrets går före miljön i database.py — mät aldrig mot fel databas
+    if database._USE_POSTGRES != (backend == "postgres") or (
+            backend == "postgres" and database._SUPABASE_DB_URL != os.environ["SUPABASE_DB_URL"]):
+        raise SystemExit(f"database.py valde inte {backend} (kontrollera .streamlit/secrets.toml)")
+    if backend == "sqlite":
+        sqlite_katalog = tempfile.mkdtemp(prefix="tm_benchmark_")
+        database.DB_PATH = os.path.join(sqlite_katalog, "benchmark.db")
+
+    from benchmark.datagenerator import generera
+    try:
+        start = time.perf_counter()
+        dataset = generera(start=DATA_START, **STORLEKAR[storlek])
+        generering_s = time.perf_counter() - start
+        kontext = _matkontext(dataset)
+
+        from allokeringsmotor import MOTOR_AKTIV
+        matningar = []
+        for kategori, modulnamn, namn, argument in MATPUNKTER:
+            funk = getattr(importlib.import_module(modulnamn), namn)
+            args, kwargs = argument(kontext)
+            post = {"backend": backend, "storlek": storlek, "kategori": kategori,
+                    "namn": namn, "upprepningar": upprepningar}
+            try:
+                tider = _tidta(funk, args, kwargs, upprepningar, MOTOR_AKTIV)
+                post.update(median_ms=round(statistics.median(tider), 3),
+                            min_ms=round(min(tider), 3), max_ms=round(max(tider), 3))
+            except Exception as e:
+                post["fel"] = f"{type(e).__name__}: {e}"
+            matningar.append(post)
+
+        resultat = {
+            "dataset": {
+                "backend": backend, "storlek": storlek, **STORLEKAR[storlek],
+                "allokeringar": dataset["allokeringar"],
+                "franvarodagar": dataset["franvarodagar"],
+                "kommentarer": dataset["kommentarer"],
+                "generering_s": round(generering_s, 3),
+            },
+            "resultat": matningar,
+            "saknade": _saknade_matpunkter(),
+        }
+        with open(ut, "w", encoding="utf-8") as f:
+            json.dump(resultat, f)
+    finally:
+        database.stang_anslutningar()
+        if backend == "postgres":
+            _aterskapa_schema(pg_url, BENCHMARK_SCHEMA, skapa=False)
+        if sqlite_katalog:
+            for namn in os.listdir(sqlite_katalog):
+                os.remove(os.path.join(sqlite_katalog, namn))
+            os.rmdir(sqlite_katalog)
+
+
+# ============================================================
+# IMPORTTIDER (kallstart)
+# ============================================================
+# Moduler som mäts var för sig; "app.py (toppnivå)" är allt som app.py
+# importerar innan första sidan ritas och läses ur app.py med ast.
+IMPORTMODULER = ["streamlit", "pandas", "plotly.graph_objects", "database",
+                 "calendar_utils", "charts", "export_utils"]
+
+
+def _appens_toppimporter():
+    """Modulerna som app.py importerar på toppnivå (inte inne i sidorna)."""
+    import ast
+    with open(os.path.join(REPO_ROT, "app.py"), encoding="utf-8") as f:
+        trad = ast.parse(f.read())
+    moduler = []
+    for nod in trad.body:
+        if isinstance(nod, ast.Import):
+            moduler.extend(alias.name for alias in nod.names)
+        elif isinstance(nod, ast.ImportFrom) and nod.module:
+            moduler.append(nod.module)
+    return list(dict.fromkeys(moduler))
+
+
+def _importtid_ms(moduler):
+    """Tid för att importera modulerna i en ny Python-process (ms)."""
+    kod = ("import importlib, time\n"
+           "start = time.perf_counter()\n"
+           f"for m in {moduler!r}:\n"
+           "    importlib.import_module(m)\n"
+           "print((time.perf_counter() - start) * 1000)\n")
+    env = dict(os.environ)
+    env.pop("SUPABASE_DB_URL", None)  # import ska inte ansluta, men håll körningen lokal
+    ut = subprocess.run([sys.executable, "-c", kod], cwd=REPO_ROT, env=env,
+                        capture_output=True, text=True, check=True).stdout
+    return float(ut.strip().splitlines()[-1])
+
+
+def mat_importtider(upprepningar=5):
+    """Kallstartstider: varje modul i IMPORTMODULER och app.py:s toppnivå,
+    importerade i nya processer. Poster i samma format som arbetarens
+    (databas "python", storlek "-") så att jamfor fungerar även på dem."""
+    matningar = [("app.py (toppnivå)", _appens_toppimporter())]
+    matningar += [(f"import {m}", [m]) for m in IMPORTMODULER]
+    resultat = []
+    for namn, moduler in matningar:
+        post = {"backend": "python", "storlek": "-", "kategori": "import",
+                "namn": namn, "upprepningar": upprepningar}
+        try:
+            _importtid_ms(moduler)  # första körningen värmer filsystemets cache
+            tider = [_importtid_ms(moduler) for _ in range(upprepningar)]
+            post.update(median_ms=round(statistics.median(tider), 3),
+                        min_ms=round(min(tider), 3), max_ms=round(max(tider), 3))
+        except (subprocess.CalledProcessError, ValueError) as e:
+            post["fel"] = f"{type(e).__name__}: {e}"
+        resultat.append(post)
+    return resultat
+
+
+# ============================================================
+# MATRIS OCH JÄMFÖRELSE
+# ============================================================
+
+def _git_version():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def kor_matris(backends=("sqlite",), storlekar=("liten", "mellan"), upprepningar=5,
+               pg_url="", motor=False, importer=False):
+    """
+    Kör en arbetare per (databas, storlek) och samla resultaten.
+    Returnerar dict med meta, dataset (en post per körning) och resultat
+    (en post per mätpunkt med median_ms, min_ms och max_ms, eller fel).
+    importer=True lägger till kallstartstiderna från mat_importtider.
+    """
+    if "postgres" in backends and not pg_url:
+        raise ValueError("PostgreSQL kräver pg_url (eller BENCHMARK_PG_URL)")
+    env = dict(os.environ)
+    env["BENCHMARK_PG_URL"] = pg_url
+    env["TEAMMANAGER_ALLOKERINGSMOTOR"] = "1" if motor else ""
+
+    samlat = {
+        "meta": {
+            "tidpunkt": datetime.now().isoformat(timespec="seconds"),
+            "git": _git_version(),
+            "python": platform.python_version(),
+            "plattform": platform.platform(),
+            "upprepningar": upprepningar,
+            "motor": motor,
+            "period_dagar": PERIOD_DAGAR,
+        },
+        "dataset": [],
+        "resultat": [],
+    }
+    saknade = set()
+    for backend in backends:
+        for storlek in storlekar:
+            print(f"{backend}/{storlek} ...", file=sys.stderr, flush=True)
+            fd, ut = tempfile.mkstemp(suffix=".json")
+            os.close(fd)
+            try:
+                subprocess.run(
+                    [sys.executable, "-m", "benchmark", "arbetare", "--backend", backend,
+                     "--storlek", storlek, "--upprepningar", str(upprepningar), "--ut", ut],
+                    cwd=REPO_ROT, env=env, check=True)
+                with open(ut, encoding="utf-8") as f:
+                    del_resultat = json.load(f)
+            finally:
+                os.remove(ut)
+            samlat["dataset"].append(del_resultat["dataset"])
+            samlat["resultat"].extend(del_resultat["resultat"])
+            saknade.update(del_resultat["saknade"])
+    if importer:
+        print("importtider ...", file=sys.stderr, flush=True)
+        samlat["resultat"].extend(mat_importtider(upprepningar))
+    if saknade:
+        print("Varning: hamta_*-funktioner utan mätpunkt: " + ", ".join(sorted(saknade)),
+              file=sys.stderr)
+    return samlat
+
+
+def kor_importer(upprepningar=5):
+    """Bara kallstartstiderna, i samma format som kor_matris."""
+    return {
+        "meta": {
+            "tidpunkt": datetime.now().isoformat(timespec="seconds"),
+            "git": _git_version(),
+            "python": platform.python_version(),
+            "plattform": platform.platform(),
+            "upprepningar": upprepningar,
+        },
+        "dataset": [],
+        "resultat": mat_importtider(upprepningar),
+    }
+
+
+def jamfor(bas, ny, troskel=1.2, min_skillnad_ms=1.0):
+    """
+    Jämför två resultat från kor_matris per (databas, storlek, funktion).
+    Returnerar list[dict] med bas_ms, ny_ms, kvot (ny/bas) och status:
+    "långsammare" om kvot > troskel, "snabbare" om kvot < 1/troskel,
+    annars "oförändrad"; "ny"/"borttagen"/"fel" om en sida saknar mätvärde.
+    Skillnader under min_skillnad_ms räknas som brus (oförändrad).
+    """
+    def nycklat(samlat):
+        return {(r["backend"], r["storlek"], r["namn"]): r for r in samlat["resultat"]}
+
+    bas_rader, nya_rader = nycklat(bas), nycklat(ny)
+    rader = []
+    for nyckel in sorted(set(bas_rader) | set(nya_rader)):
+        b, n = bas_rader.get(nyckel), nya_rader.get(nyckel)
+        rad = {"backend": nyckel[0], "storlek": nyckel[1], "namn": nyckel[2],
+               "bas_ms": b.get("median_ms") if b else None,
+               "ny_ms": n.get("median_ms") if n else None, "kvot": None}
+        if b is None:
+            rad["status"] = "ny"
+        elif n is None:
+            rad["status"] = "borttagen"
+        elif rad["bas_ms"] is None or rad["ny_ms"] is None:
+            rad["status"] = "fel"
+        else:
+            rad["kvot"] = rad["ny_ms"] / rad["bas_ms"] if rad["bas_ms"] else None
+            if rad["kvot"] is None or abs(rad["ny_ms"] - rad["bas_ms"]) < min_skillnad_ms:
+                rad["status"] = "oförändrad"
+            elif rad["kvot"] > troskel:
+                rad["status"] = "långsammare"
+            elif rad["kvot"] < 1 / troskel:
+                rad["status"] = "snabbare"
+            else:
+                rad["status"] = "oförändrad"
+        rader.append(rad)
+    return rader
+
+
+def formatera_resultat(samlat):
+    """Resultatet som textabell (en rad per mätpunkt)."""
+    rader = [f"{'databas':<9}{'storlek':<8}{'funktion':<36}{'median ms':>11}{'min ms':>10}{'max ms':>10}"]
+    for r in samlat["resultat"]:
+        if "fel" in r:
+            rader.append(f"{r['backend']:<9}{r['storlek']:<8}{r['namn']:<36}  FEL: {r['fel']}")
+        else:
+            rader.append(f"{r['backend']:<9}{r['storlek']:<8}{r['namn']:<36}"
+                         f"{r['median_ms']:>11.2f}{r['min_ms']:>10.2f}{r['max_ms']:>10.2f}")
+    return "\n".join(rader)
+
+
+def formatera_jamforelse(rader):
+    """Jämförelsen som textabell."""
+    def ms(v):
+        return f"{v:.2f}" if v is not None else "-"
+
+    ut = [f"{'databas':<9}{'storlek':<8}{'funktion':<36}{'bas ms':>10}{'ny ms':>10}{'kvot':>7}  status"]
+    for r in rader:
+        kvot = f"{r['kvot']:.2f}" if r["kvot"] is not None else "-"
+        ut.append(f"{r['backend']:<9}{r['storlek']:<8}{r['namn']:<36}"
+                  f"{ms(r['bas_ms']):>10}{ms(r['ny_ms']):>10}{kvot:>7}  {r['status']}")
+    return "\n".join(ut)
@@ -0,0 +1,173 @@
+"""
+cache_utils.py - Läscache för Teammanager
+Processgemensam LRU-cache framför hamta_*-funktionerna i database.py.
+Varje tabell har en generationsräknare som skrivfunktionerna räknar upp;
+cachenycklar innehåller generationerna för tabellerna en läsning beror på,
+så gamla poster blir oåtkomliga direkt och faller ur LRU-listan.
+"""
+
+import copy
+import functools
+import os
+import threading
+from collections import OrderedDict
+
+CACHE_STORLEK = int(os.environ.get("TEAMMANAGER_CACHE_SIZE", 256))
+
+_alla_cacher = []
+_rensningsanrop = []
+
+
+class LRUCache:
+    """Trådsäker LRU-cache med begränsat antal poster och träff/miss-statistik.
+    Med max_byte begränsas även den totala storleken av bytes-värden; ett
+    värde större än max_byte sparas inte alls."""
+
+    def __init__(self, max_storlek=CACHE_STORLEK, max_byte=None):
+        self.max_storlek = max_storlek
+        self.max_byte = max_byte
+        self._poster = OrderedDict()
+        self._byte = 0
+        self._las = threading.Lock()
+        self.traffar = 0
+        self.missar = 0
+        _alla_cacher.append(self)
+
+    def hamta(self, nyckel):
+        """Returnera (True, värde) vid träff, annars (False, None)."""
+        with self._las:
+            if nyckel in self._poster:
+                self._poster.move_to_end(nyckel)
+                self.traffar += 1
+                return True, self._poster[nyckel]
+            self.missar += 1
+            return False, None
+
+    def spara(self, nyckel, varde):
+        storlek = _storlek(varde)
+        with self._las:
+            if nyckel in self._poster:
+                self._byte -= _storlek(self._poster.pop(nyckel))
+            if self.max_byte is not None and storlek > self.max_byte:
+                return
+            self._poster[nyckel] = varde
+            self._byte += storlek
+            while len(self._poster) > self.max_storlek or (
+                    self.max_byte is not None and self._byte > self.max_byte):
+                _, aldst = self._poster.popitem(last=False)
+                self._byte -= _storlek(aldst)
+
+    def rensa(self):
+        with self._las:
+            self._poster.clear()
+            self._byte = 0
+            self.traffar = 0
+            self.missar = 0
+
+    def statistik(self):
+        with self._las:
+            totalt = self.traffar + self.missar
+            return {
+                "traffar": self.traffar,
+                "missar": self.missar,
+                "traffgrad": (self.traffar / totalt) if totalt else 0.0,
+                "poster": len(self._poster),
+                "max_poster": self.max_storlek,
+                "byte": self._byte,
+                "max_byte": self.max_byte,
+            }
+
+
+def _storlek(varde):
+    """Storleken som räknas mot max_byte: längden för bytes, annars 0."""
+    return len(varde) if isinstance(varde, (bytes, bytearray)) else 0
+
+
+_cache = LRUCache()
+_generationer = {}
+_generation_las = threading.Lock()
+
+
+def generation(*tabeller):
+    """Aktuella generationsnummer för tabellerna, som tupel."""
+    with _generation_las:
+        return tuple(_generationer.get(t, 0) for t in tabeller)
+
+
+def invalidera(*tabeller):
+    """Räkna upp generationen för tabellerna så att beroende cacheposter blir ogiltiga."""
+    with _generation_las:
+        for t in tabeller:
+            _generationer[t] = _generationer.get(t, 0) + 1
+
+
+def _hashbar(varde):
+    """Gör listor/set/dict i argument hashbara för att kunna ingå i en nyckel."""
+    if isinstance(varde, (list, tuple)):
+        return tuple(_hashbar(v) for v in varde)
+    if isinstance(varde, (set, frozenset)):
+        return frozenset(_hashbar(v) for v in varde)
+    if isinstance(varde, dict):
+        return tuple(sorted((k, _hashbar(v)) for k, v in varde.items()))
+    return varde
+
+
+def _kopiera(varde):
+    """Ge anroparen en egen kopia så att ändringar inte smittar cachen."""
+    if isinstance(varde, list) and all(isinstance(v, dict) for v in varde):
+        return [dict(v) for v in varde]
+    if isinstance(varde, (list, dict)):
+        return copy.deepcopy(varde)
+    return varde
+
+
+def cachad(*tabeller, cache=None):
+    """Dekorator: cacha funktionens resultat per argument tills någon av
+    tabellerna skrivs till (se invaliderar). Standard är den gemensamma
+    läscachen; en egen LRUCache kan anges för stora resultat."""
+    def dekorator(funk):
+        @functools.wraps(funk)
+        def omslag(*args, **kwargs):
+            lru = _cache if cache is None else cache
+            nyckel = (funk.__qualname__, _hashbar(args), _hashbar(kwargs), generation(*tabeller))
+            hittad, varde = lru.hamta(nyckel)
+            if not hittad:
+                varde = funk(*args, **kwargs)
+                lru.spara(nyckel, varde)
+            return _kopiera(varde)
+        omslag.utan_cache = funk
+        return omslag
+    return dekorator
+
+
+def invaliderar(*tabeller):
+    """Dekorator för skrivfunktioner: invalidera tabellerna när funktionen har körts."""
+    def dekorator(funk):
+        @functools.wraps(funk)
+        def omslag(*args, **kwargs):
+            try:
+                return funk(*args, **kwargs)
+            finally:
+                invalidera(*tabeller)
+        return omslag
+    return dekorator
+
+
+def cache_statistik():
+    """Träffar, missar och storlek för den processgemensamma läscachen."""
+    return _cache.statistik()
+
+
+def vid_rensning(funk):
+    """Registrera en funktion som anropas av rensa_cache(), för moduler som
+    håller egna kopior av data (t.ex. allokeringsmotorn)."""
+    _rensningsanrop.append(funk)
+    return funk
+
+
+def rensa_cache():
+    """Töm läscachen och alla andra LRU-cacher (t.ex. vid byte av databas)."""
+    for lru in list(_alla_cacher):
+        lru.rensa()
+    for funk in list(_rensningsanrop):
+        funk()
@@ -3,23 +3,142 @@ calendar_utils.py - Kalenderberäkningar för Teammanager
 Hanterar svenska helgdagar, arbetsdagar och kalendervyer.
 """
 
-import holidays
-import pandas as pd
+import os
+import numpy as np
 from datetime import date, timedelta
 from functools import lru_cache
 
+# Standardspann för arbetsdagsindexet: så många år före/efter innevarande år
+KALENDER_AR_FORE = int(os.environ.get("TEAMMANAGER_KALENDER_AR_FORE", 5))
+KALENDER_AR_EFTER = int(os.environ.get("TEAMMANAGER_KALENDER_AR_EFTER", 10))
+
 
 @lru_cache(maxsize=10)
 def hamta_svenska_helgdagar(ar_start, ar_slut):
     """
     Hämta alla svenska röda dagar för ett intervall av år.
     Returnerar en dict {datum: namn_på_helgdag}.
-    Cachad för prestanda.
+    Cachad för prestanda. holidays importeras först här (vid första
+    uppslaget), inte när modulen laddas.
     """
+    import holidays
+
     se_holidays = holidays.Sweden(years=range(ar_start, ar_slut + 1))
     return dict(se_holidays)
 
 
+class ArbetsdagsIndex:
+    """
+    Förberäknat index över arbetsdagar för ett spann av hela år.
+    ordinaler: sorterad array med date.toordinal() för varje arbetsdag.
+    prefix: prefix[i] = antal arbetsdagar före dagen start + i.
+    Antal arbetsdagar mellan två datum och "lägg till N arbetsdagar" blir
+    O(1); uppslag per vecka/månad blir O(1) per vecka/månad.
+    """
+
+    def __init__(self, ar_start, ar_slut):
+        self.ar_start = ar_start
+        self.ar_slut = ar_slut
+        self.start = date(ar_start, 1, 1).toordinal()
+        self.slut = date(ar_slut, 12, 31).toordinal()
+
+        helgdagar = hamta_svenska_helgdagar(ar_start, ar_slut)
+        dagar = np.arange(self.start, self.slut + 1, dtype=np.int64)
+        helg_ordinaler = np.array(sorted(d.toordinal() for d in helgdagar), dtype=np.int64)
+        # date.fromordinal(1) är en måndag, så (ordinal - 1) % 7 är veckodagen
+        arbetsdag = ((dagar - 1) % 7 < 5) & ~np.isin(dagar, helg_ordinaler)
+
+        self.ordinaler = dagar[arbetsdag]
+        self.prefix = np.concatenate(([0], np.cumsum(arbetsdag)))
+        self.helgdagar = np.array(sorted(helgdagar), dtype="datetime64[D]")
+
+    def tacker(self, fran_datum, till_datum):
+        return self.start <= fran_datum.toordinal() and till_datum.toordinal() <= self.slut
+
+    def _intervall(self, fran_datum, till_datum):
+        """Index i self.ordinaler för arbetsdagarna fran_datum..till_datum (inklusive)."""
+        i = int(self.prefix[max(fran_datum.toordinal(), self.start) - self.start])
+        j = int(self.prefix[min(till_datum.toordinal(), self.slut) - self.start + 1])
+        return i, max(i, j)
+
+    def ar_arbetsdag(self, datum):
+        ordinal = datum.toordinal()
+        return bool(self.prefix[ordinal - self.start + 1] - self.prefix[ordinal - self.start])
+
+    def antal(self, fran_datum, till_datum):
+        """Antal arbetsdagar i fran_datum..till_datum (inklusive)."""
+        i, j = self._intervall(fran_datum, till_datum)
+        return j - i
+
+    def arbetsdagar(self, fran_datum, till_datum):
+        """Arbetsdagarna i fran_datum..till_datum som lista av date."""
+        i, j = self._intervall(fran_datum, till_datum)
+        return [date.fromordinal(int(o)) for o in self.ordinaler[i:j]]
+
+    def lagg_till(self, datum, antal):
+        """
+        Flytta datum `antal` arbetsdagar framåt (eller bakåt om negativt).
+        Är datum ingen arbetsdag räknas från nästa arbetsdag, som
+        numpy.busday_offset(..., roll="forward").
+        """
+        if not self.tacker(datum, datum):
+            raise ValueError("Datumet ligger utanför arbetsdagsindexets år")
+        position = int(self.prefix[datum.toordinal() - self.start]) + antal
+        if not 0 <= position < len(self.ordinaler):
+            raise ValueError("Resultatet hamnar utanför arbetsdagsindexets år")
+        return date.fromordinal(int(self.ordinaler[position]))
+
+    def per_iso_vecka(self, fran_datum, till_datum):
+        """Antal arbetsdagar per ISO-vecka i intervallet: {"ÅÅÅÅ-Vnn": antal}."""
+        resultat = {}
+        mandag = fran_datum - timedelta(days=fran_datum.weekday())
+        while mandag <= till_datum:
+            iso = mandag.isocalendar()
+            resultat[f"{iso[0]}-V{iso[1]:02d}"] = self.antal(
+                max(mandag, fran_datum), min(mandag + timedelta(days=6), till_datum))
+            mandag += timedelta(days=7)
+        return resultat
+
+    def per_manad(self, fran_datum, till_datum):
+        """Antal arbetsdagar per månad i intervallet: {(år, månad): antal}."""
+        resultat = {}
+        forsta = fran_datum.replace(day=1)
+        while forsta <= till_datum:
+            nasta = (forsta + timedelta(days=32)).replace(day=1)
+            resultat[(forsta.year, forsta.month)] = self.antal(
+                max(forsta, fran_datum), min(nasta - timedelta(days=1), till_datum))
+            forsta = nasta
+        return resultat
+
+    def busdaycalendar(self):
+        """numpy.busdaycalendar med mån-fre och svenska röda dagar, för
+        vektoriserade np.is_busday/np.busday_count/np.busday_offset."""
+        return np.busdaycalendar(weekmask="1111100", holidays=self.helgdagar)
+
+
+@lru_cache(maxsize=10)
+def hamta_arbetsdagsindex(ar_start=None, ar_slut=None):
+    """
+    Hämta (och bygg vid behov) arbetsdagsindexet för ett spann av år.
+    Utan argument används standardspannet KALENDER_AR_FORE/KALENDER_AR_EFTER
+    runt innevarande år.
+    """
+    idag = date.today()
+    if ar_start is None:
+        ar_start = idag.year - KALENDER_AR_FORE
+    if ar_slut is None:
+        ar_slut = idag.year + KALENDER_AR_EFTER
+    return ArbetsdagsIndex(ar_start, ar_slut)
+
+
+def _index_for(fran_datum, till_datum):
+    """Standardindexet om det täcker intervallet, annars ett index för just de åren."""
+    index = hamta_arbetsdagsindex()
+    if index.tacker(fran_datum, till_datum):
+        return index
+    return hamta_arbetsdagsindex(fran_datum.year, till_datum.year)
+
+
 def ar_arbetsdag(datum, helgdagar=None):
     """
     Kontrollera om ett datum är en arbetsdag.
@@ -28,7 +147,7 @@ def ar_arbetsdag(datum, helgdagar=None):
     if datum.weekday() >= 5:  # Lördag=5, Söndag=6
         return False
     if helgdagar is None:
-        helgdagar = hamta_svenska_helgdagar(datum.year, datum.year)
+        return _index_for(datum, datum).ar_arbetsdag(datum)
     return datum not in helgdagar
 
 
@@ -36,14 +155,41 @@ def hamta_arbetsdagar(fran_datum, till_datum):
     """
     Returnera en lista av alla arbetsdagar i ett datumintervall.
     """
-    helgdagar = hamta_svenska_helgdagar(fran_datum.year, till_datum.year)
-    arbetsdagar = []
-    current = fran_datum
-    while current <= till_datum:
-        if ar_arbetsdag(current, helgdagar):
-            arbetsdagar.append(current)
-        current += timedelta(days=1)
-    return arbetsdagar
+    if fran_datum > till_datum:
+        return []
+    return _index_for(fran_datum, till_datum).arbetsdagar(fran_datum, till_datum)
+
+
+def antal_arbetsdagar(fran_datum, till_datum):
+    """Antal arbetsdagar i ett datumintervall (inklusive båda ändar)."""
+    if fran_datum > till_datum:
+        return 0
+    return _index_for(fran_datum, till_datum).antal(fran_datum, till_datum)
+
+
+def lagg_till_arbetsdagar(datum, antal):
+    """Datumet `antal` arbetsdagar efter (eller före) datum."""
+    index = hamta_arbetsdagsindex()
+    try:
+        return index.lagg_till(datum, antal)
+    except ValueError:
+        marginal = abs(antal) // 200 + 1
+        return hamta_arbetsdagsindex(datum.year - marginal, datum.year + marginal).lagg_till(datum, antal)
+
+
+def arbetsdagar_per_vecka(fran_datum, till_datum):
+    """Antal arbetsdagar per ISO-vecka: {"ÅÅÅÅ-Vnn": antal}."""
+    return _index_for(fran_datum, till_datum).per_iso_vecka(fran_datum, till_datum)
+
+
+def arbetsdagar_per_manad(fran_datum, till_datum):
+    """Antal arbetsdagar per månad: {(år, månad): antal}."""
+    return _index_for(fran_datum, till_datum).per_manad(fran_datum, till_datum)
+
+
+def hamta_busdaycalendar(fran_datum, till_datum):
+    """numpy.busdaycalendar med svenska röda dagar som täcker intervallet."""
+    return _index_for(fran_datum, till_datum).busdaycalendar()
 
 
 def antal_arbetsdagar_i_manad(ar, manad):
@@ -53,7 +199,7 @@ def antal_arbetsdagar_i_manad(ar, manad):
         till = date(ar, 12, 31)
     else:
         till = date(ar, manad + 1, 1) - timedelta(days=1)
-    return len(hamta_arbetsdagar(fran, till))
+    return antal_arbetsdagar(fran, till)
 
 
 def skapa_manadskalender(ar, manad):
@@ -4,14 +4,49 @@ Heatmaps, stapeldiagram, Gantt-översikt, frånvarodiagram.
 """
 
 import plotly.graph_objects as go
-import plotly.express as px
+import numpy as np
 import pandas as pd
 from datetime import date, timedelta
-from calendar_utils import hamta_arbetsdagar, hamta_svenska_helgdagar, MANAD_NAMN
+from calendar_utils import (
+    hamta_arbetsdagar, hamta_busdaycalendar,
+    arbetsdagar_per_vecka as arbetsdagar_per_vecka_i_intervall, MANAD_NAMN
+)
 from database import (
     hamta_allokeringar, hamta_all_personal, hamta_franvaro,
-    hamta_teamoversikt, FRANVARO_TYPER
+    hamta_teamoversikt, hamta_overbelagda, FRANVARO_TYPER
 )
+from allokeringsmotor import hamta_motor
+
+
+def _iso_veckor_i_intervall(fran_datum, till_datum):
+    """Veckoetiketter (ÅÅÅÅ-Vnn) i 7-dagarssteg från fran_datum, i ordning."""
+    alla_veckor = []
+    current = fran_datum
+    while current <= till_datum:
+        vecka_key = f"{current.isocalendar()[0]}-V{current.isocalendar()[1]:02d}"
+        if vecka_key not in alla_veckor:
+            alla_veckor.append(vecka_key)
+        current += timedelta(days=7)
+    return alla_veckor
+
+
+def _timmar_per_person_vecka(fran_datum, till_datum):
+    """Pivot personal_id x ISO-vecka med allokerade timmar på arbetsdagar."""
+    allokeringar = hamta_allokeringar(fran_datum=fran_datum, till_datum=till_datum)
+    if not allokeringar:
+        return pd.DataFrame()
+
+    # Arbetsdagar i intervallet och deras ISO-vecka
+    dagar = pd.DataFrame({"datum": pd.date_range(fran_datum, till_datum, freq="D")})
+    dagar = dagar[np.is_busday(dagar["datum"].to_numpy().astype("datetime64[D]"),
+                               busdaycal=hamta_busdaycalendar(fran_datum, till_datum))]
+    dagar["vecka"] = dagar["datum"].dt.strftime("%G-V%V")
+
+    df = pd.DataFrame(allokeringar, columns=["personal_id", "datum", "timmar"])
+    df["datum"] = pd.to_datetime(df["datum"])
+    df = df.merge(dagar, on="datum", how="inner")
+    return df.pivot_table(index="personal_id", columns="vecka", values="timmar",
+                          aggfunc="sum", fill_value=0.0)
 
 
 def skapa_belaggnings_heatmap(fran_datum, till_datum):
@@ -20,56 +55,32 @@ def skapa_belaggnings_heatmap(fran_datum, till_datum):
     if not personal:
         return None
 
-    allokeringar = hamta_allokeringar(fran_datum=fran_datum, till_datum=till_datum)
-    helgdagar = hamta_svenska_helgdagar(fran_datum.year, till_datum.year)
+    alla_veckor = _iso_veckor_i_intervall(fran_datum, till_datum)
+    arbetsdagar_per_vecka = pd.Series(arbetsdagar_per_vecka_i_intervall(fran_datum, till_datum)).reindex(
+        alla_veckor, fill_value=0)
 
-    if allokeringar:
-        df = pd.DataFrame(allokeringar)
-        df["datum"] = pd.to_datetime(df["datum"])
+    # Allokerade timmar per (person, vecka), bara på arbetsdagar
+    motor = hamta_motor()
+    if motor is not None:
+        timmar = motor.timmar_per_person_vecka(fran_datum, till_datum)
     else:
-        df = pd.DataFrame()
-
-    alla_veckor = []
-    current = fran_datum
-    while current <= till_datum:
-        vecka_key = f"{current.isocalendar()[0]}-V{current.isocalendar()[1]:02d}"
-        if vecka_key not in alla_veckor:
-            alla_veckor.append(vecka_key)
-        current += timedelta(days=7)
+        timmar = _timmar_per_person_vecka(fran_datum, till_datum)
+    person_ids = [p["id"] for p in personal]
+    timmar = timmar.reindex(index=person_ids, columns=alla_veckor, fill_value=0.0)
+
+    kapacitet = pd.Series([p["kapacitet_h"] for p in personal], index=person_ids)
+    max_timmar = pd.DataFrame(
+        kapacitet.to_numpy()[:, None] * arbetsdagar_per_vecka.to_numpy()[None, :],
+        index=person_ids, columns=alla_veckor
+    )
+    belaggning = (timmar / max_timmar.where(max_timmar > 0) * 100).fillna(0.0).round(1)
 
     person_namn = [p["namn"] for p in personal]
-    matris = []
-
-    for person in personal:
-        rad = []
-        for vecka_label in alla_veckor:
-            ar, vecka_nr = vecka_label.split("-V")
-            ar, vecka_nr = int(ar), int(vecka_nr)
-
-            arbetsdagar_i_vecka = 0
-            allokerade_timmar = 0.0
-
-            check_date = fran_datum
-            while check_date <= till_datum:
-                iso = check_date.isocalendar()
-                if iso[0] == ar and iso[1] == vecka_nr:
-                    if check_date.weekday() < 5 and check_date not in helgdagar:
-                        arbetsdagar_i_vecka += 1
-                        if not df.empty:
-                            dag_allok = df[
-                                (df["personal_id"] == person["id"]) &
-                                (df["datum"].dt.date == check_date)
-                            ]["timmar"].sum()
-                            allokerade_timmar += dag_allok
-                check_date += timedelta(days=1)
-
-            if arbetsdagar_i_vecka > 0:
-                max_timmar = arbetsdagar_i_vecka * person["kapacitet_h"]
-                belaggning = (allokerade_timmar / max_timmar) * 100
-            else:
-                belaggning = 0
-            rad.append(round(belaggning, 1))
-        matris.append(rad)
+    har_arbetsdagar = (arbetsdagar_per_vecka > 0).tolist()
+    matris = [
+        [v if har_dag else 0 for v, har_dag in zip(rad, har_arbetsdagar)]
+        for rad in belaggning.to_numpy().tolist()
+    ]
 
     fig = go.Figure(data=go.Heatmap(
         z=matris, x=alla_veckor, y=person_namn,
@@ -93,14 +104,20 @@ def skapa_belaggnings_heatmap(fran_datum, till_datum):
 
 def skapa_team_belaggning_stapel(fran_datum, till_datum):
     """Stacked bar: teamtimmar per vecka, uppdelat per projekt."""
-    allokeringar = hamta_allokeringar(fran_datum=fran_datum, till_datum=till_datum)
-    if not allokeringar:
-        return None
+    motor = hamta_motor()
+    if motor is not None:
+        grouped = motor.timmar_per_projekt_vecka(fran_datum, till_datum)
+        if grouped.empty:
+            return None
+    else:
+        allokeringar = hamta_allokeringar(fran_datum=fran_datum, till_datum=till_datum)
+        if not allokeringar:
+            return None
 
-    df = pd.DataFrame(allokeringar)
-    df["datum"] = pd.to_datetime(df["datum"])
-    df["vecka"] = df["datum"].dt.strftime("%G-V%V")
-    grouped = df.groupby(["vecka", "projekt_namn", "projekt_farg"])["timmar"].sum().reset_index()
+        df = pd.DataFrame(allokeringar)
+        df["datum"] = pd.to_datetime(df["datum"])
+        df["vecka"] = df["datum"].dt.strftime("%G-V%V")
+        grouped = df.groupby(["vecka", "projekt_namn", "projekt_farg"])["timmar"].sum().reset_index()
 
     fig = go.Figure()
     for _, proj_data in grouped.groupby("projekt_namn"):
@@ -121,14 +138,20 @@ def skapa_team_belaggning_stapel(fran_datum, till_datum):
 
 def skapa_person_belaggning_pie(personal_id, fran_datum, till_datum):
     """Pie chart: tidsfördelning per projekt för en person."""
-    allokeringar = hamta_allokeringar(
-        personal_id=personal_id, fran_datum=fran_datum, till_datum=till_datum
-    )
-    if not allokeringar:
-        return None
+    motor = hamta_motor()
+    if motor is not None:
+        grouped = motor.timmar_per_projekt(fran_datum, till_datum, personal_id)
+        if grouped.empty:
+            return None
+    else:
+        allokeringar = hamta_allokeringar(
+            personal_id=personal_id, fran_datum=fran_datum, till_datum=till_datum
+        )
+        if not allokeringar:
+            return None
 
-    df = pd.DataFrame(allokeringar)
-    grouped = df.groupby(["projekt_namn", "projekt_farg"])["timmar"].sum().reset_index()
+        df = pd.DataFrame(allokeringar)
+        grouped = df.groupby(["projekt_namn", "projekt_farg"])["timmar"].sum().reset_index()
 
     fig = go.Figure(data=[go.Pie(
         labels=grouped["projekt_namn"], values=grouped["timmar"],
@@ -142,18 +165,20 @@ def skapa_person_belaggning_pie(personal_id, fran_datum, till_datum):
 
 def skapa_kapacitetsvarningar(fran_datum, till_datum):
     """Returnerar DataFrame med alla överbelagda person+datum."""
-    allokeringar = hamta_allokeringar(fran_datum=fran_datum, till_datum=till_datum)
-    if not allokeringar:
+    motor = hamta_motor()
+    if motor is not None:
+        varningar = motor.overbelagda(fran_datum, till_datum)
+        return varningar if not varningar.empty else pd.DataFrame()
+
+    varningar = hamta_overbelagda(fran_datum, till_datum, bara_aktiva=False)
+    if not varningar:
         return pd.DataFrame()
 
-    df = pd.DataFrame(allokeringar)
-    dag_summa = df.groupby(
-        ["personal_id", "personal_namn", "datum", "kapacitet_h"]
-    )["timmar"].sum().reset_index()
-    dag_summa.rename(columns={"timmar": "total_timmar"}, inplace=True)
-    varningar = dag_summa[dag_summa["total_timmar"] > dag_summa["kapacitet_h"]].copy()
-    varningar["overtid"] = varningar["total_timmar"] - varningar["kapacitet_h"]
-    return varningar.sort_values(["datum", "personal_namn"])
+    df = pd.DataFrame(varningar, columns=[
+        "personal_id", "personal_namn", "datum", "kapacitet_h", "total_timmar"
+    ])
+    df["overtid"] = df["total_timmar"] - df["kapacitet_h"]
+    return df
 
 
 def skapa_gantt_oversikt(fran_datum, till_datum, arbetsdagar):
@@ -169,9 +194,11 @@ def skapa_gantt_oversikt(fran_datum, till_datum, arbetsdagar):
     if not oversikt:
         return None
 
-    fig = go.Figure()
+    # Samla staplarna per serie (ett projekt eller en frånvarotyp) så att
+    # figuren får ett spår per serie i stället för ett per cell.
+    franvaro_serier = {}
+    projekt_serier = {}
     y_labels = []
-    y_positions = []
 
     for idx, p in enumerate(personal):
         pid = p["id"]
@@ -187,33 +214,54 @@ def skapa_gantt_oversikt(fran_datum, till_datum, arbetsdagar):
                 continue
 
             dag_data = oversikt[pid]["dagar"][dag_str]
+            bas = dag.toordinal() - fran_datum.toordinal()
 
             # Frånvaro
             if dag_data["franvaro"]:
                 typ = dag_data["franvaro"]
-                info = FRANVARO_TYPER.get(typ, FRANVARO_TYPER["ovrigt"])
-                fig.add_trace(go.Bar(
-                    x=[1], y=[y_pos], base=[dag.toordinal() - fran_datum.toordinal()],
-                    orientation='h', marker_color=info["farg"],
-                    marker_line=dict(width=1, color='white'),
-                    name=info["namn"], showlegend=False,
-                    hovertemplate=f"{p['namn']}<br>{dag}<br>{info['ikon']} {info['namn']}<extra></extra>"
-                ))
+                if typ not in FRANVARO_TYPER:
+                    typ = "ovrigt"
+                serie = franvaro_serier.setdefault(typ, {"x": [], "y": [], "base": [], "customdata": []})
+                serie["x"].append(1)
+                serie["y"].append(y_pos)
+                serie["base"].append(bas)
+                serie["customdata"].append([p["namn"], dag_str])
             # Allokeringar
             elif dag_data["allokeringar"]:
                 for allok in dag_data["allokeringar"]:
-                    width = allok["timmar"] / p["kapacitet_h"]
-                    fig.add_trace(go.Bar(
-                        x=[width], y=[y_pos],
-                        base=[dag.toordinal() - fran_datum.toordinal()],
-                        orientation='h', marker_color=allok["farg"],
-                        marker_line=dict(width=0.5, color='white'),
-                        name=allok["projekt"], showlegend=False,
-                        hovertemplate=(
-                            f"{p['namn']}<br>{dag}<br>"
-                            f"{allok['projekt']}: {allok['timmar']}h<extra></extra>"
-                        )
-                    ))
+                    serie = projekt_serier.setdefault(
+                        (allok["projekt"], allok["farg"]),
+                        {"x": [], "y": [], "base": [], "customdata": []}
+                    )
+                    serie["x"].append(allok["timmar"] / p["kapacitet_h"])
+                    serie["y"].append(y_pos)
+                    serie["base"].append(bas)
+                    serie["customdata"].append([p["namn"], dag_str, f"{allok['timmar']}h"])
+
+    fig = go.Figure()
+    for typ, serie in franvaro_serier.items():
+        info = FRANVARO_TYPER[typ]
+        fig.add_trace(go.Bar(
+            x=serie["x"], y=serie["y"], base=serie["base"], customdata=serie["customdata"],
+            orientation='h', marker_color=info["farg"],
+            marker_line=dict(width=1, color='white'),
+            name=info["namn"], showlegend=False,
+            hovertemplate=(
+                f"%{{customdata[0]}}<br>%{{customdata[1]}}<br>"
+                f"{info['ikon']} {info['namn']}<extra></extra>"
+            )
+        ))
+    for (projekt, farg), serie in projekt_serier.items():
+        fig.add_trace(go.Bar(
+            x=serie["x"], y=serie["y"], base=serie["base"], customdata=serie["customdata"],
+            orientation='h', marker_color=farg,
+            marker_line=dict(width=0.5, color='white'),
+            name=projekt, showlegend=False,
+            hovertemplate=(
+                f"%{{customdata[0]}}<br>%{{customdata[1]}}<br>"
+                f"{projekt}: %{{customdata[2]}}<extra></extra>"
+            )
+        ))
 
     dag_labels = [str(d) for d in arbetsdagar]
     fig.update_layout(
@@ -236,12 +284,18 @@ def skapa_gantt_oversikt(fran_datum, till_datum, arbetsdagar):
 
 def skapa_franvaro_oversikt(fran_datum, till_datum):
     """Skapa stapeldiagram av frånvaro per typ och person."""
-    franvaro_data = hamta_franvaro(fran_datum=fran_datum, till_datum=till_datum)
-    if not franvaro_data:
-        return None
+    motor = hamta_motor()
+    if motor is not None:
+        grouped = motor.franvaro_per_person_typ(fran_datum, till_datum)
+        if grouped.empty:
+            return None
+    else:
+        franvaro_data = hamta_franvaro(fran_datum=fran_datum, till_datum=till_datum)
+        if not franvaro_data:
+            return None
 
-    df = pd.DataFrame(franvaro_data)
-    grouped = df.groupby(["personal_namn", "typ"]).size().reset_index(name="dagar")
+        df = pd.DataFrame(franvaro_data)
+        grouped = df.groupby(["personal_namn", "typ"]).size().reset_index(name="dagar")
 
     fig = go.Figure()
     for typ, info in FRANVARO_TYPER.items():
@@ -7,7 +7,15 @@ Inkluderar: personal, projekt, allokering, kompetenser, frånvaro, kommentarer.
 
 import sqlite3
 import os
-from datetime import datetime, date, timedelta
+import csv
+import io
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import date, timedelta
+from cache_utils import cachad, invaliderar, rensa_cache
+from fragelogg_utils import matt
 
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "teammanager.db")
 
@@ -28,10 +36,39 @@ if _SUPABASE_DB_URL:
     try:
         import psycopg2
         import psycopg2.extras
+        import psycopg2.extensions
+        import psycopg2.pool
         _USE_POSTGRES = True
     except ImportError:
         _USE_POSTGRES = False
 
+
+def _las_installning(nyckel, standard):
+    """Läs en inställning från st.secrets["database"] eller miljövariabeln TEAMMANAGER_<nyckel>."""
+    try:
+        varde = st.secrets.get("database", {}).get(nyckel)
+        if varde not in (None, ""):
+            return varde
+    except Exception:
+        pass
+    return os.environ.get(f"TEAMMANAGER_{nyckel}", standard)
+
+
+# Max antal samtidiga PostgreSQL-anslutningar i poolen
+POOL_STORLEK = int(_las_installning("POOL_SIZE", 5))
+# Anslutningar som legat oanvända längre än så pingas innan de lånas ut (sekunder)
+POOL_HALSOKONTROLL_S = float(_las_installning("POOL_HEALTHCHECK_S", 30))
+
+# Rader per rundresa i bulk-skrivningar, och gränsen där PostgreSQL byter till COPY
+BULK_SIDSTORLEK = 1000
+BULK_COPY_GRANS = int(_las_installning("BULK_COPY_THRESHOLD", 5000))
+
+# arkivera() flyttar som standard allt före 1 januari så många år före innevarande år
+ARKIV_AR = int(_las_installning("ARCHIVE_KEEP_YEARS", 2))
+
+# Poster i andringslogg äldre än så många dagar rensas av init_db() och allokeringsmotorn
+ANDRINGSLOGG_DAGAR = float(_las_installning("CHANGELOG_KEEP_DAYS", 7))
+
 # Databasspecifika inställningar
 if _USE_POSTGRES:
     _IntegrityError = psycopg2.IntegrityError
@@ -56,15 +93,16 @@ class _PgConnectionWrapper:
     """Wrappar psycopg2-connection att bete sig som sqlite3.Connection.
     Alla execute()-anrop använder DictCursor automatiskt så att
     row["kolumn"] och dict(row) fungerar likadant som sqlite3.Row.
+    close() lämnar tillbaka anslutningen till poolen i stället för att stänga den.
     """
 
-    def __init__(self, conn):
+    def __init__(self, conn, pool=None):
         self._conn = conn
+        self._pool = pool
 
     def execute(self, query, params=None):
         cursor = self._conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cursor.execute(query, params or ())
-        return cursor
+        return matt(query, params, cursor.execute, query, params or (), cursor=cursor)
 
     def executescript(self, script):
         """Ej tillgänglig för PostgreSQL — använd execute() per statement."""
@@ -77,29 +115,241 @@ class _PgConnectionWrapper:
         self._conn.rollback()
 
     def close(self):
-        self._conn.close()
+        if self._conn is None:
+            return
+        if self._pool is None:
+            self._conn.close()
+        else:
+            self._pool.lamna_tillbaka(self._conn)
+        self._conn = None
 
     def cursor(self):
         return self._conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
+    def executemany(self, query, seq_of_params):
+        cursor = self._conn.cursor()
+        return matt(query, None, psycopg2.extras.execute_batch, cursor, query, seq_of_params,
+                    BULK_SIDSTORLEK, massa=True, cursor=cursor)
+
+    def execute_values(self, query, rader):
+        """Skicka rader som en VALUES-lista (%s i query) — en rundresa per BULK_SIDSTORLEK rader."""
+        cursor = self._conn.cursor()
+        return matt(query, None, psycopg2.extras.execute_values, cursor, query, rader,
+                    None, BULK_SIDSTORLEK, massa=True, cursor=cursor)
+
+    def copy_expert(self, sql, fil):
+        cursor = self._conn.cursor()
+        return matt(sql, None, cursor.copy_expert, sql, fil, massa=True, cursor=cursor)
+
+    def server_cursor(self, namn, sidstorlek=BULK_SIDSTORLEK):
+        """Namngiven cursor: resultatet stannar på servern och hämtas sidstorlek rader åt gången."""
+        cursor = self._conn.cursor(name=namn)
+        cursor.itersize = sidstorlek
+        return cursor
+
+    def execute_server(self, namn, query, params=None, sidstorlek=BULK_SIDSTORLEK):
+        """Kör query i en server_cursor och returnera cursorn."""
+        cursor = self.server_cursor(namn, sidstorlek)
+        return matt(query, params, cursor.execute, query, params or (), cursor=cursor)
+
+
+class _PgPool:
+    """Processgemensam pool av psycopg2-anslutningar.
+    Blockerar när alla POOL_STORLEK anslutningar är utlånade och kontrollerar
+    att en anslutning lever innan den lånas ut igen.
+    """
+
+    def __init__(self, dsn, storlek):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(1, storlek, dsn)
+        self._lediga = threading.BoundedSemaphore(storlek)
+        self._senast_anvand = {}
+
+    def lana(self):
+        self._lediga.acquire()
+        try:
+            while True:
+                raw = self._pool.getconn()
+                if self._ar_frisk(raw):
+                    raw.autocommit = False
+                    return raw
+                self._pool.putconn(raw, close=True)
+        except Exception:
+            self._lediga.release()
+            raise
+
+    def _ar_frisk(self, raw):
+        if raw.closed:
+            return False
+        if time.monotonic() - self._senast_anvand.get(id(raw), 0) < POOL_HALSOKONTROLL_S:
+            return True
+        try:
+            with raw.cursor() as cur:
+                cur.execute("SELECT 1")
+            raw.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def lamna_tillbaka(self, raw):
+        try:
+            trasig = bool(raw.closed)
+            if not trasig and raw.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    raw.rollback()
+                except psycopg2.Error:
+                    trasig = True
+            self._senast_anvand[id(raw)] = time.monotonic()
+            self._pool.putconn(raw, close=trasig)
+        finally:
+            self._lediga.release()
+
+    def stang(self):
+        self._pool.closeall()
+
+
+# ============================================================
+# ÅTERANVÄND SQLITE-ANSLUTNING PER TRÅD
+# ============================================================
+
+class _SqliteConnection(sqlite3.Connection):
+    """sqlite3.Connection som återanvänds inom en tråd.
+    close() stänger inte filen utan räknar ner antalet utlån; när sista
+    lånet lämnas tillbaka rullas eventuell okommittad transaktion tillbaka.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.utlanad = 0
+        self.db_path = None
+
+    def execute(self, sql, parameters=()):
+        return matt(sql, parameters, super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return matt(sql, None, super().executemany, sql, seq_of_parameters, massa=True)
+
+    def close(self):
+        self.utlanad = max(0, self.utlanad - 1)
+        if self.utlanad == 0 and self.in_transaction:
+            self.rollback()
+
+    def stang(self):
+        self.utlanad = 0
+        super().close()
+
+
+_pg_pool = None
+_pool_las = threading.Lock()
+_sqlite_lokal = threading.local()
+_sqlite_anslutningar = []
+
+
+def _hamta_pg_pool():
+    global _pg_pool
+    if _pg_pool is None:
+        with _pool_las:
+            if _pg_pool is None:
+                _pg_pool = _PgPool(_SUPABASE_DB_URL, POOL_STORLEK)
+    return _pg_pool
+
+
+def _ny_sqlite_anslutning():
+    conn = sqlite3.connect(DB_PATH, factory=_SqliteConnection, check_same_thread=False)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.row_factory = sqlite3.Row
+    conn.db_path = DB_PATH
+    conn.agare = weakref.ref(threading.current_thread())
+    with _pool_las:
+        # Streamlit kör varje rerun i en ny tråd; stäng anslutningar vars tråd har avslutats
+        doda = [c for c in _sqlite_anslutningar if not _tradens_agare_lever(c)]
+        _sqlite_anslutningar[:] = [c for c in _sqlite_anslutningar if c not in doda]
+        _sqlite_anslutningar.append(conn)
+    for c in doda:
+        _stang_sqlite(c)
+    return conn
+
+
+def _tradens_agare_lever(conn):
+    trad = conn.agare()
+    return trad is not None and trad.is_alive()
+
+
+def _sqlite_ar_frisk(conn):
+    if conn.db_path != DB_PATH:
+        return False
+    try:
+        conn.total_changes  # Kastar ProgrammingError om anslutningen är stängd
+        return True
+    except sqlite3.Error:
+        return False
+
 
 # ============================================================
 # ANSLUTNING
 # ============================================================
 
 def get_connection():
-    """Skapa och returnera en databasanslutning.
-    PostgreSQL om SUPABASE_DB_URL finns, annars SQLite.
+    """Låna en databasanslutning.
+    PostgreSQL om SUPABASE_DB_URL finns (ur processens pool), annars SQLite
+    (en återanvänd anslutning per tråd). Anropa close() för att lämna tillbaka.
     """
     if _USE_POSTGRES:
-        raw = psycopg2.connect(_SUPABASE_DB_URL)
-        raw.autocommit = False
-        return _PgConnectionWrapper(raw)
-    else:
-        conn = sqlite3.connect(DB_PATH)
-        conn.execute("PRAGMA foreign_keys = ON")
-        conn.row_factory = sqlite3.Row
-        return conn
+        pool = _hamta_pg_pool()
+        return _PgConnectionWrapper(pool.lana(), pool)
+
+    conn = getattr(_sqlite_lokal, "conn", None)
+    if conn is not None and conn.utlanad == 0 and not _sqlite_ar_frisk(conn):
+        _stang_sqlite(conn)
+        conn = None
+    if conn is None:
+        conn = _ny_sqlite_anslutning()
+        _sqlite_lokal.conn = conn
+    conn.utlanad += 1
+    return conn
+
+
+@contextmanager
+def anslutning():
+    """Låna en anslutning som context manager.
+    Commit när blocket lyckas, rollback vid undantag, och anslutningen
+    lämnas alltid tillbaka:
+
+        with anslutning() as conn:
+            conn.execute(...)
+    """
+    conn = get_connection()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _stang_sqlite(conn):
+    with _pool_las:
+        if conn in _sqlite_anslutningar:
+            _sqlite_anslutningar.remove(conn)
+    try:
+        conn.stang()
+    except sqlite3.Error:
+        pass
+
+
+def stang_anslutningar():
+    """Stäng alla poolade anslutningar (t.ex. vid byte av DB_PATH eller i tester)."""
+    global _pg_pool
+    with _pool_las:
+        pool, _pg_pool = _pg_pool, None
+        sqlite_conns = list(_sqlite_anslutningar)
+    if pool is not None:
+        pool.stang()
+    for conn in sqlite_conns:
+        _stang_sqlite(conn)
+    _sqlite_lokal.__dict__.clear()
+    rensa_cache()
 
 
 # ============================================================
@@ -158,6 +408,11 @@ _CREATE_TABLES_PG = [
         FOREIGN KEY (personal_id) REFERENCES personal(id) ON DELETE CASCADE,
         UNIQUE(personal_id, datum)
     )""",
+    """CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        beskrivning TEXT NOT NULL DEFAULT '',
+        applicerad TEXT DEFAULT CURRENT_TIMESTAMP
+    )""",
 ]
 
 _CREATE_TABLES_SQLITE = """
@@ -217,29 +472,991 @@ _CREATE_TABLES_SQLITE = """
         FOREIGN KEY (personal_id) REFERENCES personal(id) ON DELETE CASCADE,
         UNIQUE(personal_id, datum)
     );
+
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        beskrivning TEXT NOT NULL DEFAULT '',
+        applicerad TEXT DEFAULT (datetime('now'))
+    );
 """
 
 
-def init_db():
-    """Skapa alla tabeller om de inte redan finns."""
-    conn = get_connection()
+# ============================================================
+# SCHEMAMIGRERINGAR
+# ============================================================
+
+# Kolumnerna som ändringsloggen sparar per tabell:
+# (personal_id, projekt_id, datum, timmar) som uttryck över raden {r} (NEW/OLD).
+_LOGGADE_TABELLER = {
+    "allokering": ("{r}.personal_id", "{r}.projekt_id", "{r}.datum", "{r}.timmar"),
+    "franvaro": ("{r}.personal_id", "NULL", "{r}.datum", "NULL"),
+    "kommentarer": ("{r}.personal_id", "NULL", "{r}.datum", "NULL"),
+    "kompetenser": ("{r}.personal_id", "NULL", "NULL", "NULL"),
+    "personal": ("{r}.id", "NULL", "NULL", "NULL"),
+    "projekt": ("NULL", "{r}.id", "NULL", "NULL"),
+    # datum är periodens/regelns startdatum
+    "allokeringsperiod": ("{r}.personal_id", "{r}.projekt_id", "{r}.start_datum", "{r}.timmar"),
+    "allokeringsregel": ("{r}.personal_id", "{r}.projekt_id", "{r}.start_datum", "{r}.timmar"),
+}
+
+
+def _andringslogg_statements(tabeller):
+    """CREATE-satser för andringslogg och en trigger per tabell och operation.
+    SQLite får tre triggers per tabell, PostgreSQL en triggerfunktion per tabell.
+    Tabellen och indexet skapas med IF NOT EXISTS och kan upprepas."""
+    statements = [(
+        """CREATE TABLE IF NOT EXISTS andringslogg (
+            generation INTEGER PRIMARY KEY AUTOINCREMENT,
+            tabell TEXT NOT NULL,
+            operation TEXT NOT NULL,
+            rad_id INTEGER,
+            personal_id INTEGER,
+            projekt_id INTEGER,
+            datum TEXT,
+            gammal_timmar REAL,
+            ny_timmar REAL,
+            tidpunkt TEXT DEFAULT (datetime('now'))
+        )""",
+        """CREATE TABLE IF NOT EXISTS andringslogg (
+            generation BIGSERIAL PRIMARY KEY,
+            tabell TEXT NOT NULL,
+            operation TEXT NOT NULL,
+            rad_id INTEGER,
+            personal_id INTEGER,
+            projekt_id INTEGER,
+            datum TEXT,
+            gammal_timmar REAL,
+            ny_timmar REAL,
+            tidpunkt TEXT DEFAULT CURRENT_TIMESTAMP
+        )""",
+    ), "CREATE INDEX IF NOT EXISTS idx_andringslogg_tabell ON andringslogg (tabell, generation)"]
+
+    kolumner = "tabell, operation, rad_id, personal_id, projekt_id, datum, gammal_timmar, ny_timmar"
+    for tabell in tabeller:
+        pid, prid, datum, timmar = _LOGGADE_TABELLER[tabell]
+        def varden(op, rad, gammal, ny):
+            return (f"'{tabell}', '{op}', {rad}.id, {pid.format(r=rad)}, {prid.format(r=rad)}, "
+                    f"{datum.format(r=rad)}, {gammal}, {ny}")
+        insert = varden("I", "NEW", "NULL", timmar.format(r="NEW"))
+        update = varden("U", "NEW", timmar.format(r="OLD"), timmar.format(r="NEW"))
+        delete = varden("D", "OLD", timmar.format(r="OLD"), "NULL")
+
+        for op, handelse, rad_varden in (("i", "INSERT", insert), ("u", "UPDATE", update),
+                                         ("d", "DELETE", delete)):
+            statements.append((
+                f"""CREATE TRIGGER IF NOT EXISTS trg_{tabell}_logg_{op} AFTER {handelse} ON {tabell}
+                BEGIN
+                    INSERT INTO andringslogg ({kolumner}) VALUES ({rad_varden});
+                END""",
+                None,
+            ))
+        statements.append((
+            None,
+            f"""CREATE OR REPLACE FUNCTION tm_logga_{tabell}() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    INSERT INTO andringslogg ({kolumner}) VALUES ({insert});
+                ELSIF TG_OP = 'UPDATE' THEN
+                    INSERT INTO andringslogg ({kolumner}) VALUES ({update});
+                ELSE
+                    INSERT INTO andringslogg ({kolumner}) VALUES ({delete});
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql""",
+        ))
+        statements.append((None, f"DROP TRIGGER IF EXISTS trg_{tabell}_logg ON {tabell}"))
+        statements.append((
+            None,
+            f"""CREATE TRIGGER trg_{tabell}_logg AFTER INSERT OR UPDATE OR DELETE ON {tabell}
+            FOR EACH ROW EXECUTE FUNCTION tm_logga_{tabell}()""",
+        ))
+    return statements
+
+
+# {kalla} är allokering (migrering 3) eller vyn allokering_dag (migrering 4 och framåt)
+_DAGSBELASTNING_SUMMA = """
+    SELECT personal_id, datum, SUM(timmar), COUNT(*)
+    FROM {kalla}
+    WHERE {villkor}
+    GROUP BY personal_id, datum
+"""
+
+
+def _omrakna_dagsbelastning(villkor, kalla):
+    """SQL som räknar om dagsbelastning för raderna som matchar villkor."""
+    return (f"DELETE FROM dagsbelastning WHERE {villkor};\n"
+            f"INSERT INTO dagsbelastning (personal_id, datum, timmar, antal_projekt) "
+            f"{_DAGSBELASTNING_SUMMA.format(kalla=kalla, villkor=villkor)};")
+
+
+def _dagsbelastning_statements():
+    """CREATE-satser för dagsbelastning (timmar och antal projekt per person och dag)
+    och triggers på allokering som räknar om de berörda nycklarna i samma transaktion."""
+    def omrakna(rad):
+        return _omrakna_dagsbelastning(f"personal_id = {rad}.personal_id AND datum = {rad}.datum",
+                                       "allokering")
+
+    statements = [
+        """CREATE TABLE IF NOT EXISTS dagsbelastning (
+            personal_id INTEGER NOT NULL,
+            datum TEXT NOT NULL,
+            timmar REAL NOT NULL DEFAULT 0,
+            antal_projekt INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (personal_id, datum)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_dagsbelastning_datum ON dagsbelastning (datum, personal_id, timmar)",
+        "DELETE FROM dagsbelastning",
+        "INSERT INTO dagsbelastning (personal_id, datum, timmar, antal_projekt) "
+        + _DAGSBELASTNING_SUMMA.format(kalla="allokering", villkor="1=1"),
+    ]
+    for op, handelse, rader in (("i", "INSERT", ("NEW",)), ("u", "UPDATE", ("OLD", "NEW")),
+                                ("d", "DELETE", ("OLD",))):
+        statements.append((
+            f"""CREATE TRIGGER IF NOT EXISTS trg_allokering_belastning_{op} AFTER {handelse} ON allokering
+            BEGIN
+                {" ".join(omrakna(r) for r in rader)}
+            END""",
+            None,
+        ))
+    statements.append((
+        None,
+        f"""CREATE OR REPLACE FUNCTION tm_uppdatera_dagsbelastning() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                {omrakna("OLD")}
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                {omrakna("NEW")}
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""",
+    ))
+    statements.append((None, "DROP TRIGGER IF EXISTS trg_allokering_belastning ON allokering"))
+    statements.append((
+        None,
+        """CREATE TRIGGER trg_allokering_belastning AFTER INSERT OR UPDATE OR DELETE ON allokering
+        FOR EACH ROW EXECUTE FUNCTION tm_uppdatera_dagsbelastning()""",
+    ))
+    return statements
+
+
+# Dagsallokeringar och perioder utvidgade till arbetsdagar. En rad i allokering
+# går före perioden för samma person, projekt och dag; timmar = 0 stryker dagen.
+# Vyn från migrering 4; migrering 5 lägger till regeldagar (_allokering_dag_vy).
+_ALLOKERING_DAG_VY = """
+    SELECT a.id, a.personal_id, a.projekt_id, a.datum, a.timmar
+    FROM allokering a
+    WHERE a.timmar > 0
+    UNION ALL
+    SELECT NULL, ap.personal_id, ap.projekt_id, k.datum, ap.timmar
+    FROM allokeringsperiod ap
+    JOIN arbetsdagskalender k ON k.datum >= ap.start_datum AND k.datum <= ap.slut_datum
+    WHERE NOT EXISTS (
+        SELECT 1 FROM allokering a
+        WHERE a.personal_id = ap.personal_id AND a.projekt_id = ap.projekt_id AND a.datum = k.datum
+    )
+"""
+
+
+def _omrakna_dag(rad):
+    """Räkna om dagsbelastning från allokering_dag för radens person och dag."""
+    return _omrakna_dagsbelastning(f"personal_id = {rad}.personal_id AND datum = {rad}.datum",
+                                   "allokering_dag")
+
+
+def _omrakna_intervall(rad):
+    """Räkna om dagsbelastning från allokering_dag för radens person i
+    start_datum..slut_datum (perioder och regler)."""
+    return _omrakna_dagsbelastning(f"personal_id = {rad}.personal_id AND datum >= {rad}.start_datum "
+                                   f"AND datum <= {rad}.slut_datum", "allokering_dag")
+
+
+def _allokeringsperiod_statements():
+    """CREATE-satser för allokeringsperiod, arbetsdagskalender och vyn allokering_dag.
+    dagsbelastning räknas därefter från vyn: triggers på allokering räknar om
+    personens dag, triggers på allokeringsperiod personens hela period."""
+    statements = [
+        "CREATE TABLE IF NOT EXISTS arbetsdagskalender (datum TEXT PRIMARY KEY)",
+        (
+            """CREATE TABLE IF NOT EXISTS allokeringsperiod (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                personal_id INTEGER NOT NULL,
+                projekt_id INTEGER NOT NULL,
+                start_datum TEXT NOT NULL,
+                slut_datum TEXT NOT NULL,
+                timmar REAL NOT NULL,
+                FOREIGN KEY (personal_id) REFERENCES personal(id) ON DELETE CASCADE,
+                FOREIGN KEY (projekt_id) REFERENCES projekt(id) ON DELETE CASCADE,
+                CHECK (start_datum <= slut_datum)
+            )""",
+            """CREATE TABLE IF NOT EXISTS allokeringsperiod (
+                id SERIAL PRIMARY KEY,
+                personal_id INTEGER NOT NULL,
+                projekt_id INTEGER NOT NULL,
+                start_datum TEXT NOT NULL,
+                slut_datum TEXT NOT NULL,
+                timmar REAL NOT NULL,
+                FOREIGN KEY (personal_id) REFERENCES personal(id) ON DELETE CASCADE,
+                FOREIGN KEY (projekt_id) REFERENCES projekt(id) ON DELETE CASCADE,
+                CHECK (start_datum <= slut_datum)
+            )""",
+        ),
+        "CREATE INDEX IF NOT EXISTS idx_allokeringsperiod_person "
+        "ON allokeringsperiod (personal_id, projekt_id, start_datum, slut_datum)",
+        "CREATE INDEX IF NOT EXISTS idx_allokeringsperiod_datum "
+        "ON allokeringsperiod (start_datum, slut_datum)",
+        (f"CREATE VIEW IF NOT EXISTS allokering_dag AS {_ALLOKERING_DAG_VY}",
+         f"CREATE OR REPLACE VIEW allokering_dag AS {_ALLOKERING_DAG_VY}"),
+    ] + _andringslogg_statements(["allokeringsperiod"])
+
+    # Triggers på allokering: samma som i migrering 3 men räknat från vyn
+    for op, handelse, rader in (("i", "INSERT", ("NEW",)), ("u", "UPDATE", ("OLD", "NEW")),
+                                ("d", "DELETE", ("OLD",))):
+        statements.append((f"DROP TRIGGER IF EXISTS trg_allokering_belastning_{op}", None))
+        statements.append((
+            f"""CREATE TRIGGER trg_allokering_belastning_{op} AFTER {handelse} ON allokering
+            BEGIN
+                {" ".join(_omrakna_dag(r) for r in rader)}
+            END""",
+            None,
+        ))
+        statements.append((
+            f"""CREATE TRIGGER IF NOT EXISTS trg_allokeringsperiod_belastning_{op}
+            AFTER {handelse} ON allokeringsperiod
+            BEGIN
+                {" ".join(_omrakna_intervall(r) for r in rader)}
+            END""",
+            None,
+        ))
+    for funktion, omrakna in (("tm_uppdatera_dagsbelastning", _omrakna_dag),
+                              ("tm_uppdatera_dagsbelastning_period", _omrakna_intervall)):
+        statements.append((
+            None,
+            f"""CREATE OR REPLACE FUNCTION {funktion}() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    {omrakna("OLD")}
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    {omrakna("NEW")}
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql""",
+        ))
+    statements.append((None, "DROP TRIGGER IF EXISTS trg_allokeringsperiod_belastning ON allokeringsperiod"))
+    statements.append((
+        None,
+        """CREATE TRIGGER trg_allokeringsperiod_belastning AFTER INSERT OR UPDATE OR DELETE
+        ON allokeringsperiod FOR EACH ROW EXECUTE FUNCTION tm_uppdatera_dagsbelastning_period()""",
+    ))
+    return statements
+
+
+def _regeldag_sql(datum, postgres=None):
+    """SQL-villkor för att datum (ISO-sträng) är en förekomst av regeln r:
+    ett helt antal intervall från r.start_datum. postgres=None väljer efter
+    aktiv databas. PostgreSQL får MOD() eftersom % är psycopg2:s platshållare."""
+    if _USE_POSTGRES if postgres is None else postgres:
+        return f"MOD(CAST({datum} AS DATE) - CAST(r.start_datum AS DATE), 7 * r.intervall_veckor) = 0"
+    return f"CAST(julianday({datum}) - julianday(r.start_datum) AS INTEGER) % (7 * r.intervall_veckor) = 0"
+
+
+def _ingen_franvaro_sql(personal_id, datum, arkiv=True):
+    """SQL-villkor för att personen inte har frånvaro datumet. arkiv=False
+    (migrering 5 och 6) tittar bara i franvaro; från migrering 8 även i arkivet."""
+    villkor = f"""NOT EXISTS (
+        SELECT 1 FROM franvaro f WHERE f.personal_id = {personal_id} AND f.datum = {datum}
+      )"""
+    if arkiv:
+        villkor += f"""
+      AND NOT EXISTS (
+        SELECT 1 FROM franvaro_arkiv fa WHERE fa.datum = {datum} AND fa.personal_id = {personal_id}
+      )"""
+    return villkor
+
+
+def _allokering_dag_vy(postgres, arkiverad_franvaro=False):
+    """Vyn allokering_dag från migrering 5: som _ALLOKERING_DAG_VY plus regeldagar.
+    En regel gäller var intervall_veckor:e vecka räknat från start_datum (som
+    alltid är en förekomst), bara på arbetsdagar och inte när personen har
+    frånvaro (med arkiverad_franvaro även arkiverad, migrering 8). Dagsrader och
+    perioder för samma person, projekt och dag går före."""
+    return _ALLOKERING_DAG_VY + f"""
+    UNION ALL
+    SELECT NULL, r.personal_id, r.projekt_id, k.datum, r.timmar
+    FROM allokeringsregel r
+    JOIN arbetsdagskalender k ON k.datum >= r.start_datum AND k.datum <= r.slut_datum
+    WHERE {_regeldag_sql("k.datum", postgres)}
+      AND {_ingen_franvaro_sql("r.personal_id", "k.datum", arkiv=arkiverad_franvaro)}
+      AND NOT EXISTS (
+        SELECT 1 FROM allokering a
+        WHERE a.personal_id = r.personal_id AND a.projekt_id = r.projekt_id AND a.datum = k.datum
+      )
+      AND NOT EXISTS (
+        SELECT 1 FROM allokeringsperiod ap
+        WHERE ap.personal_id = r.personal_id AND ap.projekt_id = r.projekt_id
+          AND ap.start_datum <= k.datum AND ap.slut_datum >= k.datum
+      )
+"""
+
+
+def _allokeringsregel_statements():
+    """CREATE-satser för allokeringsregel och vyn allokering_dag med regeldagar.
+    dagsbelastning räknas om för personens regelintervall vid ändrad regel och
+    för personens dag vid ändrad frånvaro (bara om personen har regler)."""
+    statements = [
+        (
+            """CREATE TABLE IF NOT EXISTS allokeringsregel (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                personal_id INTEGER NOT NULL,
+                projekt_id INTEGER NOT NULL,
+                veckodag INTEGER NOT NULL,
+                intervall_veckor INTEGER NOT NULL DEFAULT 1,
+                start_datum TEXT NOT NULL,
+                slut_datum TEXT NOT NULL,
+                timmar REAL NOT NULL,
+                FOREIGN KEY (personal_id) REFERENCES personal(id) ON DELETE CASCADE,
+                FOREIGN KEY (projekt_id) REFERENCES projekt(id) ON DELETE CASCADE,
+                CHECK (veckodag BETWEEN 0 AND 4),
+                CHECK (intervall_veckor >= 1),
+                CHECK (start_datum <= slut_datum)
+            )""",
+            """CREATE TABLE IF NOT EXISTS allokeringsregel (
+                id SERIAL PRIMARY KEY,
+                personal_id INTEGER NOT NULL,
+                projekt_id INTEGER NOT NULL,
+                veckodag INTEGER NOT NULL,
+                intervall_veckor INTEGER NOT NULL DEFAULT 1,
+                start_datum TEXT NOT NULL,
+                slut_datum TEXT NOT NULL,
+                timmar REAL NOT NULL,
+                FOREIGN KEY (personal_id) REFERENCES personal(id) ON DELETE CASCADE,
+                FOREIGN KEY (projekt_id) REFERENCES projekt(id) ON DELETE CASCADE,
+                CHECK (veckodag BETWEEN 0 AND 4),
+                CHECK (intervall_veckor >= 1),
+                CHECK (start_datum <= slut_datum)
+            )""",
+        ),
+        "CREATE INDEX IF NOT EXISTS idx_allokeringsregel_person "
+        "ON allokeringsregel (personal_id, projekt_id, start_datum, slut_datum)",
+        ("DROP VIEW IF EXISTS allokering_dag", None),
+        (f"CREATE VIEW allokering_dag AS {_allokering_dag_vy(False)}",
+         f"CREATE OR REPLACE VIEW allokering_dag AS {_allokering_dag_vy(True)}"),
+    ] + _andringslogg_statements(["allokeringsregel"])
+
+    for op, handelse, rader in (("i", "INSERT", ("NEW",)), ("u", "UPDATE", ("OLD", "NEW")),
+                                ("d", "DELETE", ("OLD",))):
+        statements.append((
+            f"""CREATE TRIGGER IF NOT EXISTS trg_allokeringsregel_belastning_{op}
+            AFTER {handelse} ON allokeringsregel
+            BEGIN
+                {" ".join(_omrakna_intervall(r) for r in rader)}
+            END""",
+            None,
+        ))
+        har_regel = " OR ".join(f"EXISTS (SELECT 1 FROM allokeringsregel WHERE personal_id = {r}.personal_id)"
+                                for r in rader)
+        statements.append((
+            f"""CREATE TRIGGER IF NOT EXISTS trg_franvaro_belastning_{op}
+            AFTER {handelse} ON franvaro
+            WHEN {har_regel}
+            BEGIN
+                {" ".join(_omrakna_dag(r) for r in rader)}
+            END""",
+            None,
+        ))
+    # Regler har samma intervallkolumner som perioder och återanvänder deras funktion
+    statements.append((None, "DROP TRIGGER IF EXISTS trg_allokeringsregel_belastning ON allokeringsregel"))
+    statements.append((
+        None,
+        """CREATE TRIGGER trg_allokeringsregel_belastning AFTER INSERT OR UPDATE OR DELETE
+        ON allokeringsregel FOR EACH ROW EXECUTE FUNCTION tm_uppdatera_dagsbelastning_period()""",
+    ))
+    statements.append((
+        None,
+        f"""CREATE OR REPLACE FUNCTION tm_uppdatera_dagsbelastning_franvaro() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                IF EXISTS (SELECT 1 FROM allokeringsregel WHERE personal_id = OLD.personal_id) THEN
+                    {_omrakna_dag("OLD")}
+                END IF;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                IF EXISTS (SELECT 1 FROM allokeringsregel WHERE personal_id = NEW.personal_id) THEN
+                    {_omrakna_dag("NEW")}
+                END IF;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""",
+    ))
+    statements.append((None, "DROP TRIGGER IF EXISTS trg_franvaro_belastning ON franvaro"))
+    statements.append((
+        None,
+        """CREATE TRIGGER trg_franvaro_belastning AFTER INSERT OR UPDATE OR DELETE
+        ON franvaro FOR EACH ROW EXECUTE FUNCTION tm_uppdatera_dagsbelastning_franvaro()""",
+    ))
+    return statements
+
+
+# Arkiverad frånvaro läses tillsammans med franvaro; en rad i franvaro går före.
+_FRANVARO_DAG_VY = """
+    SELECT f.id, f.personal_id, f.datum, f.typ, f.notering
+    FROM franvaro f
+    UNION ALL
+    SELECT NULL, h.personal_id, h.datum, h.typ, h.notering
+    FROM franvaro_arkiv h
+    WHERE NOT EXISTS (
+        SELECT 1 FROM franvaro f WHERE f.personal_id = h.personal_id AND f.datum = h.datum
+    )
+"""
+
+
+def _allokering_dag_vy_arkiv(postgres, arkiverad_franvaro=False):
+    """Vyn allokering_dag från migrering 6: som _allokering_dag_vy plus arkivet.
+    Arkivet har gällande timmar per dag; en dagsrad för samma nyckel går före.
+    Perioder och regler når aldrig in i arkiverade dagar (_skriv_period och
+    _skriv_regel tar bort arkivraderna de ersätter)."""
+    return _allokering_dag_vy(postgres, arkiverad_franvaro) + """
+    UNION ALL
+    SELECT NULL, h.personal_id, h.projekt_id, h.datum, h.timmar
+    FROM allokering_arkiv h
+    WHERE NOT EXISTS (
+        SELECT 1 FROM allokering a
+        WHERE a.personal_id = h.personal_id AND a.projekt_id = h.projekt_id AND a.datum = h.datum
+    )
+"""
+
+
+def _arkiv_statements():
+    """CREATE-satser för allokering_arkiv, franvaro_arkiv och vyerna som läser dem.
+    Arkivtabellerna har bara primärnyckeln (datum först, för intervallfrågor),
+    inga triggers och ingen ändringslogg; i SQLite WITHOUT ROWID."""
+    return [
+        (
+            """CREATE TABLE IF NOT EXISTS allokering_arkiv (
+                datum TEXT NOT NULL,
+                personal_id INTEGER NOT NULL,
+                projekt_id INTEGER NOT NULL,
+                timmar REAL NOT NULL,
+                PRIMARY KEY (datum, personal_id, projekt_id),
+                FOREIGN KEY (personal_id) REFERENCES personal(id) ON DELETE CASCADE,
+                FOREIGN KEY (projekt_id) REFERENCES projekt(id) ON DELETE CASCADE
+            ) WITHOUT ROWID""",
+            """CREATE TABLE IF NOT EXISTS allokering_arkiv (
+                datum TEXT NOT NULL,
+                personal_id INTEGER NOT NULL,
+                projekt_id INTEGER NOT NULL,
+                timmar REAL NOT NULL,
+                PRIMARY KEY (datum, personal_id, projekt_id),
+                FOREIGN KEY (personal_id) REFERENCES personal(id) ON DELETE CASCADE,
+                FOREIGN KEY (projekt_id) REFERENCES projekt(id) ON DELETE CASCADE
+            )""",
+        ),
+        (
+            """CREATE TABLE IF NOT EXISTS franvaro_arkiv (
+                datum TEXT NOT NULL,
+                personal_id INTEGER NOT NULL,
+                typ TEXT NOT NULL,
+                notering TEXT DEFAULT '',
+                PRIMARY KEY (datum, personal_id),
+                FOREIGN KEY (personal_id) REFERENCES personal(id) ON DELETE CASCADE
+            ) WITHOUT ROWID""",
+            """CREATE TABLE IF NOT EXISTS franvaro_arkiv (
+                datum TEXT NOT NULL,
+                personal_id INTEGER NOT NULL,
+                typ TEXT NOT NULL,
+                notering TEXT DEFAULT '',
+                PRIMARY KEY (datum, personal_id),
+                FOREIGN KEY (personal_id) REFERENCES personal(id) ON DELETE CASCADE
+            )""",
+        ),
+        ("DROP VIEW IF EXISTS allokering_dag", None),
+        (f"CREATE VIEW allokering_dag AS {_allokering_dag_vy_arkiv(False)}",
+         f"CREATE OR REPLACE VIEW allokering_dag AS {_allokering_dag_vy_arkiv(True)}"),
+        (f"CREATE VIEW IF NOT EXISTS franvaro_dag AS {_FRANVARO_DAG_VY}",
+         f"CREATE OR REPLACE VIEW franvaro_dag AS {_FRANVARO_DAG_VY}"),
+    ]
+
+
+def _arkiverad_franvaro_statements():
+    """Migrering 8: arkiverad frånvaro stryker regeldagar precis som frånvaro i
+    franvaro. Vyn allokering_dag byts, franvaro_arkiv får samma
+    dagsbelastning-triggers som franvaro och redan arkiverade frånvarodagar
+    räknas om."""
+    statements = [
+        ("DROP VIEW IF EXISTS allokering_dag", None),
+        (f"CREATE VIEW allokering_dag AS {_allokering_dag_vy_arkiv(False, True)}",
+         f"CREATE OR REPLACE VIEW allokering_dag AS {_allokering_dag_vy_arkiv(True, True)}"),
+    ]
+    for op, handelse, rader in (("i", "INSERT", ("NEW",)), ("u", "UPDATE", ("OLD", "NEW")),
+                                ("d", "DELETE", ("OLD",))):
+        har_regel = " OR ".join(f"EXISTS (SELECT 1 FROM allokeringsregel WHERE personal_id = {r}.personal_id)"
+                                for r in rader)
+        statements.append((
+            f"""CREATE TRIGGER IF NOT EXISTS trg_franvaro_arkiv_belastning_{op}
+            AFTER {handelse} ON franvaro_arkiv
+            WHEN {har_regel}
+            BEGIN
+                {" ".join(_omrakna_dag(r) for r in rader)}
+            END""",
+            None,
+        ))
+    statements.append((None, "DROP TRIGGER IF EXISTS trg_franvaro_arkiv_belastning ON franvaro_arkiv"))
+    statements.append((
+        None,
+        """CREATE TRIGGER trg_franvaro_arkiv_belastning AFTER INSERT OR UPDATE OR DELETE
+        ON franvaro_arkiv FOR EACH ROW EXECUTE FUNCTION tm_uppdatera_dagsbelastning_franvaro()""",
+    ))
+    berorda = "(personal_id, datum) IN (SELECT personal_id, datum FROM franvaro_arkiv)"
+    statements.append(f"DELETE FROM dagsbelastning WHERE {berorda}")
+    statements.append("INSERT INTO dagsbelastning (personal_id, datum, timmar, antal_projekt) "
+                      + _DAGSBELASTNING_SUMMA.format(kalla="allokering_dag", villkor=berorda))
+    return statements
+
+
+# Nyckel (klass) för pg_advisory_xact_lock per person när dagsbelastning räknas om
+_BELASTNINGSLAS_PG = 7_310_032
+_UPSERT_DAGSBELASTNING_PG = ("ON CONFLICT (personal_id, datum) DO UPDATE "
+                             "SET timmar = EXCLUDED.timmar, antal_projekt = EXCLUDED.antal_projekt")
+
+
+def _omrakna_dagsbelastning_pg(villkor, rad):
+    """Som _omrakna_dagsbelastning, men för PostgreSQL-triggers som kan köra
+    samtidigt i flera transaktioner: ett transaktionslås per person gör att
+    summan läses först när en annan transaktion som räknar om samma person har
+    committat, och ON CONFLICT tar hand om nycklar som hunnit skrivas ändå."""
+    return (f"PERFORM pg_advisory_xact_lock({_BELASTNINGSLAS_PG}, {rad}.personal_id);\n"
+            f"DELETE FROM dagsbelastning WHERE {villkor};\n"
+            f"INSERT INTO dagsbelastning (personal_id, datum, timmar, antal_projekt) "
+            f"{_DAGSBELASTNING_SUMMA.format(kalla='allokering_dag', villkor=villkor)} "
+            f"{_UPSERT_DAGSBELASTNING_PG};")
+
+
+def _samtidig_belastning_statements():
+    """Migrering 9 (bara PostgreSQL): dagsbelastning-triggerfunktionerna låser
+    personen och upsertar, så att två transaktioner som skriver samma
+    person-dag inte krockar på primärnyckeln. SQLite serialiserar skrivningar."""
+    def dag(rad):
+        return _omrakna_dagsbelastning_pg(
+            f"personal_id = {rad}.personal_id AND datum = {rad}.datum", rad)
+
+    def intervall(rad):
+        return _omrakna_dagsbelastning_pg(
+            f"personal_id = {rad}.personal_id AND datum >= {rad}.start_datum "
+            f"AND datum <= {rad}.slut_datum", rad)
+
+    def har_regel(rad):
+        return f"EXISTS (SELECT 1 FROM allokeringsregel WHERE personal_id = {rad}.personal_id)"
+
+    def funktion(namn, omrakna, forvillkor="", villkor=None):
+        gren = {r: (f"IF {villkor(r)} THEN {omrakna(r)} END IF;" if villkor else omrakna(r))
+                for r in ("OLD", "NEW")}
+        return (None, f"""CREATE OR REPLACE FUNCTION {namn}() RETURNS trigger AS $$
+        BEGIN
+            {forvillkor}
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                {gren["OLD"]}
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                {gren["NEW"]}
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""")
+
+    return [
+        funktion("tm_uppdatera_dagsbelastning", dag,
+                 forvillkor=f"IF current_setting('{_PAUS_INSTALLNING_PG}', true) = 'on' THEN "
+                            f"RETURN NULL; END IF;"),
+        funktion("tm_uppdatera_dagsbelastning_period", intervall),
+        funktion("tm_uppdatera_dagsbelastning_franvaro", dag, villkor=har_regel),
+    ]
+
+
+# Stora batchskrivningar på allokering pausar dagsbelastning-triggern inom sin
+# transaktion och räknar om de berörda dagarna i efterhand (_pausa_dagsbelastning).
+# SQLite: en rad i dagsbelastning_paus, som bara syns i den egna transaktionen.
+# PostgreSQL: inställningen teammanager.paus_belastning satt med set_config(..., true).
+_PAUS_INSTALLNING_PG = "teammanager.paus_belastning"
+
+
+def _pausbar_belastning_statements():
+    """Migrering 7: triggern som räknar om dagsbelastning vid ändrad allokering
+    hoppar över raden medan belastningen är pausad."""
+    statements = [("CREATE TABLE IF NOT EXISTS dagsbelastning_paus (id INTEGER PRIMARY KEY)", None)]
+    for op, handelse, rader in (("i", "INSERT", ("NEW",)), ("u", "UPDATE", ("OLD", "NEW")),
+                                ("d", "DELETE", ("OLD",))):
+        statements.append((f"DROP TRIGGER IF EXISTS trg_allokering_belastning_{op}", None))
+        statements.append((
+            f"""CREATE TRIGGER trg_allokering_belastning_{op} AFTER {handelse} ON allokering
+            WHEN NOT EXISTS (SELECT 1 FROM dagsbelastning_paus)
+            BEGIN
+                {" ".join(_omrakna_dag(r) for r in rader)}
+            END""",
+            None,
+        ))
+    statements.append((
+        None,
+        f"""CREATE OR REPLACE FUNCTION tm_uppdatera_dagsbelastning() RETURNS trigger AS $$
+        BEGIN
+            IF current_setting('{_PAUS_INSTALLNING_PG}', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                {_omrakna_dag("OLD")}
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                {_omrakna_dag("NEW")}
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""",
+    ))
+    return statements
+
+
+def _andringslogg_xid_statements():
+    """Migrering 10 (bara PostgreSQL): varje loggpost får skrivande transaktions
+    id (txid_current()), så att en konsument kan läsa om allt från transaktioner
+    som pågick vid förra läsningen (se hamta_synkhorisont). I SQLite blir
+    generationerna synliga i commit-ordning. Kolumnen läggs till utan standardvärde
+    och får det i ett separat steg, så att befintliga rader inte skrivs om."""
+    return [
+        (None, "ALTER TABLE andringslogg ADD COLUMN IF NOT EXISTS xid BIGINT"),
+        (None, "ALTER TABLE andringslogg ALTER COLUMN xid SET DEFAULT txid_current()"),
+        (None, "CREATE INDEX IF NOT EXISTS idx_andringslogg_xid ON andringslogg (xid)"),
+    ]
+
+
+# Ordnade migreringar: (version, beskrivning, statements).
+# Ett statement är antingen en sträng som fungerar i båda databaserna
+# eller en tupel (sqlite_sql, postgres_sql) när syntaxen skiljer sig;
+# None i tupeln betyder att steget inte behövs i den databasen.
+# Lägg alltid till nya steg sist med nästa versionsnummer — ändra aldrig ett
+# steg som redan har körts i produktion.
+_MIGRERINGAR = [
+    (1, "Index för datumintervall på allokering, franvaro och kommentarer", [
+        # (personal_id, datum) på franvaro/kommentarer täcks redan av UNIQUE-indexet,
+        # men franvaro får ett täckande index inklusive typ för ar_franvarande().
+        "CREATE INDEX IF NOT EXISTS idx_allokering_datum_person "
+        "ON allokering (datum, personal_id, projekt_id, timmar)",
+        "CREATE INDEX IF NOT EXISTS idx_allokering_person_datum "
+        "ON allokering (personal_id, datum, projekt_id, timmar)",
+        "CREATE INDEX IF NOT EXISTS idx_franvaro_datum_person "
+        "ON franvaro (datum, personal_id, typ)",
+        "CREATE INDEX IF NOT EXISTS idx_franvaro_person_datum "
+        "ON franvaro (personal_id, datum, typ)",
+        "CREATE INDEX IF NOT EXISTS idx_kommentarer_datum_person "
+        "ON kommentarer (datum, personal_id)",
+    ]),
+    (2, "Ändringslogg (andringslogg) som fylls av triggers på alla tabeller",
+     _andringslogg_statements(["allokering", "franvaro", "kommentarer", "kompetenser",
+                               "personal", "projekt"])),
+    (3, "Materialiserad dagsbelastning per person och dag, underhållen av triggers",
+     _dagsbelastning_statements()),
+    (4, "Allokeringsperioder, arbetsdagskalender och vyn allokering_dag",
+     _allokeringsperiod_statements()),
+    (5, "Återkommande allokeringsregler i vyn allokering_dag",
+     _allokeringsregel_statements()),
+    (6, "Arkivtabeller för allokering och frånvaro, lästa via allokering_dag och franvaro_dag",
+     _arkiv_statements()),
+    (7, "Pausbar dagsbelastning-trigger på allokering för stora batchskrivningar",
+     _pausbar_belastning_statements()),
+    (8, "Arkiverad frånvaro stryker regeldagar i allokering_dag",
+     _arkiverad_franvaro_statements()),
+    (9, "Samtidiga omräkningar av dagsbelastning i PostgreSQL: lås per person och upsert",
+     _samtidig_belastning_statements()),
+    (10, "Transaktions-id i andringslogg för synk utan missade sena commits",
+     _andringslogg_xid_statements()),
+]
+
+# Nyckel för pg_advisory_xact_lock så att två processer inte migrerar samtidigt
+_MIGRERINGSLAS_PG = 7_310_031
+
+_init_las = threading.Lock()
+_initierad_for = None
+
+
+def _kor_migreringar(conn):
+    """Kör alla migreringar som är nyare än databasens schema_version."""
     if _USE_POSTGRES:
-        cursor = conn.cursor()
-        for stmt in _CREATE_TABLES_PG:
-            cursor.execute(stmt)
-        conn.commit()
-        cursor.close()
-    else:
-        cursor = conn.cursor()
-        cursor.executescript(_CREATE_TABLES_SQLITE)
+        conn.execute("SELECT pg_advisory_xact_lock(%s)", (_MIGRERINGSLAS_PG,))
+    row = conn.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_version").fetchone()
+    nuvarande = row["version"]
+
+    for version, beskrivning, statements in _MIGRERINGAR:
+        if version <= nuvarande:
+            continue
+        for stmt in statements:
+            if isinstance(stmt, tuple):
+                stmt = stmt[1] if _USE_POSTGRES else stmt[0]
+            if stmt is not None:
+                conn.execute(stmt)
+        conn.execute(
+            _q("INSERT INTO schema_version (version, beskrivning) VALUES (?, ?)"),
+            (version, beskrivning)
+        )
         conn.commit()
+        if _USE_POSTGRES:
+            # Låset släpps vid commit — ta det igen inför nästa steg
+            conn.execute("SELECT pg_advisory_xact_lock(%s)", (_MIGRERINGSLAS_PG,))
+    conn.commit()
+
+
+def hamta_schemaversion():
+    """Returnera senast applicerade migreringsversion (0 om inga körts)."""
+    conn = get_connection()
+    row = conn.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_version").fetchone()
     conn.close()
+    return row["version"]
+
+
+def init_db(tvinga=False):
+    """Skapa alla tabeller om de inte redan finns och kör väntande migreringar.
+    Körs en gång per process och databas; efterföljande anrop är gratis
+    om inte tvinga=True.
+    """
+    global _initierad_for
+    mal = _SUPABASE_DB_URL if _USE_POSTGRES else DB_PATH
+    if _initierad_for == mal and not tvinga:
+        return
+    with _init_las:
+        if _initierad_for == mal and not tvinga:
+            return
+        conn = get_connection()
+        try:
+            if _USE_POSTGRES:
+                cursor = conn.cursor()
+                for stmt in _CREATE_TABLES_PG:
+                    cursor.execute(stmt)
+                conn.commit()
+                cursor.close()
+            else:
+                cursor = conn.cursor()
+                cursor.executescript(_CREATE_TABLES_SQLITE)
+                conn.commit()
+            _kor_migreringar(conn)
+            _sakerstall_standardkalender(conn)
+            _rensa_gammal_andringslogg(conn, ANDRINGSLOGG_DAGAR)
+            conn.commit()
+        finally:
+            conn.close()
+        if _initierad_for is not None:
+            rensa_cache()
+        _initierad_for = mal
+
+
+# ============================================================
+# ÄNDRINGSLOGG
+# ============================================================
+# andringslogg fylls av triggers (migrering 2) vid varje INSERT/UPDATE/DELETE
+# på de tabeller som finns i _LOGGADE_TABELLER, oavsett vilken funktion eller
+# process som skriver. generation är loggens växande primärnyckel.
+
+def hamta_generation():
+    """Senaste generationsnummer i ändringsloggen (0 om loggen är tom).
+    Billig att anropa: MAX över primärnyckeln läses direkt ur indexet."""
+    conn = get_connection()
+    row = conn.execute("SELECT COALESCE(MAX(generation), 0) AS generation FROM andringslogg").fetchone()
+    conn.close()
+    return row["generation"]
+
+
+def hamta_synkhorisont():
+    """Horisont att skicka till nästa hamta_andringar_sedan(): i PostgreSQL id:t
+    för den äldsta transaktion som fortfarande pågår, None i SQLite. Hämtas
+    *före* läsningen av loggen — allt från transaktioner med lägre id var då
+    redan avslutat och syns i läsningen."""
+    if not _USE_POSTGRES:
+        return None
+    conn = get_connection()
+    row = conn.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()) AS horisont").fetchone()
+    conn.close()
+    return row["horisont"]
+
+
+def hamta_andringar_sedan(generation, tabeller=None, max_antal=None, horisont=None):
+    """Ändringar med generation > `generation`, äldst först, som list[dict] med
+    generation, tabell, operation ('I'/'U'/'D'), rad_id, personal_id, projekt_id,
+    datum, gammal_timmar, ny_timmar och tidpunkt.
+
+    I PostgreSQL delas generationer ut vid INSERT men syns först vid commit, så en
+    samtidig transaktion kan bli synlig med ett lägre nummer än det senast lästa.
+    Med `horisont` från hamta_synkhorisont() vid förra läsningen kommer också alla
+    poster från transaktioner som då inte var avslutade med, oavsett generation;
+    konsumenten får själv hålla reda på vilka av dem den redan har sett.
+    """
+    query = "SELECT * FROM andringslogg WHERE generation > ?"
+    params = [generation]
+    if horisont is not None and _USE_POSTGRES:
+        query = "SELECT * FROM andringslogg WHERE (generation > ? OR xid >= ?)"
+        params.append(horisont)
+    if tabeller:
+        query += f" AND tabell IN ({', '.join(['?'] * len(tabeller))})"
+        params.extend(tabeller)
+    query += " ORDER BY generation"
+    if max_antal:
+        query += " LIMIT ?"
+        params.append(int(max_antal))
+    conn = get_connection()
+    rows = conn.execute(_q(query), params).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+def rensa_andringslogg(till_generation):
+    """Ta bort loggposter med generation <= till_generation, t.ex. när alla
+    konsumenter har kommit ikapp. Returnerar antal borttagna poster."""
+    with anslutning() as conn:
+        cursor = conn.execute(_q("DELETE FROM andringslogg WHERE generation <= ?"), (till_generation,))
+        return cursor.rowcount
+
+
+def _rensa_gammal_andringslogg(conn, dagar):
+    """Ta bort loggposter äldre än `dagar` dagar. tidpunkt är text i ISO-format,
+    så gränsen jämförs som sträng; poster utan tidpunkt lämnas kvar."""
+    grans = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - dagar * 86400))
+    cursor = conn.execute(_q("DELETE FROM andringslogg WHERE tidpunkt < ?"), (grans,))
+    return cursor.rowcount
+
+
+def rensa_gammal_andringslogg(dagar=None):
+    """Ta bort loggposter äldre än `dagar` dagar (standard ANDRINGSLOGG_DAGAR).
+    Körs av init_db() och periodiskt av allokeringsmotorn; en konsument som inte
+    har läst loggen på så länge måste läsa om allt. Returnerar antal borttagna poster."""
+    with anslutning() as conn:
+        return _rensa_gammal_andringslogg(conn, ANDRINGSLOGG_DAGAR if dagar is None else dagar)
+
+
+# ============================================================
+# BULK-SKRIVNING
+# ============================================================
+
+def _unika_pa_nyckel(rader, nyckel_index):
+    """Behåll sista raden per konfliktnyckel — ON CONFLICT DO UPDATE i PostgreSQL
+    tillåter inte att samma rad träffas två gånger i ett statement."""
+    unika = {}
+    for rad in rader:
+        unika[tuple(rad[i] for i in nyckel_index)] = rad
+    return list(unika.values())
+
+
+def _bulk_upsert(conn, tabell, kolumner, konflikt, rader, uppdatera=()):
+    """Upserta många rader med få rundresor.
+    SQLite: executemany. PostgreSQL: execute_values, eller COPY till en temporär
+    tabell följt av INSERT ... SELECT ... ON CONFLICT när raderna är fler än
+    BULK_COPY_GRANS. `uppdatera` är kolumnerna som skrivs över vid konflikt;
+    tom betyder DO NOTHING. Committar inte.
+    """
+    rader = _unika_pa_nyckel(rader, [kolumner.index(k) for k in konflikt])
+    if not rader:
+        return 0
+    kol_sql = ", ".join(kolumner)
+    if uppdatera:
+        vid_konflikt = (f"ON CONFLICT({', '.join(konflikt)}) DO UPDATE SET "
+                        + ", ".join(f"{k} = excluded.{k}" for k in uppdatera))
+    else:
+        vid_konflikt = f"ON CONFLICT({', '.join(konflikt)}) DO NOTHING"
+
+    if not _USE_POSTGRES:
+        platshallare = ", ".join(["?"] * len(kolumner))
+        conn.executemany(
+            f"INSERT INTO {tabell} ({kol_sql}) VALUES ({platshallare}) {vid_konflikt}", rader
+        )
+    elif len(rader) <= BULK_COPY_GRANS:
+        conn.execute_values(f"INSERT INTO {tabell} ({kol_sql}) VALUES %s {vid_konflikt}", rader)
+    else:
+        stage = f"_bulk_{tabell}"
+        conn.execute(f"DROP TABLE IF EXISTS {stage}")
+        conn.execute(f"CREATE TEMP TABLE {stage} ON COMMIT DROP AS "
+                     f"SELECT {kol_sql} FROM {tabell} WITH NO DATA")
+        buffer = io.StringIO()
+        skrivare = csv.writer(buffer)
+        for rad in rader:
+            skrivare.writerow(["\\N" if v is None else v for v in rad])
+        buffer.seek(0)
+        conn.copy_expert(f"COPY {stage} ({kol_sql}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+        conn.execute(f"INSERT INTO {tabell} ({kol_sql}) SELECT {kol_sql} FROM {stage} {vid_konflikt}")
+    return len(rader)
+
+
+def _pausa_dagsbelastning(conn, paus):
+    """Slå av (paus=True) eller på dagsbelastning-triggern på allokering för resten
+    av transaktionen. Den som pausar räknar om med _omrakna_belastning_for().
+    En rollback återställer pausen i båda databaserna."""
+    if _USE_POSTGRES:
+        conn.execute(_q("SELECT set_config(?, ?, true)"), (_PAUS_INSTALLNING_PG, "on" if paus else "off"))
+    elif paus:
+        conn.execute("INSERT OR IGNORE INTO dagsbelastning_paus (id) VALUES (1)")
+    else:
+        conn.execute("DELETE FROM dagsbelastning_paus")
+
+
+def _omrakna_belastning_for(conn, nycklar):
+    """Räkna om dagsbelastning för (personal_id, datum)-nycklar från allokering_dag:
+    ett intervall per person (första till sista berörda dag), två executemany totalt.
+    Committar inte."""
+    intervall = {}
+    for personal_id, datum in nycklar:
+        datum = str(datum)
+        fran, till = intervall.get(personal_id, (datum, datum))
+        intervall[personal_id] = (min(fran, datum), max(till, datum))
+    if not intervall:
+        return
+    rader = sorted((p, fran, till) for p, (fran, till) in intervall.items())
+    villkor = "personal_id = ? AND datum >= ? AND datum <= ?"
+    upsert = ""
+    if _USE_POSTGRES:
+        # Samma lås per person som triggerna (migrering 9), i personordning
+        conn.executemany(_q(f"SELECT pg_advisory_xact_lock({_BELASTNINGSLAS_PG}, ?)"),
+                         [(p,) for p, _, _ in rader])
+        upsert = " " + _UPSERT_DAGSBELASTNING_PG
+    conn.executemany(_q(f"DELETE FROM dagsbelastning WHERE {villkor}"), rader)
+    conn.executemany(_q(
+        "INSERT INTO dagsbelastning (personal_id, datum, timmar, antal_projekt) "
+        + _DAGSBELASTNING_SUMMA.format(kalla="allokering_dag", villkor=villkor) + upsert
+    ), rader)
+
+
+def _bygg_om_dagsbelastning(conn):
+    """Räkna om hela dagsbelastning från allokering_dag. I PostgreSQL låses
+    tabellen först så att samtidiga triggers väntar och räknar om efteråt.
+    Committar inte."""
+    if _USE_POSTGRES:
+        conn.execute("LOCK TABLE dagsbelastning IN SHARE ROW EXCLUSIVE MODE")
+    conn.execute("DELETE FROM dagsbelastning")
+    conn.execute(
+        "INSERT INTO dagsbelastning (personal_id, datum, timmar, antal_projekt) "
+        + _DAGSBELASTNING_SUMMA.format(kalla="allokering_dag", villkor="1=1")
+    )
+
+
+def _bulk_radera(conn, tabell, nyckelkolumner, nycklar):
+    """Radera många rader identifierade av nyckelkolumner med få rundresor. Committar inte."""
+    nycklar = list(dict.fromkeys(tuple(n) for n in nycklar))
+    if not nycklar:
+        return 0
+    if _USE_POSTGRES:
+        villkor = " AND ".join(f"t.{k} = v.{k}" for k in nyckelkolumner)
+        conn.execute_values(
+            f"DELETE FROM {tabell} t USING (VALUES %s) AS v({', '.join(nyckelkolumner)}) "
+            f"WHERE {villkor}", nycklar
+        )
+    else:
+        villkor = " AND ".join(f"{k} = ?" for k in nyckelkolumner)
+        conn.executemany(f"DELETE FROM {tabell} WHERE {villkor}", nycklar)
+    return len(nycklar)
 
 
 # ============================================================
 # PERSONAL - CRUD
 # ============================================================
 
+@cachad("personal")
 def hamta_all_personal(bara_aktiva=True):
     conn = get_connection()
     if bara_aktiva:
@@ -250,6 +1467,7 @@ def hamta_all_personal(bara_aktiva=True):
     return [dict(r) for r in rows]
 
 
+@invaliderar("personal")
 def lagg_till_personal(namn, roll="", kapacitet_h=8.0):
     conn = get_connection()
     try:
@@ -275,6 +1493,7 @@ def lagg_till_personal(namn, roll="", kapacitet_h=8.0):
         conn.close()
 
 
+@invaliderar("personal")
 def uppdatera_personal(person_id, namn, roll, kapacitet_h, aktiv):
     conn = get_connection()
     try:
@@ -292,17 +1511,46 @@ def uppdatera_personal(person_id, namn, roll, kapacitet_h, aktiv):
         conn.close()
 
 
+@invaliderar("personal", "projekt", "allokering", "kompetenser", "franvaro", "kommentarer")
 def ta_bort_personal(person_id):
-    conn = get_connection()
-    conn.execute(_q("DELETE FROM personal WHERE id=?"), (person_id,))
-    conn.commit()
-    conn.close()
+    with anslutning() as conn:
+        conn.execute(_q("DELETE FROM personal WHERE id=?"), (person_id,))
+
+
+@invaliderar("personal", "kompetenser")
+def satt_personal(poster):
+    """Upserta många medarbetare på namn i en transaktion.
+    poster: iterable av (namn, roll, kapacitet_h, aktiv, taggar); taggar None
+    lämnar kompetenserna orörda, annars ersätts de. Returnerar {namn: id}."""
+    poster = list({p[0].strip(): p for p in poster}.values())
+    if not poster:
+        return {}
+    with anslutning() as conn:
+        _bulk_upsert(conn, "personal", ["namn", "roll", "kapacitet_h", "aktiv"], ["namn"],
+                     [(namn.strip(), roll.strip(), kapacitet_h, int(aktiv))
+                      for namn, roll, kapacitet_h, aktiv, _ in poster],
+                     uppdatera=["roll", "kapacitet_h", "aktiv"])
+        namn = [p[0].strip() for p in poster]
+        ids = {}
+        for i in range(0, len(namn), BULK_SIDSTORLEK):
+            del_namn = namn[i:i + BULK_SIDSTORLEK]
+            rows = conn.execute(
+                _q(f"SELECT id, namn FROM personal WHERE namn IN ({', '.join(['?'] * len(del_namn))})"),
+                del_namn
+            ).fetchall()
+            ids.update({r["namn"]: r["id"] for r in rows})
+        med_taggar = [(ids[p[0].strip()], p[4]) for p in poster if p[4] is not None]
+        _bulk_radera(conn, "kompetenser", ["personal_id"], [(pid,) for pid, _ in med_taggar])
+        _bulk_upsert(conn, "kompetenser", ["personal_id", "tagg"], ["personal_id", "tagg"],
+                     [(pid, t.strip()) for pid, taggar in med_taggar for t in taggar if t.strip()])
+    return ids
 
 
 # ============================================================
 # PROJEKT - CRUD
 # ============================================================
 
+@cachad("projekt")
 def hamta_alla_projekt(bara_aktiva=True):
     conn = get_connection()
     if bara_aktiva:
@@ -313,6 +1561,7 @@ def hamta_alla_projekt(bara_aktiva=True):
     return [dict(r) for r in rows]
 
 
+@invaliderar("projekt")
 def lagg_till_projekt(namn, farg="#3498db", startdatum=None, slutdatum=None):
     conn = get_connection()
     try:
@@ -338,6 +1587,7 @@ def lagg_till_projekt(namn, farg="#3498db", startdatum=None, slutdatum=None):
         conn.close()
 
 
+@invaliderar("projekt")
 def uppdatera_projekt(projekt_id, namn, farg, startdatum, slutdatum, aktiv):
     conn = get_connection()
     try:
@@ -355,24 +1605,57 @@ def uppdatera_projekt(projekt_id, namn, farg, startdatum, slutdatum, aktiv):
         conn.close()
 
 
+@invaliderar("projekt", "allokering")
 def ta_bort_projekt(projekt_id):
-    conn = get_connection()
-    conn.execute(_q("DELETE FROM projekt WHERE id=?"), (projekt_id,))
-    conn.commit()
-    conn.close()
+    with anslutning() as conn:
+        conn.execute(_q("DELETE FROM projekt WHERE id=?"), (projekt_id,))
+
+
+# ============================================================
+# ARBETSDAGSKALENDER
+# ============================================================
+# arbetsdagskalender har en rad per arbetsdag (mån-fre utom svenska röda
+# dagar, enligt calendar_utils) och används av vyn allokering_dag för att
+# utvidga perioder till dagar. Den fylls med hela år och alltid som ett
+# sammanhängande spann, så MIN/MAX räcker för att se vilka år som finns.
+
+def _sakerstall_arbetsdagskalender(conn, fran_ar, till_ar):
+    """Se till att kalendern täcker åren fran_ar..till_ar. Committar inte.
+    Returnerar antal tillagda dagar."""
+    row = conn.execute("SELECT MIN(datum) AS forsta, MAX(datum) AS sista FROM arbetsdagskalender").fetchone()
+    if row["forsta"]:
+        forsta_ar, sista_ar = int(row["forsta"][:4]), int(row["sista"][:4])
+        if forsta_ar <= fran_ar and till_ar <= sista_ar:
+            return 0
+        fran_ar, till_ar = min(fran_ar, forsta_ar), max(till_ar, sista_ar)
+
+    from calendar_utils import hamta_arbetsdagsindex
+    index = hamta_arbetsdagsindex(fran_ar, till_ar)
+    dagar = index.arbetsdagar(date(fran_ar, 1, 1), date(till_ar, 12, 31))
+    return _bulk_upsert(conn, "arbetsdagskalender", ["datum"], ["datum"], [(str(d),) for d in dagar])
+
+
+def _sakerstall_standardkalender(conn):
+    """Kalendern för calendar_utils standardspann runt innevarande år."""
+    from calendar_utils import KALENDER_AR_FORE, KALENDER_AR_EFTER
+    ar = date.today().year
+    return _sakerstall_arbetsdagskalender(conn, ar - KALENDER_AR_FORE, ar + KALENDER_AR_EFTER)
 
 
 # ============================================================
 # ALLOKERING - CRUD
 # ============================================================
 
+@cachad("allokering", "personal", "projekt")
 def hamta_allokeringar(personal_id=None, projekt_id=None, fran_datum=None, till_datum=None):
+    """Allokeringar per dag (vyn allokering_dag: dagsrader och utvidgade perioder).
+    id är None för dagar som kommer från en period."""
     conn = get_connection()
     query = """
         SELECT a.id, a.personal_id, a.projekt_id, a.datum, a.timmar,
                p.namn as personal_namn, pr.namn as projekt_namn, pr.farg as projekt_farg,
                p.kapacitet_h
-        FROM allokering a
+        FROM allokering_dag a
         JOIN personal p ON a.personal_id = p.id
         JOIN projekt pr ON a.projekt_id = pr.id
         WHERE 1=1
@@ -396,86 +1679,622 @@ def hamta_allokeringar(personal_id=None, projekt_id=None, fran_datum=None, till_
     return [dict(r) for r in rows]
 
 
-def satt_allokering(personal_id, projekt_id, datum, timmar):
-    """Upsert allokering. Om timmar <= 0 raderas posten."""
-    conn = get_connection()
-    datum_str = str(datum)
-    if timmar <= 0:
-        conn.execute(
-            _q("DELETE FROM allokering WHERE personal_id=? AND projekt_id=? AND datum=?"),
-            (personal_id, projekt_id, datum_str)
-        )
-    else:
-        conn.execute(_q("""
-            INSERT INTO allokering (personal_id, projekt_id, datum, timmar)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(personal_id, projekt_id, datum)
-            DO UPDATE SET timmar = excluded.timmar
-        """), (personal_id, projekt_id, datum_str, timmar))
-    conn.commit()
-    conn.close()
+def _stromma_rader(query, params=(), sidstorlek=BULK_SIDSTORLEK):
+    """Generator som ger resultatet i sidor om högst sidstorlek rader.
+    SQLite läser med fetchmany(), PostgreSQL via en namngiven server-side cursor,
+    så att hela resultatet aldrig ligger i minnet samtidigt."""
+    with anslutning() as conn:
+        if _USE_POSTGRES:
+            cursor = conn.execute_server("tm_strom", _q(query), params, sidstorlek)
+        else:
+            cursor = conn.execute(query, params)
+        try:
+            while True:
+                rader = cursor.fetchmany(sidstorlek)
+                if not rader:
+                    break
+                yield rader
+        finally:
+            cursor.close()
+
+
+def stromma_tabell(tabell, kolumner=None, sidstorlek=BULK_SIDSTORLEK):
+    """Alla rader i en datatabell sida för sida (se _stromma_rader), sorterade på id.
+    Bara tabellerna i _LOGGADE_TABELLER är tillåtna."""
+    if tabell not in _LOGGADE_TABELLER:
+        raise ValueError(f"Okänd tabell: {tabell}")
+    valda = ", ".join(kolumner) if kolumner else "*"
+    return _stromma_rader(f"SELECT {valda} FROM {tabell} ORDER BY id", (), sidstorlek)
+
+
+def stromma_allokeringar(fran_datum=None, till_datum=None, sidstorlek=BULK_SIDSTORLEK):
+    """Allokeringar som (personal_namn, projekt_namn, datum, timmar) i samma ordning
+    som hamta_allokeringar, sida för sida (se _stromma_rader). Går förbi läscachen."""
+    query = """
+        SELECT p.namn, pr.namn, a.datum, a.timmar
+        FROM allokering_dag a
+        JOIN personal p ON a.personal_id = p.id
+        JOIN projekt pr ON a.projekt_id = pr.id
+        WHERE 1=1
+    """
+    params = []
+    if fran_datum:
+        query += " AND a.datum >= ?"
+        params.append(str(fran_datum))
+    if till_datum:
+        query += " AND a.datum <= ?"
+        params.append(str(till_datum))
+    query += " ORDER BY a.datum, p.namn"
+    return _stromma_rader(query, params, sidstorlek)
+
+
+def stromma_allokeringsdagar(sidstorlek=BULK_SIDSTORLEK):
+    """Alla allokeringar per dag som (personal_id, projekt_id, datum, timmar),
+    sida för sida (se _stromma_rader). Används av allokeringsmotorn."""
+    return _stromma_rader("SELECT personal_id, projekt_id, datum, timmar FROM allokering_dag",
+                          (), sidstorlek)
+
+
+def _gallande_timmar(conn, nycklar, dagsrader=True):
+    """Timmar enligt allokering_dag för (personal_id, projekt_id, datum)-nycklar,
+    i en fråga per BULK_SIDSTORLEK nycklar. Med dagsrader=False räknas bara
+    perioder, regler och arkivet (vad dagen skulle ha utan dagsrad).
+    Returnerar {nyckel: timmar} för nycklar med timmar > 0."""
+    nycklar = list(dict.fromkeys((p, pr, str(d)) for p, pr, d in nycklar))
+    if not nycklar:
+        return {}
+    # Samma företräde som allokering_dag, men som uppslag per nyckel:
+    # en join mot vyn utvidgar alla perioder och regler innan nycklarna matchas.
+    # Arkivet och perioder/regler överlappar aldrig (se _allokering_dag_vy_arkiv).
+    dagsrad = """(SELECT a.timmar FROM allokering a
+                  WHERE a.personal_id = n.personal_id AND a.projekt_id = n.projekt_id
+                    AND a.datum = n.datum),""" if dagsrader else ""
+    resultat = {}
+    for i in range(0, len(nycklar), BULK_SIDSTORLEK):
+        del_nycklar = nycklar[i:i + BULK_SIDSTORLEK]
+        platshallare = ", ".join(["(?, ?, ?)"] * len(del_nycklar))
+        rows = conn.execute(_q(f"""
+            WITH nycklar(personal_id, projekt_id, datum) AS (VALUES {platshallare})
+            SELECT n.personal_id, n.projekt_id, n.datum, COALESCE(
+                {dagsrad}
+                (SELECT ap.timmar FROM allokeringsperiod ap
+                 JOIN arbetsdagskalender k ON k.datum = n.datum
+                 WHERE ap.personal_id = n.personal_id AND ap.projekt_id = n.projekt_id
+                   AND ap.start_datum <= n.datum AND ap.slut_datum >= n.datum),
+                (SELECT r.timmar FROM allokeringsregel r
+                 JOIN arbetsdagskalender k ON k.datum = n.datum
+                 WHERE r.personal_id = n.personal_id AND r.projekt_id = n.projekt_id
+                   AND r.start_datum <= n.datum AND r.slut_datum >= n.datum
+                   AND {_regeldag_sql("n.datum")}
+                   AND {_ingen_franvaro_sql("n.personal_id", "n.datum")}),
+                (SELECT h.timmar FROM allokering_arkiv h
+                 WHERE h.datum = n.datum AND h.personal_id = n.personal_id
+                   AND h.projekt_id = n.projekt_id)
+            ) AS timmar
+            FROM nycklar n
+        """), [v for nyckel in del_nycklar for v in nyckel]).fetchall()
+        resultat.update({(r["personal_id"], r["projekt_id"], r["datum"]): r["timmar"]
+                         for r in rows if r["timmar"] and r["timmar"] > 0})
+    return resultat
 
 
-def bulk_allokera(personal_id, projekt_id, datum_lista, timmar_per_dag):
-    """Allokera en person till ett projekt för en lista av datum."""
+def stromma_franvarodagar(sidstorlek=BULK_SIDSTORLEK):
+    """All frånvaro, även arkiverad, som (personal_id, datum, typ) sida för sida
+    (se _stromma_rader). Används av allokeringsmotorn."""
+    return _stromma_rader("SELECT personal_id, datum, typ FROM franvaro_dag", (), sidstorlek)
+
+
+def hamta_allokeringsdagar(nycklar):
+    """Gällande timmar för (personal_id, projekt_id, datum)-nycklar enligt
+    allokering_dag. Returnerar {(personal_id, projekt_id, datum): timmar};
+    nycklar utan allokering saknas. Går förbi läscachen (allokeringsmotorns synk)."""
+    nycklar = list(nycklar)
+    if not nycklar:
+        return {}
     conn = get_connection()
-    for d in datum_lista:
-        datum_str = str(d)
-        if timmar_per_dag <= 0:
-            conn.execute(
-                _q("DELETE FROM allokering WHERE personal_id=? AND projekt_id=? AND datum=?"),
-                (personal_id, projekt_id, datum_str)
-            )
+    try:
+        return _gallande_timmar(conn, nycklar)
+    finally:
+        conn.close()
+
+
+def _skriv_dagar(conn, poster):
+    """Skriv dagsallokeringar. timmar <= 0 raderar dagsraden, eller sparar
+    timmar = 0 om en period eller regel täcker dagen så att den inte syns den dagen.
+    Förekommer en nyckel flera gånger gäller den sista. Committar inte.
+    Returnerar antal skrivna dagar (unika nycklar)."""
+    # Samma nyckel flera gånger: sista posten gäller, som om de skrevs en och en
+    sista = {(personal_id, projekt_id, str(datum)): timmar
+             for personal_id, projekt_id, datum, timmar in poster}
+    upsert, radera = [], []
+    for nyckel, timmar in sista.items():
+        if timmar <= 0:
+            radera.append(nyckel)
         else:
-            conn.execute(_q("""
-                INSERT INTO allokering (personal_id, projekt_id, datum, timmar)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(personal_id, projekt_id, datum)
-                DO UPDATE SET timmar = excluded.timmar
-            """), (personal_id, projekt_id, datum_str, timmar_per_dag))
-    conn.commit()
-    conn.close()
+            upsert.append((*nyckel, timmar))
+    if radera:
+        tackta = _gallande_timmar(conn, radera, dagsrader=False)
+        upsert += [(*r, 0) for r in radera if r in tackta]
+        radera = [r for r in radera if r not in tackta]
+    # Mer än en sida: en omräkning per person i stället för en per rad i triggern
+    pausa = len(upsert) + len(radera) > BULK_SIDSTORLEK
+    if pausa:
+        _pausa_dagsbelastning(conn, True)
+    _bulk_radera(conn, "allokering", ["personal_id", "projekt_id", "datum"], radera)
+    _bulk_upsert(conn, "allokering", ["personal_id", "projekt_id", "datum", "timmar"],
+                 ["personal_id", "projekt_id", "datum"], upsert, uppdatera=["timmar"])
+    if pausa:
+        _pausa_dagsbelastning(conn, False)
+        _omrakna_belastning_for(conn, ((p, d) for p, _, d, *_ in upsert + radera))
+    return len(upsert) + len(radera)
+
+
+@invaliderar("allokering")
+def satt_allokering(personal_id, projekt_id, datum, timmar):
+    """Upsert allokering för en dag. Om timmar <= 0 tas dagen bort
+    (även om den ingår i en allokeringsperiod eller regel)."""
+    with anslutning() as conn:
+        _skriv_dagar(conn, [(personal_id, projekt_id, datum, timmar)])
+
+
+@invaliderar("allokering")
+def satt_allokeringar(poster):
+    """Spara en batch allokeringar i en transaktion.
+    poster: iterable av (personal_id, projekt_id, datum, timmar); timmar <= 0 raderar.
+    Förekommer samma dag flera gånger gäller den sista posten.
+    Returnerar antal skrivna dagar.
+    """
+    with anslutning() as conn:
+        return _skriv_dagar(conn, poster)
 
 
-def kopiera_vecka(personal_id, fran_vecka_start, till_vecka_start):
-    """Kopiera alla allokeringar från en vecka till en annan för en person."""
-    conn = get_connection()
-    fran_slut = fran_vecka_start + timedelta(days=4)  # Mån-Fre
-    rows = conn.execute(_q("""
-        SELECT projekt_id, datum, timmar FROM allokering
-        WHERE personal_id=? AND datum >= ? AND datum <= ?
-    """), (personal_id, str(fran_vecka_start), str(fran_slut))).fetchall()
-
-    dag_diff = (till_vecka_start - fran_vecka_start).days
-    for row in rows:
-        gammalt_datum = datetime.strptime(row["datum"], "%Y-%m-%d").date()
-        nytt_datum = gammalt_datum + timedelta(days=dag_diff)
-        conn.execute(_q("""
+@invaliderar("allokering")
+def bulk_allokera(personal_id, projekt_id, datum_lista, timmar_per_dag):
+    """Allokera en person till ett projekt för en lista av datum.
+    Sammanhängande arbetsdagar (minst två i följd i arbetsdagskalender) sparas
+    som en allokeringsperiod, övriga datum som dagsallokeringar.
+    Returnerar antal perioder och dagsrader som skrevs."""
+    dagar = sorted({str(d) for d in datum_lista})
+    if not dagar:
+        return 0
+    with anslutning() as conn:
+        _sakerstall_arbetsdagskalender(conn, int(dagar[0][:4]), int(dagar[-1][:4]))
+        arbetsdagar = [r["datum"] for r in conn.execute(
+            _q("SELECT datum FROM arbetsdagskalender WHERE datum >= ? AND datum <= ? ORDER BY datum"),
+            (dagar[0], dagar[-1])
+        ).fetchall()]
+        valda = set(dagar)
+        foljder, foljd = [], []
+        for dag in arbetsdagar:
+            if dag in valda:
+                foljd.append(dag)
+            elif foljd:
+                foljder.append(foljd)
+                foljd = []
+        if foljd:
+            foljder.append(foljd)
+
+        enstaka = valda - set(arbetsdagar)
+        for foljd in foljder:
+            if len(foljd) == 1:
+                enstaka.add(foljd[0])
+            else:
+                _skriv_period(conn, personal_id, projekt_id, foljd[0], foljd[-1], timmar_per_dag)
+        _skriv_dagar(conn, [(personal_id, projekt_id, d, timmar_per_dag) for d in sorted(enstaka)])
+    return sum(len(f) > 1 for f in foljder) + len(enstaka)
+
+
+def _forskjut_datum_sql(kolumn, dagar_kolumn):
+    """SQL-uttryck för ISO-datumsträngen `kolumn` förskjuten `dagar_kolumn` dagar."""
+    if _USE_POSTGRES:
+        return f"TO_CHAR(CAST({kolumn} AS DATE) + {dagar_kolumn}, 'YYYY-MM-DD')"
+    return f"date({kolumn}, {dagar_kolumn} || ' days')"
+
+
+@invaliderar("allokering")
+def kopiera_allokeringar(personal_ids, fran_start, fran_slut, mal_starter,
+                         hoppa_over_datum=(), hoppa_over_franvaro=False):
+    """
+    Kopiera allokeringarna i källfönstret fran_start..fran_slut för flera personer
+    till ett eller flera målfönster som börjar på datumen i mal_starter.
+    Datumförskjutningen görs i databasen i en enda INSERT ... SELECT, så antalet
+    rundresor är konstant oavsett teamets storlek och antalet veckor.
+    hoppa_over_datum: måldatum som inte skrivs (t.ex. röda dagar).
+    hoppa_over_franvaro: hoppa över måldagar där personen har registrerad frånvaro.
+    Källfönstret läses ur allokering_dag (även perioder); kopiorna blir dagsallokeringar.
+    Returnerar antal skrivna rader.
+    """
+    personal_ids = list(personal_ids)
+    forskjutningar = sorted({(m - fran_start).days for m in mal_starter})
+    if not personal_ids or not forskjutningar:
+        return 0
+    fonster_langd = (fran_slut - fran_start).days + 1
+    if any(b - a < fonster_langd for a, b in zip(forskjutningar, forskjutningar[1:])):
+        raise ValueError("Målfönstren överlappar varandra")
+
+    nytt_datum = _forskjut_datum_sql("a.datum", "s.dagar")
+    ctes = ["skift(dagar) AS (VALUES " + ", ".join(["(?)"] * len(forskjutningar)) + ")"]
+    params = list(forskjutningar)
+    villkor = [
+        f"a.personal_id IN ({', '.join(['?'] * len(personal_ids))})",
+        "a.datum >= ?", "a.datum <= ?",
+    ]
+    hoppa = sorted({str(d) for d in hoppa_over_datum})
+    if hoppa:
+        ctes.append("hoppa(datum) AS (VALUES " + ", ".join(["(?)"] * len(hoppa)) + ")")
+        params += hoppa
+        villkor.append(f"{nytt_datum} NOT IN (SELECT datum FROM hoppa)")
+    params += personal_ids + [str(fran_start), str(fran_slut)]
+    if hoppa_over_franvaro:
+        villkor.append(f"""NOT EXISTS (SELECT 1 FROM franvaro_dag f
+                           WHERE f.personal_id = a.personal_id AND f.datum = {nytt_datum})""")
+
+    with anslutning() as conn:
+        cursor = conn.execute(_q(f"""
             INSERT INTO allokering (personal_id, projekt_id, datum, timmar)
-            VALUES (?, ?, ?, ?)
+            WITH {", ".join(ctes)}
+            SELECT a.personal_id, a.projekt_id, {nytt_datum}, a.timmar
+            FROM allokering_dag a
+            CROSS JOIN skift s
+            WHERE {" AND ".join(villkor)}
             ON CONFLICT(personal_id, projekt_id, datum)
             DO UPDATE SET timmar = excluded.timmar
-        """), (personal_id, row["projekt_id"], str(nytt_datum), row["timmar"]))
+        """), params)
+        antal = cursor.rowcount
+    return antal
 
-    conn.commit()
-    conn.close()
-    return len(rows)
 
+def kopiera_vecka(personal_id, fran_vecka_start, till_vecka_start):
+    """Kopiera alla allokeringar från en vecka till en annan för en person."""
+    fran_slut = fran_vecka_start + timedelta(days=4)  # Mån-Fre
+    return kopiera_allokeringar([personal_id], fran_vecka_start, fran_slut, [till_vecka_start])
 
+
+@cachad("allokering")
 def hamta_dagsbelastning(personal_id, datum):
     conn = get_connection()
     row = conn.execute(
-        _q("SELECT COALESCE(SUM(timmar), 0) as total FROM allokering WHERE personal_id=? AND datum=?"),
+        _q("SELECT timmar as total FROM dagsbelastning WHERE personal_id=? AND datum=?"),
         (personal_id, str(datum))
     ).fetchone()
     conn.close()
     return row["total"] if row else 0
 
 
+def hamta_dagsbelastningar(nycklar):
+    """Timmar i dagsbelastning för (personal_id, datum)-nycklar, en fråga per
+    BULK_SIDSTORLEK nycklar. Returnerar {(personal_id, datum): timmar}; dagar
+    utan allokering saknas. Går förbi läscachen."""
+    nycklar = list(dict.fromkeys((p, str(d)) for p, d in nycklar))
+    resultat = {}
+    if not nycklar:
+        return resultat
+    conn = get_connection()
+    try:
+        for i in range(0, len(nycklar), BULK_SIDSTORLEK):
+            del_nycklar = nycklar[i:i + BULK_SIDSTORLEK]
+            platshallare = ", ".join(["(?, ?)"] * len(del_nycklar))
+            rows = conn.execute(_q(f"""
+                WITH nycklar(personal_id, datum) AS (VALUES {platshallare})
+                SELECT b.personal_id, b.datum, b.timmar
+                FROM nycklar n
+                JOIN dagsbelastning b ON b.personal_id = n.personal_id AND b.datum = n.datum
+            """), [v for nyckel in del_nycklar for v in nyckel]).fetchall()
+            resultat.update({(r["personal_id"], r["datum"]): r["timmar"] for r in rows})
+    finally:
+        conn.close()
+    return resultat
+
+
+@invaliderar("allokering")
+def bygg_om_dagsbelastning():
+    """Räkna om hela dagsbelastning från allokering_dag. Behövs bara om tabellen har
+    hamnat ur synk, t.ex. efter skrivningar med triggers avstängda.
+    Returnerar antal person-dagar."""
+    with anslutning() as conn:
+        _bygg_om_dagsbelastning(conn)
+        return conn.execute("SELECT COUNT(*) AS antal FROM dagsbelastning").fetchone()["antal"]
+
+
+# ============================================================
+# ALLOKERINGSPERIODER
+# ============================================================
+# En period är timmar per arbetsdag för en person och ett projekt i
+# start_datum..slut_datum (inklusive) och ersätter en dagsrad per arbetsdag.
+# Perioder för samma person och projekt överlappar aldrig; _skriv_period
+# kortar eller delar befintliga perioder. Dagsrader i allokering går före
+# perioden (se vyn allokering_dag).
+
+def _forskjut_dag(datum, dagar):
+    return str(date.fromisoformat(str(datum)) + timedelta(days=dagar))
+
+
+def _infoga_period(conn, personal_id, projekt_id, start_datum, slut_datum, timmar):
+    """Lägg till en period och returnera dess id. Committar inte."""
+    sql = ("INSERT INTO allokeringsperiod (personal_id, projekt_id, start_datum, slut_datum, timmar) "
+           "VALUES (?, ?, ?, ?, ?)")
+    params = (personal_id, projekt_id, str(start_datum), str(slut_datum), timmar)
+    if _USE_POSTGRES:
+        return conn.execute(_q(sql + " RETURNING id"), params).fetchone()["id"]
+    return conn.execute(sql, params).lastrowid
+
+
+def _skriv_period(conn, personal_id, projekt_id, start_datum, slut_datum, timmar):
+    """Låt en period gälla för hela start_datum..slut_datum: överlappande perioder
+    för samma person och projekt kortas eller delas, och dagsrader och arkivrader
+    på intervallets arbetsdagar (och nollrader) tas bort. timmar <= 0 tömmer intervallet.
+    Committar inte. Returnerar den nya periodens id (None om timmar <= 0)."""
+    start, slut = str(start_datum), str(slut_datum)
+    if start > slut:
+        raise ValueError("Perioden slutar före startdatum")
+    _sakerstall_arbetsdagskalender(conn, int(start[:4]), int(slut[:4]))
+    overlappande = conn.execute(_q("""
+        SELECT id, start_datum, slut_datum, timmar FROM allokeringsperiod
+        WHERE personal_id = ? AND projekt_id = ? AND start_datum <= ? AND slut_datum >= ?
+    """), (personal_id, projekt_id, slut, start)).fetchall()
+    kvar = []
+    for p in overlappande:
+        if p["start_datum"] < start:
+            kvar.append((p["start_datum"], _forskjut_dag(start, -1), p["timmar"]))
+        if p["slut_datum"] > slut:
+            kvar.append((_forskjut_dag(slut, 1), p["slut_datum"], p["timmar"]))
+    _bulk_radera(conn, "allokeringsperiod", ["id"], [(p["id"],) for p in overlappande])
+    conn.execute(_q("""
+        DELETE FROM allokering
+        WHERE personal_id = ? AND projekt_id = ? AND datum >= ? AND datum <= ?
+          AND (timmar <= 0 OR datum IN (SELECT datum FROM arbetsdagskalender))
+    """), (personal_id, projekt_id, start, slut))
+    conn.execute(_q("""
+        DELETE FROM allokering_arkiv
+        WHERE datum >= ? AND datum <= ? AND personal_id = ? AND projekt_id = ?
+          AND datum IN (SELECT datum FROM arbetsdagskalender)
+    """), (start, slut, personal_id, projekt_id))
+
+    ny_id = None
+    if timmar > 0:
+        # Rester med samma timmar gränsar till intervallet och slås ihop med det
+        for rest in [k for k in kvar if k[2] == timmar]:
+            kvar.remove(rest)
+            start, slut = min(start, rest[0]), max(slut, rest[1])
+        ny_id = _infoga_period(conn, personal_id, projekt_id, start, slut, timmar)
+    for rest_start, rest_slut, rest_timmar in kvar:
+        _infoga_period(conn, personal_id, projekt_id, rest_start, rest_slut, rest_timmar)
+    return ny_id
+
+
+@cachad("allokering", "personal", "projekt")
+def hamta_allokeringsperioder(personal_id=None, projekt_id=None, fran_datum=None, till_datum=None):
+    """Perioder som överlappar fran_datum..till_datum, med namn och färg
+    som i hamta_allokeringar. Sorterat på startdatum och namn."""
+    query = """
+        SELECT ap.id, ap.personal_id, ap.projekt_id, ap.start_datum, ap.slut_datum, ap.timmar,
+               p.namn as personal_namn, pr.namn as projekt_namn, pr.farg as projekt_farg
+        FROM allokeringsperiod ap
+        JOIN personal p ON ap.personal_id = p.id
+        JOIN projekt pr ON ap.projekt_id = pr.id
+        WHERE 1=1
+    """
+    params = []
+    if personal_id:
+        query += " AND ap.personal_id = ?"
+        params.append(personal_id)
+    if projekt_id:
+        query += " AND ap.projekt_id = ?"
+        params.append(projekt_id)
+    if fran_datum:
+        query += " AND ap.slut_datum >= ?"
+        params.append(str(fran_datum))
+    if till_datum:
+        query += " AND ap.start_datum <= ?"
+        params.append(str(till_datum))
+    query += " ORDER BY ap.start_datum, p.namn"
+    conn = get_connection()
+    rows = conn.execute(_q(query), params).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+@invaliderar("allokering")
+def satt_allokeringsperiod(personal_id, projekt_id, start_datum, slut_datum, timmar):
+    """Allokera timmar per arbetsdag i start_datum..slut_datum som en period
+    (ersätter tidigare allokeringar för personen och projektet på intervallets
+    arbetsdagar). timmar <= 0 tar bort allokeringen i intervallet.
+    Returnerar periodens id (None om timmar <= 0)."""
+    with anslutning() as conn:
+        return _skriv_period(conn, personal_id, projekt_id, start_datum, slut_datum, timmar)
+
+
+@invaliderar("allokering")
+def komprimera_allokeringar(min_dagar=2):
+    """Gör om befintliga dagsrader till perioder: minst min_dagar arbetsdagar i
+    följd med samma person, projekt och timmar blir en period. Dagar som redan
+    täcks av en period och dagar utanför arbetsdagskalendern lämnas orörda.
+    Resultatet i allokering_dag och dagsbelastning är detsamma.
+    Returnerar (antal nya perioder, antal borttagna dagsrader)."""
+    with anslutning() as conn:
+        row = conn.execute("SELECT MIN(datum) AS forsta, MAX(datum) AS sista FROM allokering").fetchone()
+        if not row["forsta"]:
+            return 0, 0
+        _sakerstall_arbetsdagskalender(conn, int(row["forsta"][:4]), int(row["sista"][:4]))
+        position = {r["datum"]: i for i, r in enumerate(conn.execute(
+            _q("SELECT datum FROM arbetsdagskalender WHERE datum >= ? AND datum <= ? ORDER BY datum"),
+            (row["forsta"], row["sista"])
+        ).fetchall())}
+        rader = conn.execute("""
+            SELECT a.personal_id, a.projekt_id, a.datum, a.timmar
+            FROM allokering a
+            JOIN arbetsdagskalender k ON k.datum = a.datum
+            WHERE a.timmar > 0 AND NOT EXISTS (
+                SELECT 1 FROM allokeringsperiod ap
+                WHERE ap.personal_id = a.personal_id AND ap.projekt_id = a.projekt_id
+                  AND ap.start_datum <= a.datum AND ap.slut_datum >= a.datum
+            )
+            ORDER BY a.personal_id, a.projekt_id, a.datum
+        """).fetchall()
+
+        foljder, foljd = [], []
+        for r in rader:
+            if foljd and ((r["personal_id"], r["projekt_id"], r["timmar"])
+                          != (foljd[-1]["personal_id"], foljd[-1]["projekt_id"], foljd[-1]["timmar"])
+                          or position[r["datum"]] != position[foljd[-1]["datum"]] + 1):
+                foljder.append(foljd)
+                foljd = []
+            foljd.append(r)
+        if foljd:
+            foljder.append(foljd)
+        foljder = [f for f in foljder if len(f) >= max(2, min_dagar)]
+
+        _bulk_radera(conn, "allokering", ["personal_id", "projekt_id", "datum"],
+                     [(r["personal_id"], r["projekt_id"], r["datum"]) for f in foljder for r in f])
+        perioder = [(f[0]["personal_id"], f[0]["projekt_id"], f[0]["datum"], f[-1]["datum"], f[0]["timmar"])
+                    for f in foljder]
+        if perioder and _USE_POSTGRES:
+            conn.execute_values("INSERT INTO allokeringsperiod "
+                                "(personal_id, projekt_id, start_datum, slut_datum, timmar) VALUES %s",
+                                perioder)
+        elif perioder:
+            conn.executemany("INSERT INTO allokeringsperiod "
+                             "(personal_id, projekt_id, start_datum, slut_datum, timmar) "
+                             "VALUES (?, ?, ?, ?, ?)", perioder)
+        return len(perioder), sum(len(f) for f in foljder)
+
+
+# ============================================================
+# ALLOKERINGSREGLER
+# ============================================================
+# En regel är timmar på en veckodag (0 = måndag) var intervall_veckor:e vecka
+# för en person och ett projekt i start_datum..slut_datum, som RRULE
+# FREQ=WEEKLY;INTERVAL=n;BYDAY=... Regler utvidgas först när de läses (vyn
+# allokering_dag), bara på arbetsdagar i arbetsdagskalender och inte på dagar
+# med frånvaro — ett ändrat mönster är en rad, inte en rad per dag.
+# start_datum sparas som första förekomsten och är ankare för intervallet.
+# Regler för samma person, projekt och veckodag överlappar aldrig;
+# _skriv_regel kortar eller delar befintliga regler.
+
+def _forsta_forekomst(datum, veckodag):
+    """Första datum >= datum som infaller på veckodag."""
+    dag = date.fromisoformat(str(datum))
+    return dag + timedelta(days=(veckodag - dag.weekday()) % 7)
+
+
+def _skriv_regel(conn, personal_id, projekt_id, veckodag, intervall_veckor,
+                 start_datum, slut_datum, timmar):
+    """Låt en regel gälla för veckodagen i start_datum..slut_datum: överlappande
+    regler för samma person, projekt och veckodag kortas eller delas (resten efter
+    intervallet behåller sitt ankare) och arkivrader på förekomsterna tas bort.
+    timmar <= 0 tar bara bort regeldagarna.
+    Dagsrader och perioder går fortfarande före. Committar inte.
+    Returnerar den nya regelns id (None om timmar <= 0)."""
+    if veckodag not in range(5):
+        raise ValueError("Veckodag måste vara 0 (måndag) till 4 (fredag)")
+    if intervall_veckor < 1:
+        raise ValueError("Intervallet måste vara minst en vecka")
+    start, slut = str(start_datum), str(slut_datum)
+    if start > slut:
+        raise ValueError("Regeln slutar före startdatum")
+    forsta = str(_forsta_forekomst(start, veckodag))
+    if timmar > 0 and forsta > slut:
+        raise ValueError("Veckodagen infaller inte i intervallet")
+    _sakerstall_arbetsdagskalender(conn, int(start[:4]), int(slut[:4]))
+
+    overlappande = conn.execute(_q("""
+        SELECT id, intervall_veckor, start_datum, slut_datum, timmar FROM allokeringsregel
+        WHERE personal_id = ? AND projekt_id = ? AND veckodag = ?
+          AND start_datum <= ? AND slut_datum >= ?
+    """), (personal_id, projekt_id, veckodag, slut, start)).fetchall()
+    kvar = []
+    for r in overlappande:
+        if r["start_datum"] < start:
+            kvar.append((r["intervall_veckor"], r["start_datum"], _forskjut_dag(start, -1), r["timmar"]))
+        if r["slut_datum"] > slut:
+            # Nästa förekomst i den gamla regelns takt efter intervallet
+            steg = 7 * r["intervall_veckor"]
+            dagar = (date.fromisoformat(slut) - date.fromisoformat(r["start_datum"])).days + 1
+            nasta = _forskjut_dag(r["start_datum"], -(-dagar // steg) * steg)
+            if nasta <= r["slut_datum"]:
+                kvar.append((r["intervall_veckor"], nasta, r["slut_datum"], r["timmar"]))
+    _bulk_radera(conn, "allokeringsregel", ["id"], [(r["id"],) for r in overlappande])
+    if timmar > 0:
+        # Regeln ersätter arkiverade dagar på sina förekomster
+        forekomster = []
+        dag = date.fromisoformat(forsta)
+        while str(dag) <= slut:
+            forekomster.append((personal_id, projekt_id, str(dag)))
+            dag += timedelta(weeks=intervall_veckor)
+        _bulk_radera(conn, "allokering_arkiv", ["personal_id", "projekt_id", "datum"], forekomster)
+
+    sql = ("INSERT INTO allokeringsregel "
+           "(personal_id, projekt_id, veckodag, intervall_veckor, start_datum, slut_datum, timmar) "
+           "VALUES (?, ?, ?, ?, ?, ?, ?)")
+    ny_id = None
+    if timmar > 0:
+        params = (personal_id, projekt_id, veckodag, intervall_veckor, forsta, slut, timmar)
+        if _USE_POSTGRES:
+            ny_id = conn.execute(_q(sql + " RETURNING id"), params).fetchone()["id"]
+        else:
+            ny_id = conn.execute(sql, params).lastrowid
+    for rest in kvar:
+        conn.execute(_q(sql), (personal_id, projekt_id, veckodag, *rest))
+    return ny_id
+
+
+@cachad("allokering", "personal", "projekt")
+def hamta_allokeringsregler(personal_id=None, projekt_id=None, fran_datum=None, till_datum=None):
+    """Regler som överlappar fran_datum..till_datum, med namn och färg
+    som i hamta_allokeringar. Sorterat på startdatum, veckodag och namn."""
+    query = """
+        SELECT r.id, r.personal_id, r.projekt_id, r.veckodag, r.intervall_veckor,
+               r.start_datum, r.slut_datum, r.timmar,
+               p.namn as personal_namn, pr.namn as projekt_namn, pr.farg as projekt_farg
+        FROM allokeringsregel r
+        JOIN personal p ON r.personal_id = p.id
+        JOIN projekt pr ON r.projekt_id = pr.id
+        WHERE 1=1
+    """
+    params = []
+    if personal_id:
+        query += " AND r.personal_id = ?"
+        params.append(personal_id)
+    if projekt_id:
+        query += " AND r.projekt_id = ?"
+        params.append(projekt_id)
+    if fran_datum:
+        query += " AND r.slut_datum >= ?"
+        params.append(str(fran_datum))
+    if till_datum:
+        query += " AND r.start_datum <= ?"
+        params.append(str(till_datum))
+    query += " ORDER BY r.start_datum, r.veckodag, p.namn"
+    conn = get_connection()
+    rows = conn.execute(_q(query), params).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+@invaliderar("allokering")
+def satt_allokeringsregel(personal_id, projekt_id, veckodag, start_datum, slut_datum, timmar,
+                          intervall_veckor=1):
+    """Allokera timmar på veckodag (0 = måndag) var intervall_veckor:e vecka i
+    start_datum..slut_datum, t.ex. "varannan fredag 8h". Ersätter tidigare regler
+    för personen, projektet och veckodagen i intervallet; timmar <= 0 tar bort dem.
+    Returnerar regelns id (None om timmar <= 0)."""
+    with anslutning() as conn:
+        return _skriv_regel(conn, personal_id, projekt_id, veckodag, intervall_veckor,
+                            start_datum, slut_datum, timmar)
+
+
+@invaliderar("allokering")
+def ta_bort_allokeringsregel(regel_id):
+    """Ta bort en regel helt."""
+    with anslutning() as conn:
+        conn.execute(_q("DELETE FROM allokeringsregel WHERE id = ?"), (regel_id,))
+
+
 # ============================================================
 # KOMPETENSER
 # ============================================================
 
+@cachad("kompetenser")
 def hamta_kompetenser(personal_id):
     conn = get_connection()
     rows = conn.execute(
@@ -486,6 +2305,7 @@ def hamta_kompetenser(personal_id):
     return [r["tagg"] for r in rows]
 
 
+@cachad("kompetenser")
 def hamta_alla_kompetenser():
     conn = get_connection()
     rows = conn.execute("SELECT DISTINCT tagg FROM kompetenser ORDER BY tagg").fetchall()
@@ -493,22 +2313,13 @@ def hamta_alla_kompetenser():
     return [r["tagg"] for r in rows]
 
 
+@invaliderar("kompetenser")
 def satt_kompetenser(personal_id, taggar):
-    conn = get_connection()
-    conn.execute(_q("DELETE FROM kompetenser WHERE personal_id=?"), (personal_id,))
-    for tagg in taggar:
-        tagg = tagg.strip()
-        if tagg:
-            try:
-                conn.execute(
-                    _q("INSERT INTO kompetenser (personal_id, tagg) VALUES (?, ?)"),
-                    (personal_id, tagg)
-                )
-            except _IntegrityError:
-                if _USE_POSTGRES:
-                    conn.rollback()
-    conn.commit()
-    conn.close()
+    """Ersätt personens kompetenstaggar (full replace)."""
+    rader = [(personal_id, t.strip()) for t in taggar if t.strip()]
+    with anslutning() as conn:
+        conn.execute(_q("DELETE FROM kompetenser WHERE personal_id=?"), (personal_id,))
+        _bulk_upsert(conn, "kompetenser", ["personal_id", "tagg"], ["personal_id", "tagg"], rader)
 
 
 # ============================================================
@@ -524,14 +2335,18 @@ FRANVARO_TYPER = {
     "ovrigt": {"namn": "Övrigt", "ikon": "📌", "farg": "#636e72"},
 }
 
+# Frånvaro stryker regeldagar i allokering_dag, så skrivningarna
+# nedan invaliderar även allokeringscachen.
+
 
+@cachad("franvaro", "personal")
 def hamta_franvaro(personal_id=None, fran_datum=None, till_datum=None):
-    """Hämta frånvaro med valfria filter."""
+    """Hämta frånvaro med valfria filter (även arkiverad; id är None för den)."""
     conn = get_connection()
     query = """
         SELECT f.id, f.personal_id, f.datum, f.typ, f.notering,
                p.namn as personal_namn
-        FROM franvaro f
+        FROM franvaro_dag f
         JOIN personal p ON f.personal_id = p.id
         WHERE 1=1
     """
@@ -551,66 +2366,229 @@ def hamta_franvaro(personal_id=None, fran_datum=None, till_datum=None):
     return [dict(r) for r in rows]
 
 
+@invaliderar("franvaro", "allokering")
 def satt_franvaro(personal_id, datum, typ, notering=""):
     """Registrera frånvaro (upsert). Typ='' tar bort frånvaron."""
-    conn = get_connection()
-    datum_str = str(datum)
-    if not typ:
-        conn.execute(
-            _q("DELETE FROM franvaro WHERE personal_id=? AND datum=?"),
-            (personal_id, datum_str)
-        )
-    else:
-        conn.execute(_q("""
-            INSERT INTO franvaro (personal_id, datum, typ, notering)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(personal_id, datum)
-            DO UPDATE SET typ = excluded.typ, notering = excluded.notering
-        """), (personal_id, datum_str, typ, notering))
-    conn.commit()
-    conn.close()
+    with anslutning() as conn:
+        datum_str = str(datum)
+        if not typ:
+            for tabell in ("franvaro", "franvaro_arkiv"):
+                conn.execute(
+                    _q(f"DELETE FROM {tabell} WHERE personal_id=? AND datum=?"),
+                    (personal_id, datum_str)
+                )
+        else:
+            conn.execute(_q("""
+                INSERT INTO franvaro (personal_id, datum, typ, notering)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(personal_id, datum)
+                DO UPDATE SET typ = excluded.typ, notering = excluded.notering
+            """), (personal_id, datum_str, typ, notering))
 
 
+@invaliderar("franvaro", "allokering")
 def bulk_franvaro(personal_id, datum_lista, typ, notering=""):
     """Registrera frånvaro för flera datum."""
-    conn = get_connection()
-    for d in datum_lista:
-        conn.execute(_q("""
-            INSERT INTO franvaro (personal_id, datum, typ, notering)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(personal_id, datum)
-            DO UPDATE SET typ = excluded.typ, notering = excluded.notering
-        """), (personal_id, str(d), typ, notering))
-    conn.commit()
-    conn.close()
+    rader = [(personal_id, str(d), typ, notering) for d in datum_lista]
+    with anslutning() as conn:
+        _bulk_upsert(conn, "franvaro", ["personal_id", "datum", "typ", "notering"],
+                     ["personal_id", "datum"], rader, uppdatera=["typ", "notering"])
 
 
+@invaliderar("franvaro", "allokering")
+def satt_franvarodagar(poster):
+    """Registrera frånvaro för många personer och dagar i en transaktion.
+    poster: iterable av (personal_id, datum, typ, notering). Returnerar antal poster."""
+    rader = [(personal_id, str(datum), typ, notering or "") for personal_id, datum, typ, notering in poster]
+    with anslutning() as conn:
+        return _bulk_upsert(conn, "franvaro", ["personal_id", "datum", "typ", "notering"],
+                            ["personal_id", "datum"], rader, uppdatera=["typ", "notering"])
+
+
+@invaliderar("franvaro", "allokering")
 def ta_bort_franvaro(personal_id, fran_datum, till_datum):
-    """Ta bort all frånvaro för en person i ett intervall."""
-    conn = get_connection()
-    conn.execute(
-        _q("DELETE FROM franvaro WHERE personal_id=? AND datum >= ? AND datum <= ?"),
-        (personal_id, str(fran_datum), str(till_datum))
-    )
-    conn.commit()
-    conn.close()
+    """Ta bort all frånvaro för en person i ett intervall (även arkiverad)."""
+    with anslutning() as conn:
+        for tabell in ("franvaro", "franvaro_arkiv"):
+            conn.execute(
+                _q(f"DELETE FROM {tabell} WHERE personal_id=? AND datum >= ? AND datum <= ?"),
+                (personal_id, str(fran_datum), str(till_datum))
+            )
 
 
+@cachad("franvaro")
 def ar_franvarande(personal_id, datum):
     """Kolla om en person är frånvarande ett specifikt datum."""
     conn = get_connection()
     row = conn.execute(
-        _q("SELECT typ FROM franvaro WHERE personal_id=? AND datum=?"),
+        _q("SELECT typ FROM franvaro_dag WHERE personal_id=? AND datum=?"),
         (personal_id, str(datum))
     ).fetchone()
     conn.close()
     return dict(row) if row else None
 
 
+# ============================================================
+# ARKIVERING
+# ============================================================
+# Gammal allokering och frånvaro flyttas till allokering_arkiv och
+# franvaro_arkiv så att de heta tabellerna och deras index hålls små.
+# Arkivet har gällande timmar per dag (perioder och regler utvidgade) och
+# läses genomskinligt via vyerna allokering_dag och franvaro_dag, så
+# hamta_allokeringar, hamta_franvaro och exporterna ser ingen skillnad.
+# En senare skrivning på en arkiverad dag hamnar i den heta tabellen och
+# går före arkivraden. dagsbelastning lämnas orörd.
+
+@invaliderar("allokering", "franvaro")
+def arkivera(fore_datum=None):
+    """Flytta allokering och frånvaro före fore_datum till arkivet (standard:
+    1 januari ARKIV_AR år före innevarande år). Perioder och regler som slutar
+    före gränsen tas bort och de som korsar den kortas. Kan köras om med en
+    senare gräns. Returnerar {"allokering": arkiverade dagar, "franvaro": ...}."""
+    grans = str(fore_datum or date(date.today().year - ARKIV_AR, 1, 1))
+    with anslutning() as conn:
+        # En nollrad stryker en redan arkiverad dag: arkivraden tas bort
+        conn.execute(_q("""
+            DELETE FROM allokering_arkiv
+            WHERE datum < ? AND EXISTS (
+                SELECT 1 FROM allokering a
+                WHERE a.personal_id = allokering_arkiv.personal_id
+                  AND a.projekt_id = allokering_arkiv.projekt_id
+                  AND a.datum = allokering_arkiv.datum AND a.timmar <= 0
+            )
+        """), (grans,))
+        # Gällande timmar ur vyn utan arkivdelen (dagsrader, perioder och regler)
+        antal_allokering = conn.execute(_q(f"""
+            INSERT INTO allokering_arkiv (datum, personal_id, projekt_id, timmar)
+            SELECT h.datum, h.personal_id, h.projekt_id, h.timmar
+            FROM ({_allokering_dag_vy(_USE_POSTGRES)}) h
+            WHERE h.datum < ?
+            ON CONFLICT (datum, personal_id, projekt_id) DO UPDATE SET timmar = excluded.timmar
+        """), (grans,)).rowcount
+        conn.execute(_q("DELETE FROM allokering WHERE datum < ?"), (grans,))
+        conn.execute(_q("DELETE FROM allokeringsperiod WHERE slut_datum < ?"), (grans,))
+        conn.execute(_q("UPDATE allokeringsperiod SET start_datum = ? WHERE start_datum < ?"),
+                     (grans, grans))
+        conn.execute(_q("DELETE FROM allokeringsregel WHERE slut_datum < ?"), (grans,))
+        for r in conn.execute(_q(
+            "SELECT id, intervall_veckor, start_datum, slut_datum FROM allokeringsregel WHERE start_datum < ?"
+        ), (grans,)).fetchall():
+            # Första förekomsten från gränsen i regelns takt
+            steg = 7 * r["intervall_veckor"]
+            dagar = (date.fromisoformat(grans) - date.fromisoformat(r["start_datum"])).days
+            nasta = _forskjut_dag(r["start_datum"], -(-dagar // steg) * steg)
+            if nasta <= r["slut_datum"]:
+                conn.execute(_q("UPDATE allokeringsregel SET start_datum = ? WHERE id = ?"), (nasta, r["id"]))
+            else:
+                conn.execute(_q("DELETE FROM allokeringsregel WHERE id = ?"), (r["id"],))
+
+        antal_franvaro = conn.execute(_q("""
+            INSERT INTO franvaro_arkiv (datum, personal_id, typ, notering)
+            SELECT datum, personal_id, typ, notering FROM franvaro
+            WHERE datum < ?
+            ON CONFLICT (datum, personal_id) DO UPDATE SET typ = excluded.typ, notering = excluded.notering
+        """), (grans,)).rowcount
+        conn.execute(_q("DELETE FROM franvaro WHERE datum < ?"), (grans,))
+    return {"allokering": antal_allokering, "franvaro": antal_franvaro}
+
+
+@cachad("allokering", "franvaro")
+def hamta_arkivstatus():
+    """Antal arkiverade rader per arkivtabell och senaste arkiverade datum (None om tomt)."""
+    conn = get_connection()
+    status = {}
+    sista = []
+    for nyckel, tabell in (("allokering", "allokering_arkiv"), ("franvaro", "franvaro_arkiv")):
+        row = conn.execute(f"SELECT COUNT(*) AS antal, MAX(datum) AS sista FROM {tabell}").fetchone()
+        status[nyckel] = row["antal"]
+        if row["sista"]:
+            sista.append(row["sista"])
+    conn.close()
+    status["sista_datum"] = max(sista) if sista else None
+    return status
+
+
+# ============================================================
+# DUMP OCH ÅTERSTÄLLNING
+# ============================================================
+# En fullständig dump är alla datatabeller med sina id:n, så att
+# främmande nycklar håller när den läses in i en annan databas.
+# dagsbelastning och andringslogg är härledda och följer inte med.
+
+# (tabell, kolumner, nyckel) i återställningsordning: föräldrar före barn.
+DUMP_TABELLER = [
+    ("personal", ("id", "namn", "roll", "kapacitet_h", "aktiv", "skapad_datum"), ("id",)),
+    ("projekt", ("id", "namn", "farg", "startdatum", "slutdatum", "aktiv"), ("id",)),
+    ("kompetenser", ("id", "personal_id", "tagg"), ("id",)),
+    ("arbetsdagskalender", ("datum",), ("datum",)),
+    ("allokering", ("id", "personal_id", "projekt_id", "datum", "timmar"), ("id",)),
+    ("allokeringsperiod", ("id", "personal_id", "projekt_id", "start_datum", "slut_datum", "timmar"),
+     ("id",)),
+    ("allokeringsregel", ("id", "personal_id", "projekt_id", "veckodag", "intervall_veckor",
+                          "start_datum", "slut_datum", "timmar"), ("id",)),
+    ("franvaro", ("id", "personal_id", "datum", "typ", "notering"), ("id",)),
+    ("kommentarer", ("id", "personal_id", "datum", "text", "skapad"), ("id",)),
+    ("allokering_arkiv", ("datum", "personal_id", "projekt_id", "timmar"),
+     ("datum", "personal_id", "projekt_id")),
+    ("franvaro_arkiv", ("datum", "personal_id", "typ", "notering"), ("datum", "personal_id")),
+]
+_DUMP_INDEX = {tabell: (kolumner, nyckel) for tabell, kolumner, nyckel in DUMP_TABELLER}
+
+
+def stromma_dumptabell(tabell, sidstorlek=BULK_SIDSTORLEK):
+    """Alla rader i en tabell ur DUMP_TABELLER med dess kolumner, sorterade på
+    nyckeln, sida för sida (se _stromma_rader). Går förbi läscachen."""
+    if tabell not in _DUMP_INDEX:
+        raise ValueError(f"Okänd tabell: {tabell}")
+    kolumner, nyckel = _DUMP_INDEX[tabell]
+    return _stromma_rader(f"SELECT {', '.join(kolumner)} FROM {tabell} ORDER BY {', '.join(nyckel)}",
+                          (), sidstorlek)
+
+
+@invaliderar("personal", "projekt", "allokering", "kompetenser", "franvaro", "kommentarer")
+def aterstall_dump(tabeller):
+    """Ersätt allt innehåll i DUMP_TABELLER med en dump i en transaktion.
+    tabeller är (tabell, kolumner, sidor) i DUMP_TABELLER-ordning, där sidor
+    ger listor av rader; tabeller som saknas i dumpen blir tomma. Raderna skrivs
+    med _bulk_upsert, id-sekvenserna flyttas fram i PostgreSQL, kalendern fylls
+    på till standardspannet, dagsbelastning byggs om och en loggpost tvingar
+    allokeringsmotorn att ladda om. Returnerar {tabell: antal rader}."""
+    antal = {tabell: 0 for tabell, _, _ in DUMP_TABELLER}
+    with anslutning() as conn:
+        # dagsbelastning byggs om i sin helhet på slutet
+        _pausa_dagsbelastning(conn, True)
+        for tabell, _, _ in reversed(DUMP_TABELLER):
+            conn.execute(f"DELETE FROM {tabell}")
+        for tabell, kolumner, sidor in tabeller:
+            if tabell not in _DUMP_INDEX:
+                raise ValueError(f"Okänd tabell i dumpen: {tabell}")
+            kolumner = list(kolumner)
+            okanda = set(kolumner) - set(_DUMP_INDEX[tabell][0])
+            if okanda:
+                raise ValueError(f"Okända kolumner i {tabell}: {', '.join(sorted(okanda))}")
+            nyckel = list(_DUMP_INDEX[tabell][1])
+            uppdatera = [k for k in kolumner if k not in nyckel]
+            for rader in sidor:
+                antal[tabell] += _bulk_upsert(conn, tabell, kolumner, nyckel, rader, uppdatera)
+        if _USE_POSTGRES:
+            for tabell, _, nyckel in DUMP_TABELLER:
+                if nyckel == ("id",):
+                    conn.execute(f"SELECT setval(pg_get_serial_sequence('{tabell}', 'id'), "
+                                 f"COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {tabell}")
+        _sakerstall_standardkalender(conn)
+        _pausa_dagsbelastning(conn, False)
+        _bygg_om_dagsbelastning(conn)
+        # Arkivtabellerna loggas inte; en periodpost utan rad får konsumenter
+        # av andringslogg (allokeringsmotorn i alla processer) att läsa om allt
+        conn.execute("INSERT INTO andringslogg (tabell, operation) VALUES ('allokeringsperiod', 'U')")
+    return antal
+
+
 # ============================================================
 # KOMMENTARER
 # ============================================================
 
+@cachad("kommentarer")
 def hamta_kommentar(personal_id, datum):
     conn = get_connection()
     row = conn.execute(
@@ -621,25 +2599,25 @@ def hamta_kommentar(personal_id, datum):
     return row["text"] if row else ""
 
 
+@invaliderar("kommentarer")
 def satt_kommentar(personal_id, datum, text):
     """Sätt kommentar (upsert). Tom text raderar."""
-    conn = get_connection()
-    if not text.strip():
-        conn.execute(
-            _q("DELETE FROM kommentarer WHERE personal_id=? AND datum=?"),
-            (personal_id, str(datum))
-        )
-    else:
-        conn.execute(_q(f"""
-            INSERT INTO kommentarer (personal_id, datum, text)
-            VALUES (?, ?, ?)
-            ON CONFLICT(personal_id, datum)
-            DO UPDATE SET text = excluded.text, skapad = {_NOW_FUNC}
-        """), (personal_id, str(datum), text.strip()))
-    conn.commit()
-    conn.close()
+    with anslutning() as conn:
+        if not text.strip():
+            conn.execute(
+                _q("DELETE FROM kommentarer WHERE personal_id=? AND datum=?"),
+                (personal_id, str(datum))
+            )
+        else:
+            conn.execute(_q(f"""
+                INSERT INTO kommentarer (personal_id, datum, text)
+                VALUES (?, ?, ?)
+                ON CONFLICT(personal_id, datum)
+                DO UPDATE SET text = excluded.text, skapad = {_NOW_FUNC}
+            """), (personal_id, str(datum), text.strip()))
 
 
+@cachad("kommentarer")
 def hamta_kommentarer_period(personal_id, fran_datum, till_datum):
     conn = get_connection()
     rows = conn.execute(
@@ -654,86 +2632,132 @@ def hamta_kommentarer_period(personal_id, fran_datum, till_datum):
 # SAMMANSTÄLLNINGAR (för startsida och lediga resurser)
 # ============================================================
 
-def hamta_overbelagda(fran_datum, till_datum):
-    """Hitta alla person+datum som är överbelagda."""
+@cachad("allokering", "personal")
+def hamta_overbelagda(fran_datum, till_datum, bara_aktiva=True):
+    """Hitta alla person+datum som är överbelagda (läser dagsbelastning)."""
+    query = """
+        SELECT b.personal_id, p.namn as personal_namn, b.datum,
+               b.timmar as total_timmar, p.kapacitet_h
+        FROM dagsbelastning b
+        JOIN personal p ON b.personal_id = p.id
+        WHERE b.datum >= ? AND b.datum <= ? AND b.timmar > p.kapacitet_h
+    """
+    if bara_aktiva:
+        query += " AND p.aktiv = 1"
+    query += " ORDER BY b.datum, p.namn"
     conn = get_connection()
-    rows = conn.execute(_q("""
-        SELECT a.personal_id, p.namn as personal_namn, a.datum,
-               SUM(a.timmar) as total_timmar, p.kapacitet_h
-        FROM allokering a
-        JOIN personal p ON a.personal_id = p.id
-        WHERE a.datum >= ? AND a.datum <= ? AND p.aktiv = 1
-        GROUP BY a.personal_id, a.datum, p.namn, p.kapacitet_h
-        HAVING SUM(a.timmar) > p.kapacitet_h
-        ORDER BY a.datum, p.namn
-    """), (str(fran_datum), str(till_datum))).fetchall()
+    rows = conn.execute(_q(query), (str(fran_datum), str(till_datum))).fetchall()
     conn.close()
     return [dict(r) for r in rows]
 
 
-def hamta_oallokerade(fran_datum, till_datum, arbetsdagar):
-    """Hitta alla aktiva personer som saknar allokering på arbetsdagar."""
-    personal = hamta_all_personal()
+@cachad("allokering", "personal")
+def hamta_timmar_per_person(fran_datum, till_datum, bara_aktiva=True):
+    """Allokerade timmar per person i perioden, summerade i en enda GROUP BY.
+    En rad per person (även utan allokeringar) med personalfälten plus
+    `allokerat`, sorterat på namn som hamta_all_personal.
+    """
+    query = """
+        SELECT p.*, COALESCE(s.total, 0) AS allokerat
+        FROM personal p
+        LEFT JOIN (
+            SELECT personal_id, SUM(timmar) AS total
+            FROM dagsbelastning
+            WHERE datum >= ? AND datum <= ?
+            GROUP BY personal_id
+        ) s ON s.personal_id = p.id
+    """
+    if bara_aktiva:
+        query += " WHERE p.aktiv = 1"
+    query += " ORDER BY p.namn"
     conn = get_connection()
-    resultat = []
-    for dag in arbetsdagar:
-        dag_str = str(dag)
-        for p in personal:
-            # Kolla om personen har frånvaro
-            franvaro = conn.execute(
-                _q("SELECT typ FROM franvaro WHERE personal_id=? AND datum=?"),
-                (p["id"], dag_str)
-            ).fetchone()
-            if franvaro:
-                continue  # Frånvarande, hoppa över
-
-            allok = conn.execute(
-                _q("SELECT COALESCE(SUM(timmar), 0) as total FROM allokering WHERE personal_id=? AND datum=?"),
-                (p["id"], dag_str)
-            ).fetchone()
-            if allok["total"] == 0:
-                resultat.append({
-                    "personal_id": p["id"],
-                    "personal_namn": p["namn"],
-                    "datum": dag_str,
-                    "roll": p["roll"]
-                })
+    rows = conn.execute(_q(query), (str(fran_datum), str(till_datum))).fetchall()
     conn.close()
-    return resultat
+    return [dict(r) for r in rows]
+
+
+def _dagar_cte(dagar):
+    """SQL och parametrar för en CTE dagar(datum) med en rad per datum."""
+    platshallare = ", ".join(["(?)"] * len(dagar))
+    return f"dagar(datum) AS (VALUES {platshallare})", [str(d) for d in dagar]
+
+
+def _hamta_dagskapacitet(dagar):
+    """En rad per aktiv person och dag i `dagar` med allokerade timmar och
+    eventuell frånvarotyp — personal LEFT JOIN dagsbelastning LEFT JOIN franvaro_dag
+    i en enda fråga. Sorterat på datum, namn.
+    """
+    cte, params = _dagar_cte(dagar)
+    conn = get_connection()
+    rows = conn.execute(_q(f"""
+        WITH {cte}
+        SELECT p.id AS personal_id, p.namn, p.roll, p.kapacitet_h, d.datum,
+               COALESCE(b.timmar, 0) AS allokerat, f.typ AS franvaro
+        FROM personal p
+        CROSS JOIN dagar d
+        LEFT JOIN dagsbelastning b ON b.personal_id = p.id AND b.datum = d.datum
+        LEFT JOIN franvaro_dag f ON f.personal_id = p.id AND f.datum = d.datum
+        WHERE p.aktiv = 1
+        ORDER BY d.datum, p.namn
+    """), params).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
 
 
+@cachad("allokering", "personal", "franvaro")
+def hamta_oallokerade(fran_datum, till_datum, arbetsdagar):
+    """Hitta alla aktiva personer som saknar allokering på arbetsdagar."""
+    if not arbetsdagar:
+        return []
+    return [
+        {"personal_id": r["personal_id"], "personal_namn": r["namn"],
+         "datum": r["datum"], "roll": r["roll"]}
+        for r in _hamta_dagskapacitet(arbetsdagar)
+        if not r["franvaro"] and r["allokerat"] == 0
+    ]
+
+
+@cachad("allokering", "personal", "franvaro")
 def hamta_lediga_resurser(datum):
     """Hitta personer som har ledig kapacitet på ett datum."""
-    personal = hamta_all_personal()
-    conn = get_connection()
     lediga = []
-    for p in personal:
-        # Kolla frånvaro
-        franvaro = conn.execute(
-            _q("SELECT typ FROM franvaro WHERE personal_id=? AND datum=?"),
-            (p["id"], str(datum))
-        ).fetchone()
-        if franvaro:
-            continue
-
-        allok = conn.execute(
-            _q("SELECT COALESCE(SUM(timmar), 0) as total FROM allokering WHERE personal_id=? AND datum=?"),
-            (p["id"], str(datum))
-        ).fetchone()
-        ledig_tid = p["kapacitet_h"] - allok["total"]
-        if ledig_tid > 0:
+    for r in _hamta_dagskapacitet([datum]):
+        ledig_tid = r["kapacitet_h"] - r["allokerat"]
+        if not r["franvaro"] and ledig_tid > 0:
             lediga.append({
-                "personal_id": p["id"],
-                "namn": p["namn"],
-                "roll": p["roll"],
-                "kapacitet_h": p["kapacitet_h"],
-                "allokerat": allok["total"],
+                "personal_id": r["personal_id"],
+                "namn": r["namn"],
+                "roll": r["roll"],
+                "kapacitet_h": r["kapacitet_h"],
+                "allokerat": r["allokerat"],
                 "ledigt": ledig_tid
             })
-    conn.close()
     return sorted(lediga, key=lambda x: x["ledigt"], reverse=True)
 
 
+@cachad("allokering", "personal", "franvaro")
+def hamta_lediga_resurser_period(arbetsdagar):
+    """
+    Ledig kapacitet per person och dag för en hel period i en fråga.
+    Returnerar dict: {personal_id: {"namn", "roll", "kapacitet_h", "totalt_ledigt",
+                                    "dagar": {datum_str: ledigt}}}
+    Frånvarodagar och överbelagda dagar har ledigt = 0.
+    """
+    if not arbetsdagar:
+        return {}
+    matris = {}
+    for r in _hamta_dagskapacitet(arbetsdagar):
+        person = matris.setdefault(r["personal_id"], {
+            "namn": r["namn"], "roll": r["roll"], "kapacitet_h": r["kapacitet_h"],
+            "totalt_ledigt": 0.0, "dagar": {}
+        })
+        ledigt = 0.0 if r["franvaro"] else max(0.0, r["kapacitet_h"] - r["allokerat"])
+        person["dagar"][r["datum"]] = ledigt
+        person["totalt_ledigt"] += ledigt
+    return matris
+
+
+@cachad("allokering", "personal", "projekt", "franvaro")
 def hamta_teamoversikt(fran_datum, till_datum, arbetsdagar):
     """
     Hämta komplett teamöversikt: per person, per dag - vad de gör.
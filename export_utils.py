@@ -1,39 +1,58 @@
 """
 export_utils.py - Export-funktioner för Teammanager
-Hanterar export till CSV och PDF.
+Hanterar export till CSV och PDF samt fullständig dump och återställning
+i Parquet. Färdiga exporter cachas per (exporttyp, argument,
+tabellgenerationer) i en egen LRU-cache.
 """
 
 import pandas as pd
+import csv
 import io
+import os
+import zipfile
 from datetime import date
-from database import hamta_allokeringar, hamta_all_personal, hamta_alla_projekt, hamta_kompetenser
+from database import (
+    hamta_all_personal, hamta_alla_projekt, hamta_kompetenser, hamta_timmar_per_person,
+    stromma_allokeringar, BULK_SIDSTORLEK,
+    DUMP_TABELLER, stromma_dumptabell, aterstall_dump, hamta_schemaversion
+)
 from calendar_utils import hamta_arbetsdagar
+from cache_utils import LRUCache, cachad
 
+EXPORT_CACHE_STORLEK = int(os.environ.get("TEAMMANAGER_EXPORT_CACHE_SIZE", 16))
+# Total storlek på cachade exporter; en enskild export större än så cachas inte
+EXPORT_CACHE_MAX_BYTE = int(os.environ.get("TEAMMANAGER_EXPORT_CACHE_MB", 64)) * 1024 * 1024
+_export_cache = LRUCache(EXPORT_CACHE_STORLEK, max_byte=EXPORT_CACHE_MAX_BYTE)
 
+
+def stromma_allokeringar_csv(fran_datum, till_datum, sidstorlek=BULK_SIDSTORLEK):
+    """
+    Exportera allokeringsdata som CSV i bitar direkt från databasens cursor.
+    Ger bytes-bitar (utf-8-sig, ;-separerat); BOM och rubrikrad ligger i första
+    biten. Minnesåtgången beror på sidstorlek, inte på periodens längd.
+    """
+    text = io.StringIO()
+    skrivare = csv.writer(text, delimiter=";", lineterminator=os.linesep)
+    skrivare.writerow(["Personal", "Projekt", "Datum", "Timmar"])
+    yield text.getvalue().encode("utf-8-sig")
+
+    for rader in stromma_allokeringar(fran_datum, till_datum, sidstorlek):
+        text.seek(0)
+        text.truncate()
+        skrivare.writerows(rader)
+        yield text.getvalue().encode("utf-8")
+
+
+@cachad("allokering", "personal", "projekt", cache=_export_cache)
 def exportera_allokeringar_csv(fran_datum, till_datum):
     """
     Exportera allokeringsdata som CSV.
     Returnerar en bytes-buffer redo för nedladdning.
     """
-    allokeringar = hamta_allokeringar(fran_datum=fran_datum, till_datum=till_datum)
-
-    if not allokeringar:
-        df = pd.DataFrame(columns=["Personal", "Projekt", "Datum", "Timmar"])
-    else:
-        df = pd.DataFrame(allokeringar)
-        df = df[["personal_namn", "projekt_namn", "datum", "timmar"]].rename(columns={
-            "personal_namn": "Personal",
-            "projekt_namn": "Projekt",
-            "datum": "Datum",
-            "timmar": "Timmar"
-        })
-
-    buffer = io.BytesIO()
-    df.to_csv(buffer, index=False, encoding="utf-8-sig", sep=";")
-    buffer.seek(0)
-    return buffer.getvalue()
+    return b"".join(stromma_allokeringar_csv(fran_datum, till_datum))
 
 
+@cachad("personal", "kompetenser", cache=_export_cache)
 def exportera_personal_csv():
     """Exportera personalregister som CSV."""
     personal = hamta_all_personal(bara_aktiva=False)
@@ -57,21 +76,19 @@ def exportera_personal_csv():
     return buffer.getvalue()
 
 
+@cachad("allokering", "personal", cache=_export_cache)
 def exportera_belaggningsrapport_csv(fran_datum, till_datum):
     """
     Exportera beläggningsrapport per person som CSV.
     Visar tillgängliga timmar, allokerade timmar, beläggningsgrad.
     """
-    personal = hamta_all_personal()
+    personal = hamta_timmar_per_person(fran_datum, till_datum)
     arbetsdagar = hamta_arbetsdagar(fran_datum, till_datum)
     antal_dagar = len(arbetsdagar)
 
     rows = []
     for p in personal:
-        allokeringar = hamta_allokeringar(
-            personal_id=p["id"], fran_datum=fran_datum, till_datum=till_datum
-        )
-        allokerade = sum(a["timmar"] for a in allokeringar)
+        allokerade = p["allokerat"]
         tillgangliga = antal_dagar * p["kapacitet_h"]
         belaggning = (allokerade / tillgangliga * 100) if tillgangliga > 0 else 0
 
@@ -97,9 +114,15 @@ def generera_pdf_rapport(fran_datum, till_datum):
     Generera en PDF-rapport med beläggningsöversikt.
     Returnerar bytes-buffer.
     """
+    return _generera_pdf_rapport(fran_datum, till_datum, date.today())
+
+
+@cachad("allokering", "personal", cache=_export_cache)
+def _generera_pdf_rapport(fran_datum, till_datum, genererad):
+    """Bygg PDF:en; genererad (dagens datum) ingår i cachenyckeln via argumentet."""
     from fpdf import FPDF
 
-    personal = hamta_all_personal()
+    personal = hamta_timmar_per_person(fran_datum, till_datum)
     arbetsdagar = hamta_arbetsdagar(fran_datum, till_datum)
     antal_dagar = len(arbetsdagar)
 
@@ -133,10 +156,7 @@ def generera_pdf_rapport(fran_datum, till_datum):
     pdf.set_text_color(0, 0, 0)
 
     for idx, p in enumerate(personal):
-        allokeringar = hamta_allokeringar(
-            personal_id=p["id"], fran_datum=fran_datum, till_datum=till_datum
-        )
-        allokerade = sum(a["timmar"] for a in allokeringar)
+        allokerade = p["allokerat"]
         tillgangliga = antal_dagar * p["kapacitet_h"]
         belaggning = (allokerade / tillgangliga * 100) if tillgangliga > 0 else 0
 
@@ -169,12 +189,7 @@ def generera_pdf_rapport(fran_datum, till_datum):
     pdf.set_font("Helvetica", "", 10)
     pdf.cell(0, 7, f"Antal resurser: {len(personal)}", ln=True)
 
-    total_allok = sum(
-        sum(a["timmar"] for a in hamta_allokeringar(
-            personal_id=p["id"], fran_datum=fran_datum, till_datum=till_datum
-        ))
-        for p in personal
-    )
+    total_allok = sum(p["allokerat"] for p in personal)
     total_tillg = sum(antal_dagar * p["kapacitet_h"] for p in personal)
     snitt_belaggning = (total_allok / total_tillg * 100) if total_tillg > 0 else 0
 
@@ -185,9 +200,130 @@ def generera_pdf_rapport(fran_datum, till_datum):
     # Footer
     pdf.ln(15)
     pdf.set_font("Helvetica", "I", 8)
-    pdf.cell(0, 5, f"Genererad: {date.today()}", ln=True, align="C")
+    pdf.cell(0, 5, f"Genererad: {genererad}", ln=True, align="C")
 
     buffer = io.BytesIO()
     pdf.output(buffer)
     buffer.seek(0)
     return buffer.getvalue()
+
+
+# ============================================================
+# PARQUET-DUMP
+# ============================================================
+# En dump är en zip med en <tabell>.parquet per tabell i DUMP_TABELLER.
+# Kolumnerna är typade (datum som date32, timmar som float64, aktiv som
+# bool) och återkommande strängar dictionary-kodade. Schemaversionen
+# ligger i varje fils metadata.
+
+SCHEMAVERSION_NYCKEL = b"teammanager.schema_version"
+_DICTIONARY_KOLUMNER = ("roll", "farg", "typ", "tagg")
+
+
+def _parquet_typ(kolumn):
+    """Arrow-typ för en kolumn i DUMP_TABELLER."""
+    import pyarrow as pa
+
+    if kolumn in ("id", "personal_id", "projekt_id"):
+        return pa.int64()
+    if kolumn in ("veckodag", "intervall_veckor"):
+        return pa.int8()
+    if kolumn in ("timmar", "kapacitet_h"):
+        return pa.float64()
+    if kolumn == "aktiv":
+        return pa.bool_()
+    if kolumn.endswith("datum"):
+        return pa.date32()
+    if kolumn in _DICTIONARY_KOLUMNER:
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+def _till_arrow(varden, typ):
+    """Kolumn ur databasen (datum som ISO-text, tomt datum som NULL) till Arrow."""
+    import pyarrow as pa
+
+    if pa.types.is_date32(typ):
+        return pa.array([v or None for v in varden], pa.string()).cast(typ)
+    if pa.types.is_boolean(typ):
+        return pa.array([None if v is None else bool(v) for v in varden], typ)
+    if pa.types.is_dictionary(typ):
+        return pa.array(varden, pa.string()).dictionary_encode()
+    return pa.array(varden, typ)
+
+
+def _fran_arrow(kolumn):
+    """Arrow-kolumn tillbaka till databasens värden (ISO-text, 0/1)."""
+    import pyarrow as pa
+
+    if pa.types.is_date32(kolumn.type) or pa.types.is_dictionary(kolumn.type):
+        kolumn = kolumn.cast(pa.string())
+    elif pa.types.is_boolean(kolumn.type):
+        kolumn = kolumn.cast(pa.int8())
+    return kolumn.to_pylist()
+
+
+@cachad("personal", "projekt", "allokering", "kompetenser", "franvaro", "kommentarer",
+        cache=_export_cache)
+def exportera_parquet():
+    """
+    Exportera alla tabeller i DUMP_TABELLER som en zip med Parquet-filer.
+    Tabellerna skrivs sida för sida (BULK_SIDSTORLEK rader per radgrupp).
+    Returnerar bytes.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    metadata = {SCHEMAVERSION_NYCKEL: str(hamta_schemaversion()).encode()}
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as arkiv:
+        for tabell, kolumner, _ in DUMP_TABELLER:
+            schema = pa.schema([(k, _parquet_typ(k)) for k in kolumner], metadata=metadata)
+            fil = io.BytesIO()
+            with pq.ParquetWriter(fil, schema, compression="zstd") as skrivare:
+                for rader in stromma_dumptabell(tabell):
+                    skrivare.write_batch(pa.record_batch(
+                        [_till_arrow(varden, f.type) for varden, f in zip(zip(*rader), schema)],
+                        schema=schema
+                    ))
+            arkiv.writestr(f"{tabell}.parquet", fil.getvalue())
+    return buffer.getvalue()
+
+
+def importera_parquet(dump):
+    """
+    Ersätt databasens innehåll med en dump från exportera_parquet().
+    dump är bytes, en sökväg eller en binär fil. En dump från ett äldre schema
+    går att läsa (saknade tabeller blir tomma), en från ett nyare ger ValueError.
+    Returnerar {tabell: antal rader}.
+    """
+    import pyarrow.parquet as pq
+
+    if isinstance(dump, bytes):
+        dump = io.BytesIO(dump)
+    aktuell = hamta_schemaversion()
+    with zipfile.ZipFile(dump) as arkiv:
+        filer = {}
+        for namn in arkiv.namelist():
+            tabell, _, filtyp = namn.rpartition(".")
+            if filtyp != "parquet":
+                continue
+            fil = pq.ParquetFile(io.BytesIO(arkiv.read(namn)))
+            version = int((fil.schema_arrow.metadata or {}).get(SCHEMAVERSION_NYCKEL, 0))
+            if version > aktuell:
+                raise ValueError(f"Dumpen har schemaversion {version}, databasen {aktuell}")
+            filer[tabell] = fil
+
+    def sidor(fil):
+        for batch in fil.iter_batches(batch_size=BULK_SIDSTORLEK):
+            yield list(zip(*(_fran_arrow(k) for k in batch.columns)))
+
+    return aterstall_dump(
+        (tabell, filer[tabell].schema_arrow.names, sidor(filer[tabell]))
+        for tabell, _, _ in DUMP_TABELLER if tabell in filer
+    )
+
+
+def export_cache_statistik():
+    """Träffar, missar och storlek för exportcachen."""
+    return _export_cache.statistik()
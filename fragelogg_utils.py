@@ -0,0 +1,226 @@
+"""
+fragelogg_utils.py - Frågelogg för Teammanager
+Mäter varje SQL-sats som database.py skickar (SQLite-anslutningen och
+_PgConnectionWrapper) medan en insamling är igång i tråden: normaliserad SQL,
+tid, antal rader och anropande funktion. En insamling motsvarar en rerun i
+Streamlit; rapporten summerar per sats och flaggar N+1-mönster, dvs. samma
+sats körd många gånger med olika parametrar.
+
+Utan aktiv insamling kostar mätpunkten bara en attributuppslagning.
+"""
+
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+
+# Samla in på varje rerun och logga rapporten (annars bara med ?fragelogg=1)
+FRAGELOGG_AKTIV = os.environ.get("TEAMMANAGER_FRAGELOGG", "").lower() in ("1", "true", "ja")
+# Så många körningar av samma sats med olika parametrar räknas som N+1
+N_PLUS_1_GRANS = int(os.environ.get("TEAMMANAGER_N_PLUS_1_GRANS", 5))
+
+logger = logging.getLogger("teammanager.fragelogg")
+
+_lokal = threading.local()
+_DENNA_FIL = os.path.basename(__file__)
+_INTERNA_FILER = {"database.py", "cache_utils.py", _DENNA_FIL}
+_OMSLAG = {"execute", "executemany", "execute_values", "execute_server", "copy_expert", "omslag"}
+
+
+class FrageInsamling:
+    """Satser som körts i en tråd sedan starta_insamling()."""
+
+    def __init__(self):
+        self.poster = []
+        self.start = time.perf_counter()
+
+    def registrera(self, sql, params, sekunder, rader, massa=False):
+        funktion, kalla = _anropare()
+        post = {
+            "sql": sql,
+            # Parametrarna jämförs bara för enstaka satser; massoperationer saknar nyckel
+            "parametrar": None if massa else hash(repr(params)),
+            "sekunder": sekunder,
+            "rader": rader,
+            "funktion": funktion,
+            "kalla": kalla,
+        }
+        self.poster.append(post)
+        return post
+
+    def rapport(self, etikett=""):
+        """Summering per normaliserad sats, dyraste först, med N+1-flaggor."""
+        satser = {}
+        for post in self.poster:
+            sql = normalisera_sql(post["sql"])
+            sats = satser.setdefault(sql, {
+                "sql": sql, "antal": 0, "tid_ms": 0.0, "rader": 0,
+                "parametrar": set(), "anropare": Counter(),
+            })
+            sats["antal"] += 1
+            sats["tid_ms"] += post["sekunder"] * 1000
+            sats["rader"] += post["rader"]
+            if post["parametrar"] is not None:
+                sats["parametrar"].add(post["parametrar"])
+            sats["anropare"][f"{post['funktion']} ({post['kalla']})"] += 1
+
+        lista = []
+        for sats in satser.values():
+            olika = len(sats.pop("parametrar"))
+            sats["olika_parametrar"] = olika
+            sats["n_plus_1"] = sats["antal"] >= N_PLUS_1_GRANS and olika > 1
+            sats["tid_ms"] = round(sats["tid_ms"], 3)
+            sats["anropare"] = dict(sats["anropare"].most_common(5))
+            lista.append(sats)
+        lista.sort(key=lambda s: s["tid_ms"], reverse=True)
+
+        return {
+            "etikett": etikett,
+            "fragor": len(self.poster),
+            "tid_ms": round(sum(p["sekunder"] for p in self.poster) * 1000, 3),
+            "total_ms": round((time.perf_counter() - self.start) * 1000, 3),
+            "rader": sum(p["rader"] for p in self.poster),
+            "satser": lista,
+            "n_plus_1": [s["sql"] for s in lista if s["n_plus_1"]],
+        }
+
+
+class _RaknandeCursor:
+    """Cursor-omslag som räknar hämtade rader och lägger hämtningstiden
+    till satsens post (SQLite vet inte antalet rader förrän de hämtats)."""
+
+    def __init__(self, cursor, post, rakna_rader):
+        self._cursor = cursor
+        self._post = post
+        self._rakna_rader = rakna_rader
+
+    def _hamtat(self, start, rader):
+        self._post["sekunder"] += time.perf_counter() - start
+        if self._rakna_rader:
+            self._post["rader"] += rader
+
+    def fetchone(self):
+        start = time.perf_counter()
+        rad = self._cursor.fetchone()
+        self._hamtat(start, rad is not None)
+        return rad
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        rader = self._cursor.fetchmany(*args)
+        self._hamtat(start, len(rader))
+        return rader
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rader = self._cursor.fetchall()
+        self._hamtat(start, len(rader))
+        return rader
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, namn):
+        return getattr(self._cursor, namn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+
+def starta_insamling():
+    """Börja samla in satser i den här tråden (ersätter en tidigare insamling)."""
+    _lokal.insamling = FrageInsamling()
+
+
+def avsluta_insamling(etikett=""):
+    """Avsluta trådens insamling och returnera rapporten (None om ingen pågick).
+    etikett följer med i rapporten, t.ex. sidans namn."""
+    insamling = getattr(_lokal, "insamling", None)
+    _lokal.insamling = None
+    return insamling.rapport(etikett) if insamling is not None else None
+
+
+def aktiv_insamling():
+    return getattr(_lokal, "insamling", None)
+
+
+def matt(sql, params, utfor, *args, massa=False, cursor=None):
+    """Kör utfor(*args) och returnera cursorn: den som anges med cursor=
+    (psycopg2, där execute() returnerar None) eller annars utfor:s resultat
+    (sqlite3). Pågår en insamling registreras satsen och cursorn wrappas så
+    att hämtade rader räknas.
+    massa=True för executemany/execute_values/COPY (parametrarna jämförs inte)."""
+    insamling = getattr(_lokal, "insamling", None)
+    if insamling is None:
+        resultat = utfor(*args)
+        return resultat if cursor is None else cursor
+    start = time.perf_counter()
+    resultat = utfor(*args)
+    sekunder = time.perf_counter() - start
+    if cursor is None:
+        cursor = resultat
+    rader = getattr(cursor, "rowcount", -1)
+    post = insamling.registrera(sql, params, sekunder, max(rader, 0), massa)
+    return _RaknandeCursor(cursor, post, rakna_rader=rader < 0)
+
+
+def _anropare():
+    """(funktion, källa): närmaste publika funktion utanför anslutningslagret,
+    t.ex. hamta_allokeringar, och första raden utanför databaslagret som
+    ledde dit, t.ex. "app.py:412"."""
+    ram = sys._getframe(2)
+    funktion = kalla = ""
+    while ram is not None:
+        fil = os.path.basename(ram.f_code.co_filename)
+        namn = ram.f_code.co_name
+        if not funktion:
+            if fil != _DENNA_FIL and not namn.startswith("_") and namn not in _OMSLAG:
+                funktion = namn
+        elif fil not in _INTERNA_FILER:
+            kalla = f"{fil}:{ram.f_lineno}"
+            break
+        ram = ram.f_back
+    return funktion or "?", kalla or "?"
+
+
+_STRANG = re.compile(r"'(?:[^']|'')*'")
+_TAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLATSHALLARE = re.compile(r"%s|\?")
+_LISTA = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_VARDELISTA = re.compile(r"\((?:\s*\?\s*,?)+\)(?:\s*,\s*\((?:\s*\?\s*,?)+\))+")
+_BLANKSTEG = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=512)
+def normalisera_sql(sql):
+    """SQL utan literaler och med enhetliga platshållare, så att samma sats
+    med olika värden eller listlängder blir samma nyckel."""
+    sql = _STRANG.sub("?", sql)
+    sql = _TAL.sub("?", sql)
+    sql = _PLATSHALLARE.sub("?", sql)
+    sql = _VARDELISTA.sub("(...)", sql)
+    sql = _LISTA.sub("(...)", sql)
+    return _BLANKSTEG.sub(" ", sql).strip()
+
+
+def logga_rapport(rapport):
+    """Skriv rapporten som en JSON-rad på loggern teammanager.fragelogg
+    (varning om den innehåller N+1-mönster)."""
+    if rapport is None:
+        return
+    if not logger.handlers:
+        hanterare = logging.StreamHandler()
+        hanterare.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+        logger.addHandler(hanterare)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    niva = logging.WARNING if rapport["n_plus_1"] else logging.INFO
+    logger.log(niva, json.dumps(rapport, ensure_ascii=False, default=str))
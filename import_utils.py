@@ -0,0 +1,388 @@
+"""
+import_utils.py - Import från Excel och CSV för Teammanager
+Läser allokering, frånvaro och personal i bitar, antingen i långt format
+(en rad per post, samma kolumner som CSV-exporten) eller brett (en rad per
+person/projekt och en kolumn per datum). Varje bit valideras vektoriserat
+med pandas och skrivs i en transaktion; fel och varningar rapporteras per rad.
+"""
+
+import csv
+import io
+import os
+from datetime import date, datetime
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+from calendar_utils import hamta_busdaycalendar
+from database import (
+    hamta_all_personal, hamta_alla_projekt, hamta_dagsbelastningar,
+    satt_allokeringar, satt_franvarodagar, satt_personal, FRANVARO_TYPER
+)
+
+# Ungefärligt antal celler per bit; en bit valideras och skrivs i en transaktion
+IMPORT_SIDSTORLEK = int(os.environ.get("TEAMMANAGER_IMPORT_SIDSTORLEK", 20000))
+# Högst så många fel respektive varningar sparas i rapporten (alla räknas)
+MAX_RAPPORTRADER = 1000
+
+_EXCEL_SUFFIX = (".xlsx", ".xlsm")
+
+
+# ============================================================
+# LÄSNING I BITAR
+# ============================================================
+
+def _kolumnnamn(varde):
+    """Rubrikcell som text; datum (Excel-celler) som ISO-datum."""
+    if isinstance(varde, datetime):
+        return varde.date().isoformat()
+    if isinstance(varde, date):
+        return varde.isoformat()
+    return "" if varde is None else str(varde).strip()
+
+
+def _las_excel(fil, sidstorlek):
+    from openpyxl import load_workbook
+
+    bok = load_workbook(fil, read_only=True, data_only=True)
+    rader = bok.active.iter_rows(values_only=True)
+    kolumner = [_kolumnnamn(v) for v in next(rader, ())]
+    per_bit = max(1, sidstorlek // max(1, len(kolumner)))
+
+    def bitar():
+        forsta = 2
+        try:
+            while True:
+                bit = [(rad + (None,) * len(kolumner))[:len(kolumner)] for rad in islice(rader, per_bit)]
+                if not bit:
+                    break
+                df = pd.DataFrame(bit, columns=kolumner, dtype=object,
+                                  index=pd.RangeIndex(forsta, forsta + len(bit)))
+                forsta += len(bit)
+                yield df.where(df != "", None)
+        finally:
+            bok.close()
+
+    return kolumner, bitar()
+
+
+def _las_csv(fil, sidstorlek):
+    if isinstance(fil, bytes):
+        fil = io.BytesIO(fil)
+    if isinstance(fil, (str, os.PathLike)):
+        text = open(fil, encoding="utf-8-sig", newline="")
+    else:
+        text = io.TextIOWrapper(fil, encoding="utf-8-sig", newline="")
+    rubrik = text.readline()
+    try:
+        separator = csv.Sniffer().sniff(rubrik, delimiters=";,\t").delimiter
+    except csv.Error:
+        separator = ";"
+    kolumner = [_kolumnnamn(k) for k in next(csv.reader([rubrik], delimiter=separator), [])]
+    per_bit = max(1, sidstorlek // max(1, len(kolumner)))
+
+    def bitar():
+        try:
+            for df in pd.read_csv(text, sep=separator, header=None, names=kolumner, dtype=object,
+                                  keep_default_na=False, na_values=[""], chunksize=per_bit,
+                                  skip_blank_lines=False):
+                df.index += 2
+                yield df
+        finally:
+            text.close()
+
+    return kolumner, bitar()
+
+
+def _las_bitar(fil, filnamn, sidstorlek):
+    """(kolumner, bitar) för en CSV- eller Excel-fil. bitar ger DataFrames med
+    ungefär sidstorlek celler, tomma celler som None/NaN och radnumret i filen
+    som index (rubriken är rad 1). Helt tomma rader tas bort."""
+    namn = str(filnamn or getattr(fil, "name", fil)).lower()
+    kolumner, bitar = (_las_excel if namn.endswith(_EXCEL_SUFFIX) else _las_csv)(fil, sidstorlek)
+    return kolumner, (df[df[kolumner].notna().any(axis=1)] for df in bitar)
+
+
+def _hitta_kolumn(kolumner, *namn, kravs=True):
+    """Filens kolumn som heter något av namn (skiftlägesokänsligt)."""
+    for kolumn in kolumner:
+        if kolumn.lower() in namn:
+            return kolumn
+    if kravs:
+        raise ValueError(f"Kolumnen {namn[0].capitalize()} saknas")
+    return None
+
+
+def _datumkolumner(kolumner, fasta, rapport):
+    """Datumrubrikerna i ett brett format: {kolumn: datum}. Övriga rubriker
+    rapporteras som fel på rad 1 och hoppas över."""
+    ovriga = [k for k in kolumner if k not in fasta]
+    datum = pd.to_datetime(pd.Series(ovriga, dtype=object), format="ISO8601", errors="coerce")
+    for kolumn, d in zip(ovriga, datum):
+        if pd.isna(d):
+            _rapportera(rapport, "fel", pd.DataFrame({"_rad": [1]}), kolumn or "(tom)",
+                        "Rubriken är inget datum, kolumnen hoppas över")
+    return {k: d for k, d in zip(ovriga, datum) if not pd.isna(d)}
+
+
+def _langt(df, kolumn):
+    """Långt format: _rad = radnumret och _kolumn = kolumnen som värdet kom från."""
+    df = df.reset_index(names="_rad")
+    df["_kolumn"] = kolumn
+    return df
+
+
+def _smalt(df, fasta, datumkolumner, varde):
+    """Brett format till långt: en rad per ifylld datumcell med _kolumn = rubriken,
+    i filens ordning. Görs med numpy i stället för DataFrame.melt, som blir långsam
+    med hundratals kolumner."""
+    rubriker = list(datumkolumner)
+    celler = df[rubriker].to_numpy(dtype=object)
+    rader, kolumner = np.nonzero(~pd.isna(celler))
+    return pd.DataFrame({
+        "_rad": df.index.to_numpy()[rader],
+        **{f: df[f].to_numpy(dtype=object)[rader] for f in fasta},
+        "_kolumn": np.array(rubriker, dtype=object)[kolumner],
+        varde: celler[rader, kolumner],
+        "datum": np.array([datumkolumner[k] for k in rubriker], dtype="datetime64[ns]")[kolumner],
+    })
+
+
+# ============================================================
+# VALIDERING OCH RAPPORT
+# ============================================================
+
+def _ny_rapport():
+    return {"importerade": 0, "fel": [], "varningar": [], "antal_fel": 0, "antal_varningar": 0}
+
+
+def _rapportera(rapport, nyckel, rader, kolumn, meddelande):
+    """Lägg raderna (DataFrame med _rad) i rapporten under nyckel ("fel" eller
+    "varningar"). kolumn och meddelande är text eller Series över raderna. Med
+    en fast kolumn (t.ex. Personal i brett format) rapporteras varje rad en gång."""
+    if not isinstance(kolumn, pd.Series):
+        rader = rader.drop_duplicates("_rad")
+    rapport[f"antal_{nyckel}"] += len(rader)
+    plats = MAX_RAPPORTRADER - len(rapport[nyckel])
+    if plats <= 0 or rader.empty:
+        return
+    rader = rader.head(plats)
+
+    def per_rad(varde):
+        return varde.loc[rader.index] if isinstance(varde, pd.Series) else [varde] * len(rader)
+
+    rapport[nyckel].extend(
+        {"rad": int(r), "kolumn": k, "meddelande": m}
+        for r, k, m in zip(rader["_rad"], per_rad(kolumn), per_rad(meddelande))
+    )
+
+
+def _kontrollera(df, kontroller, rapport):
+    """Kör (mask, kolumn, meddelande)-kontroller i ordning. En rad rapporteras
+    bara för sitt första fel. Returnerar de giltiga raderna."""
+    giltig = pd.Series(True, index=df.index)
+    for mask, kolumn, meddelande in kontroller:
+        traff = giltig & mask
+        if traff.any():
+            _rapportera(rapport, "fel", df[traff], kolumn, meddelande)
+        giltig &= ~traff
+    return df[giltig]
+
+
+def _tolka_datum(kolumn):
+    return pd.to_datetime(kolumn, format="ISO8601", errors="coerce")
+
+
+def _iso_datum(kolumn):
+    """Datumkolumn som ISO-strängar (Python-str, som databasen lagrar dem)."""
+    return np.datetime_as_string(kolumn.to_numpy(dtype="datetime64[D]"), unit="D").astype(object)
+
+
+def _tolka_tal(kolumn):
+    """Tal med decimalpunkt eller decimalkomma; annat blir NaN."""
+    return pd.to_numeric(kolumn.astype(str).str.strip().str.replace(",", ".", regex=False),
+                         errors="coerce")
+
+
+def _inte_arbetsdag(datum):
+    """Mask för giltiga datum som är helg eller svensk röd dag."""
+    mask = pd.Series(False, index=datum.index)
+    giltiga = datum.dropna()
+    if not giltiga.empty:
+        dagar = giltiga.values.astype("datetime64[D]")
+        kalender = hamta_busdaycalendar(giltiga.min().date(), giltiga.max().date())
+        mask.loc[giltiga.index] = ~np.is_busday(dagar, busdaycal=kalender)
+    return mask
+
+
+def _sammanstall(rapport):
+    for nyckel in ("fel", "varningar"):
+        rapport[nyckel].sort(key=lambda r: r["rad"])
+    return rapport
+
+
+# ============================================================
+# IMPORT
+# ============================================================
+
+def importera_allokeringar(fil, filnamn=None, sidstorlek=IMPORT_SIDSTORLEK):
+    """
+    Importera allokeringar från CSV eller Excel (.xlsx).
+    Långt format: Personal, Projekt, Datum, Timmar (som CSV-exporten).
+    Brett format: Personal, Projekt och en kolumn per datum med timmar.
+    Tomma celler hoppas över, 0 timmar tar bort allokeringen. Rader med okänd
+    person eller projekt, ogiltigt datum, helg/röd dag eller timmar utanför 0-24
+    blir fel; överbelagda dagar efter importen blir varningar.
+    Returnerar en rapport: {"importerade", "fel", "varningar", "antal_fel",
+    "antal_varningar"} där fel/varningar är {"rad", "kolumn", "meddelande"}.
+    """
+    rapport = _ny_rapport()
+    kolumner, bitar = _las_bitar(fil, filnamn, sidstorlek)
+    k_person = _hitta_kolumn(kolumner, "personal", "namn", "person")
+    k_projekt = _hitta_kolumn(kolumner, "projekt")
+    k_datum = _hitta_kolumn(kolumner, "datum", kravs=False)
+    if k_datum:
+        k_timmar = _hitta_kolumn(kolumner, "timmar")
+    else:
+        datumkolumner = _datumkolumner(kolumner, (k_person, k_projekt), rapport)
+
+    personal = hamta_all_personal(bara_aktiva=False)
+    person_id = {p["namn"]: p["id"] for p in personal}
+    kapacitet = {p["id"]: p["kapacitet_h"] for p in personal}
+    projekt_id = {p["namn"]: p["id"] for p in hamta_alla_projekt(bara_aktiva=False)}
+
+    for df in bitar:
+        if k_datum:
+            df = _langt(df.rename(columns={k_datum: "datum", k_timmar: "timmar"}), k_timmar)
+            df["datum"] = _tolka_datum(df["datum"])
+            datum_kolumn = k_datum
+        else:
+            df = _smalt(df, (k_person, k_projekt), datumkolumner, "timmar")
+            datum_kolumn = df["_kolumn"]
+        df["personal_id"] = df[k_person].str.strip().map(person_id)
+        df["projekt_id"] = df[k_projekt].str.strip().map(projekt_id)
+        df["timmar"] = _tolka_tal(df["timmar"])
+
+        df = _kontrollera(df, [
+            (df["personal_id"].isna(), k_person, "Okänd person: " + df[k_person].fillna("").astype(str)),
+            (df["projekt_id"].isna(), k_projekt, "Okänt projekt: " + df[k_projekt].fillna("").astype(str)),
+            (df["datum"].isna(), datum_kolumn, "Ogiltigt datum"),
+            (_inte_arbetsdag(df["datum"]), datum_kolumn, "Inte en arbetsdag (helg eller röd dag)"),
+            (df["timmar"].isna() | (df["timmar"] < 0) | (df["timmar"] > 24), df["_kolumn"],
+             "Timmar måste vara ett tal mellan 0 och 24"),
+        ], rapport)
+        if df.empty:
+            continue
+
+        df = df.astype({"personal_id": int, "projekt_id": int})
+        df["datum"] = _iso_datum(df["datum"])
+        rapport["importerade"] += satt_allokeringar(
+            df[["personal_id", "projekt_id", "datum", "timmar"]].itertuples(index=False, name=None))
+
+        belastning = hamta_dagsbelastningar(df[["personal_id", "datum"]].itertuples(index=False, name=None))
+        df["belastning"] = [belastning.get(n, 0) for n in zip(df["personal_id"], df["datum"])]
+        df["kapacitet"] = df["personal_id"].map(kapacitet)
+        over = df[(df["timmar"] > 0) & (df["belastning"] > df["kapacitet"])]
+        if not over.empty:
+            _rapportera(rapport, "varningar", over, over["_kolumn"],
+                        "Överbelagd " + over["datum"] + ": " + over["belastning"].map("{:g}".format)
+                        + " h av " + over["kapacitet"].map("{:g}".format) + " h")
+    return _sammanstall(rapport)
+
+
+def importera_franvaro(fil, filnamn=None, sidstorlek=IMPORT_SIDSTORLEK):
+    """
+    Importera frånvaro från CSV eller Excel (.xlsx).
+    Långt format: Personal, Datum, Typ och valfri Notering.
+    Brett format: Personal och en kolumn per datum med frånvarotyp.
+    Typ är en nyckel eller ett namn ur FRANVARO_TYPER (t.ex. "vab" eller "VAB").
+    Returnerar en rapport som importera_allokeringar.
+    """
+    rapport = _ny_rapport()
+    kolumner, bitar = _las_bitar(fil, filnamn, sidstorlek)
+    k_person = _hitta_kolumn(kolumner, "personal", "namn", "person")
+    k_datum = _hitta_kolumn(kolumner, "datum", kravs=False)
+    k_notering = _hitta_kolumn(kolumner, "notering", kravs=False)
+    if k_datum:
+        k_typ = _hitta_kolumn(kolumner, "typ")
+    else:
+        datumkolumner = _datumkolumner(kolumner, (k_person,), rapport)
+
+    person_id = {p["namn"]: p["id"] for p in hamta_all_personal(bara_aktiva=False)}
+    typer = {**{k: k for k in FRANVARO_TYPER},
+             **{t["namn"].lower(): k for k, t in FRANVARO_TYPER.items()}}
+
+    for df in bitar:
+        if k_datum:
+            df = _langt(df.rename(columns={k_datum: "datum", k_typ: "typ"}), k_typ)
+            df["datum"] = _tolka_datum(df["datum"])
+            datum_kolumn = k_datum
+        else:
+            df = _smalt(df, (k_person,), datumkolumner, "typ")
+            datum_kolumn = df["_kolumn"]
+        df["personal_id"] = df[k_person].str.strip().map(person_id)
+        df["typ_nyckel"] = df["typ"].astype(str).str.strip().str.lower().map(typer)
+
+        df = _kontrollera(df, [
+            (df["personal_id"].isna(), k_person, "Okänd person: " + df[k_person].fillna("").astype(str)),
+            (df["datum"].isna(), datum_kolumn, "Ogiltigt datum"),
+            (_inte_arbetsdag(df["datum"]), datum_kolumn, "Inte en arbetsdag (helg eller röd dag)"),
+            (df["typ_nyckel"].isna(), df["_kolumn"], "Okänd frånvarotyp: " + df["typ"].fillna("").astype(str)),
+        ], rapport)
+        if df.empty:
+            continue
+
+        noteringar = df[k_notering].fillna("").astype(str) if k_notering else [""] * len(df)
+        rapport["importerade"] += satt_franvarodagar(zip(
+            df["personal_id"].astype(int), _iso_datum(df["datum"]), df["typ_nyckel"], noteringar))
+    return _sammanstall(rapport)
+
+
+def importera_personal(fil, filnamn=None, sidstorlek=IMPORT_SIDSTORLEK):
+    """
+    Importera personal från CSV eller Excel (.xlsx), med samma kolumner som
+    personalexporten: Namn, Roll, Kapacitet (h/dag), Aktiv (Ja/Nej), Kompetenser
+    (kommaseparerade). Bara Namn krävs. Befintliga personer (samma namn)
+    uppdateras; en tom Kompetenser-cell lämnar kompetenserna orörda.
+    Returnerar en rapport som importera_allokeringar.
+    """
+    rapport = _ny_rapport()
+    kolumner, bitar = _las_bitar(fil, filnamn, sidstorlek)
+    k_namn = _hitta_kolumn(kolumner, "namn", "personal")
+    k_roll = _hitta_kolumn(kolumner, "roll", kravs=False)
+    k_kapacitet = _hitta_kolumn(kolumner, "kapacitet (h/dag)", "kapacitet", "kapacitet_h", kravs=False)
+    k_aktiv = _hitta_kolumn(kolumner, "aktiv", kravs=False)
+    k_kompetenser = _hitta_kolumn(kolumner, "kompetenser", kravs=False)
+    sant = {"ja", "j", "1", "1.0", "true", "sant", "x"}
+    falskt = {"nej", "n", "0", "0.0", "false", "falskt", ""}
+
+    for df in bitar:
+        df = _langt(df, k_namn)
+        df["namn"] = df[k_namn].fillna("").astype(str).str.strip()
+        df["roll"] = df[k_roll].fillna("").astype(str).str.strip() if k_roll else ""
+        df["kapacitet_h"] = _tolka_tal(df[k_kapacitet].fillna("8")) if k_kapacitet else 8.0
+        aktiv = df[k_aktiv].fillna("ja").astype(str).str.strip().str.lower() if k_aktiv else None
+        df["aktiv"] = aktiv.isin(sant) if k_aktiv else True
+
+        df = _kontrollera(df, [
+            (df["namn"] == "", k_namn, "Namn saknas"),
+            (df["kapacitet_h"].isna() | (df["kapacitet_h"] <= 0) | (df["kapacitet_h"] > 24),
+             k_kapacitet, "Kapacitet måste vara ett tal mellan 0 och 24"),
+            (~aktiv.isin(sant | falskt) if k_aktiv else pd.Series(False, index=df.index),
+             k_aktiv, "Aktiv måste vara Ja eller Nej"),
+        ], rapport)
+        if df.empty:
+            continue
+
+        dubbletter = df[df.duplicated("namn", keep="last")]
+        if not dubbletter.empty:
+            _rapportera(rapport, "varningar", dubbletter, k_namn,
+                        "Namnet förekommer igen längre ner; den sista raden gäller")
+        if k_kompetenser:
+            taggar = [None if pd.isna(v) else str(v).split(",") for v in df[k_kompetenser]]
+        else:
+            taggar = [None] * len(df)
+        satt_personal(zip(df["namn"], df["roll"], df["kapacitet_h"], df["aktiv"], taggar))
+        rapport["importerade"] += len(df) - len(dubbletter)
+    return _sammanstall(rapport)
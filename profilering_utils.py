@@ -0,0 +1,228 @@
+"""
+profilering_utils.py - Profilering av en körning (rerun) av app.py
+Tidtar sidans delar (uppstart, sidofält, sida -> rubrik/data/diagram/rendering)
+med varvmarkörer, och kan dessutom köra cProfile eller en samplande profilerare
+över hela körningen. Resultatet skrivs till PROFIL_KATALOG:
+
+    <tid>_<sida>.json               delarnas tider (+ samplingens fördelning per kategori)
+    <tid>_<sida>_delar.folded       delarna som "folded stacks" (mikrosekunder)
+    <tid>_<sida>_sampling.folded    samplade Python-stackar (antal sampel)
+    <tid>_<sida>.prof               cProfile/pstats (snakeviz, gprof2dot, flameprof)
+
+.folded-filerna läses av flamegraph.pl, inferno och speedscope.
+
+Läge väljs med TEAMMANAGER_PROFILERING eller ?profilering= i adressen:
+"delar" (eller "1"), "cprofile" eller "sampling". Utan aktiv profilering
+kostar markörerna bara en attributuppslagning.
+"""
+
+import cProfile
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+PROFIL_LAGEN = ("delar", "cprofile", "sampling")
+PROFILERING_LAGE = os.environ.get("TEAMMANAGER_PROFILERING", "").lower()
+PROFIL_KATALOG = os.environ.get(
+    "TEAMMANAGER_PROFIL_KATALOG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiler"))
+# Tid mellan sampel för den samplande profileraren (millisekunder)
+SAMPLING_INTERVALL_MS = float(os.environ.get("TEAMMANAGER_PROFIL_INTERVALL_MS", 5))
+
+# Sampel klassas efter modulen i stackens innersta Python-ram
+_KATEGORIER = [
+    ("databas", ("database.py", "sqlite3", "psycopg2", "fragelogg_utils.py")),
+    ("pandas/numpy", ("pandas", "numpy")),
+    ("plotly", ("plotly",)),
+    ("streamlit", ("streamlit",)),
+]
+
+_lokal = threading.local()
+
+
+def tolka_lage(varde):
+    """Normalisera ett lägesvärde från miljö/adress; None = ingen profilering."""
+    varde = (varde or "").lower()
+    if varde in ("1", "true", "ja"):
+        return "delar"
+    return varde if varde in PROFIL_LAGEN else None
+
+
+class _Sampler(threading.Thread):
+    """Bakgrundstråd som med jämna mellanrum läser en annan tråds stack."""
+
+    def __init__(self, profil, trad_id, intervall_s):
+        super().__init__(daemon=True, name="tm-profil-sampler")
+        self.profil = profil
+        self.trad_id = trad_id
+        self.intervall_s = intervall_s
+        self.stackar = Counter()
+        self.kategorier = Counter()
+        self._stopp = threading.Event()
+
+    def run(self):
+        while not self._stopp.wait(self.intervall_s):
+            ram = sys._current_frames().get(self.trad_id)
+            if ram is None:
+                continue
+            ramar = []
+            kategori = None
+            while ram is not None:
+                kod = ram.f_code
+                fil = kod.co_filename
+                if kategori is None:
+                    kategori = _kategori(fil)
+                ramar.append(f"{os.path.basename(fil)}:{kod.co_name}")
+                # Ramar ovanför app.py tillhör Streamlits skriptkörare
+                if kod.co_name == "<module>" and os.path.basename(fil) == "app.py":
+                    break
+                ram = ram.f_back
+            delar = [nod["namn"] for nod in list(self.profil.stack)[1:]]
+            self.stackar[";".join(delar + ramar[::-1])] += 1
+            self.kategorier[kategori] += 1
+
+    def stoppa(self):
+        self._stopp.set()
+        self.join()
+
+
+def _kategori(fil):
+    for namn, monster in _KATEGORIER:
+        if any(m in fil for m in monster):
+            return namn
+    return "app/python"
+
+
+class Profilering:
+    """En körnings delar som ett träd av noder {namn, tid, antal, barn}."""
+
+    def __init__(self, lage):
+        self.lage = lage
+        nu = time.perf_counter()
+        self.rot = {"namn": "", "start": nu, "tid": 0.0, "antal": 1, "barn": {}}
+        self.stack = [self.rot]
+        self.profiler = None
+        self.sampler = None
+        if lage == "cprofile":
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:  # en annan profilerare är redan aktiv i processen
+                self.profiler = None
+        elif lage == "sampling":
+            self.sampler = _Sampler(self, threading.get_ident(), SAMPLING_INTERVALL_MS / 1000)
+            self.sampler.start()
+
+    def _oppna(self, namn):
+        forald = self.stack[-1]
+        nod = forald["barn"].setdefault(namn, {"namn": namn, "tid": 0.0, "antal": 0, "barn": {}})
+        nod["start"] = time.perf_counter()
+        nod["antal"] += 1
+        self.stack.append(nod)
+
+    def _stang(self):
+        nod = self.stack.pop()
+        nod["tid"] += time.perf_counter() - nod.pop("start")
+
+    def varv(self, niva, namn):
+        """Avsluta delarna på nivå >= niva och börja en ny del på den nivån."""
+        while len(self.stack) > niva:
+            self._stang()
+        self._oppna(namn)
+
+    def avsluta(self):
+        while len(self.stack) > 1:
+            self._stang()
+        self.rot["tid"] = time.perf_counter() - self.rot.pop("start")
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.sampler is not None:
+            self.sampler.stoppa()
+
+
+def _platta(nod, vag=()):
+    """(väg, total tid, egen tid, antal) för varje nod under nod, i ordning."""
+    for barn in nod["barn"].values():
+        barn_vag = vag + (barn["namn"],)
+        egen = barn["tid"] - sum(b["tid"] for b in barn["barn"].values())
+        yield barn_vag, barn["tid"], egen, barn["antal"]
+        yield from _platta(barn, barn_vag)
+
+
+def starta_profilering(lage):
+    """Börja profilera körningen i den här tråden. En tidigare profilering som
+    aldrig avslutades (t.ex. efter st.rerun()) stoppas och kastas."""
+    tidigare = getattr(_lokal, "profil", None)
+    if tidigare is not None:
+        tidigare.avsluta()
+    _lokal.profil = Profilering(lage) if lage else None
+
+
+def profil_steg(namn):
+    """Varvmarkör på översta nivån, t.ex. "sidofält" eller sidans namn."""
+    profil = getattr(_lokal, "profil", None)
+    if profil is not None:
+        profil.varv(1, namn)
+
+
+def profil_del(namn):
+    """Varvmarkör inom aktuellt steg, t.ex. "data", "diagram" eller "rendering".
+    Delar med samma namn summeras."""
+    profil = getattr(_lokal, "profil", None)
+    if profil is not None:
+        profil.varv(2, namn)
+
+
+def avsluta_profilering(sida=""):
+    """Avsluta trådens profilering, skriv filerna och returnera sammanfattningen
+    (None om ingen profilering pågick)."""
+    profil = getattr(_lokal, "profil", None)
+    _lokal.profil = None
+    if profil is None:
+        return None
+    profil.avsluta()
+
+    delar = [{"del": " / ".join(vag), "ms": round(tid * 1000, 3),
+              "egen_ms": round(egen * 1000, 3), "antal": antal}
+             for vag, tid, egen, antal in _platta(profil.rot)]
+    sammanfattning = {
+        "tidpunkt": datetime.now().isoformat(timespec="seconds"),
+        "sida": sida,
+        "lage": profil.lage,
+        "total_ms": round(profil.rot["tid"] * 1000, 3),
+        "delar": delar,
+        "filer": [],
+    }
+    if profil.sampler is not None:
+        antal = sum(profil.sampler.kategorier.values()) or 1
+        sammanfattning["sampel"] = sum(profil.sampler.kategorier.values())
+        sammanfattning["kategorier"] = {k: round(n / antal, 3)
+                                        for k, n in profil.sampler.kategorier.most_common()}
+
+    os.makedirs(PROFIL_KATALOG, exist_ok=True)
+    bas = os.path.join(PROFIL_KATALOG, datetime.now().strftime("%Y%m%d-%H%M%S-%f") + "_"
+                       + (re.sub(r"[^\w-]+", "_", sida) or "app"))
+
+    def skriv(filnamn, rader):
+        with open(filnamn, "w", encoding="utf-8") as f:
+            f.writelines(f"{rad}\n" for rad in rader)
+        sammanfattning["filer"].append(filnamn)
+
+    skriv(bas + "_delar.folded",
+          (f"{';'.join(vag)} {round(egen * 1e6)}" for vag, _, egen, _ in _platta(profil.rot)
+           if egen > 0))
+    if profil.sampler is not None:
+        skriv(bas + "_sampling.folded",
+              (f"{stack} {antal}" for stack, antal in profil.sampler.stackar.most_common()))
+    if profil.profiler is not None:
+        profil.profiler.dump_stats(bas + ".prof")
+        sammanfattning["filer"].append(bas + ".prof")
+    sammanfattning["filer"].append(bas + ".json")
+    with open(bas + ".json", "w", encoding="utf-8") as f:
+        json.dump(sammanfattning, f, ensure_ascii=False, indent=2)
+    return sammanfattning